@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Load test of the Android message path over the socket transports of AndroidLink.
+
+For the TCP and Unix socket transports, a simulated tablet in a thread measures:
+- how many messages per second AndroidLink.send() gets across,
+- the round trip of a message from the tablet through AndroidLink.recv() and back through send(),
+- how many messages per second AndroidLink.recv() parses out of a burst sent by the tablet all at once,
+- how long a drop and reconnection takes, through the same close_client() and connect() as reconnect_android.
+
+Does not need the robot or Bluetooth, run from the root of the repository:
+
+    python3 -m benchmarks.android_link [messages]
+"""
+import logging
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from communication.android import AndroidLink, AndroidMessage
+from communication.transport import TCPTransport, Transport, UnixTransport
+
+RECONNECTIONS = 50
+
+
+def connect(address) -> socket.socket:
+    """Connects to the RPi like the tablet, retrying while the RPi is not listening"""
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    while True:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.connect(address)
+            return sock
+        except (ConnectionRefusedError, FileNotFoundError):
+            sock.close()
+            time.sleep(0.001)
+
+
+def read_lines(sock: socket.socket, count: int):
+    """Reads until `count` newline-terminated messages are received"""
+    received = 0
+    while received < count:
+        data = sock.recv(65536)
+        if not data:
+            raise ConnectionError("RPi closed the connection")
+        received += data.count(b"\n")
+
+
+def measure(transport: Transport, messages: int) -> dict:
+    link = AndroidLink(transport)
+    address = transport.address
+    tablet = {}
+    thread = threading.Thread(target=lambda: tablet.update(sock=connect(address)))
+    thread.start()
+    link.connect()
+    thread.join()
+    sock = tablet["sock"]
+
+    # Throughput from the RPi to the tablet
+    message = AndroidMessage("location", {"x": 10, "y": 5, "d": 2})
+    reader = threading.Thread(target=read_lines, args=(sock, messages))
+    reader.start()
+    start = time.perf_counter()
+    for _ in range(messages):
+        link.send(message)
+    reader.join()
+    send_rate = messages / (time.perf_counter() - start)
+
+    # Round trip from the tablet through the RPi and back
+    def echo():
+        for _ in range(messages):
+            link.send(AndroidMessage("info", link.recv()))
+
+    echoer = threading.Thread(target=echo)
+    echoer.start()
+    round_trips = []
+    for i in range(messages):
+        start = time.perf_counter()
+        sock.sendall(f'{{"cat": "control", "value": "{i}"}}\n'.encode("utf-8"))
+        read_lines(sock, 1)
+        round_trips.append(time.perf_counter() - start)
+    echoer.join()
+
+    # Burst from the tablet, which arrives in large reads holding many messages
+    burst = b"".join(f'{{"cat": "control", "value": "{i}"}}\n'.encode("utf-8") for i in range(messages))
+    start = time.perf_counter()
+    threading.Thread(target=sock.sendall, args=(burst,)).start()
+    for i in range(messages):
+        assert link.recv() == f'{{"cat": "control", "value": "{i}"}}'
+    recv_rate = messages / (time.perf_counter() - start)
+    sock.close()
+
+    # Drop and reconnection, as in reconnect_android
+    def tablet_reconnects():
+        reconnected = 0
+        while reconnected < RECONNECTIONS:
+            sock = connect(address)
+            try:
+                # The tablet may have been queued on the server socket just before it was closed
+                read_lines(sock, 1)
+                reconnected += 1
+            except OSError:
+                pass
+            sock.close()
+
+    reconnecting = threading.Thread(target=tablet_reconnects)
+    start = time.perf_counter()
+    reconnecting.start()
+    for _ in range(RECONNECTIONS):
+        link.close_client()
+        link.connect()
+        link.send(AndroidMessage("info", "You are reconnected!"))
+    reconnecting.join()
+    reconnect_time = (time.perf_counter() - start) / RECONNECTIONS
+    link.disconnect()
+
+    round_trips.sort()
+    return {
+        "send": send_rate,
+        "recv": recv_rate,
+        "rtt_p50": round_trips[len(round_trips) // 2] * 1e6,
+        "rtt_p99": round_trips[int(len(round_trips) * 0.99)] * 1e6,
+        "reconnect": reconnect_time * 1e6,
+    }
+
+
+def main(messages: int):
+    # Every message is logged at debug level, which would be timed along with it
+    logging.disable(logging.INFO)
+    transports = {
+        "tcp": TCPTransport("127.0.0.1", 0),
+        "unix": UnixTransport(os.path.join(tempfile.mkdtemp(), "android.sock")),
+    }
+    print(f"{messages} messages, {RECONNECTIONS} reconnections")
+    print(f"{'transport':>10}{'send (msg/s)':>14}{'burst (msg/s)':>15}{'RTT p50 (us)':>14}{'RTT p99 (us)':>14}{'reconnect (us)':>16}")
+    for name, transport in transports.items():
+        result = measure(transport, messages)
+        print(f"{name:>10}{result['send']:>14.0f}{result['recv']:>15.0f}{result['rtt_p50']:>14.0f}{result['rtt_p99']:>14.0f}"
+              f"{result['reconnect']:>16.0f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the capture profiles in settings.CAPTURE_PROFILES.
+
+For every profile, captures a number of images of the obstacle in front of the robot and sends them to the
+image recognition API, then reports the average capture time, JPEG size and API round-trip time.
+Run on the RPi with the API server up, from the root of the repository:
+
+    python3 -m benchmarks.capture_profiles [signal] [repeats]
+"""
+import statistics
+import sys
+import time
+from camera import CameraService
+from communication.api import APIClient
+from settings import CAPTURE_PROFILES
+
+
+def main(signal: str = "C", repeats: int = 5):
+    camera = CameraService(mode="still")
+    api = APIClient()
+    camera.start()
+    try:
+        # Open the keep-alive connection before measuring
+        api.get("/", timeout=1)
+        print(f"{'profile':<10}{'capture (s)':>14}{'size (KB)':>12}{'round-trip (s)':>17}")
+        for name in CAPTURE_PROFILES:
+            capture_times, sizes, round_trips = [], [], []
+            for attempt in range(repeats):
+                start = time.perf_counter()
+                image_data = camera.capture(signal=signal, profile=name)
+                capture_times.append(time.perf_counter() - start)
+                sizes.append(len(image_data))
+
+                filename = f"{int(time.time())}_0_{signal}_{name}{attempt}.jpg"
+                start = time.perf_counter()
+                response = api.post_file("/image", filename, image_data)
+                round_trips.append(time.perf_counter() - start)
+                if response.status_code != 200:
+                    print(f"{name}: image-rec API returned {response.status_code}")
+
+            print(f"{name:<10}{statistics.mean(capture_times):>14.3f}{statistics.mean(sizes) / 1024:>12.1f}"
+                  f"{statistics.mean(round_trips):>17.3f}")
+    finally:
+        camera.stop()
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:2], *[int(arg) for arg in sys.argv[2:3]])
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+End-to-end latency of a full run of an orchestrator against the simulated hardware in simulation/harness.py.
+
+Sets the obstacles from the simulated tablet, starts the robot, and waits until the images are stitched. From the
+timeline recorded by the simulated STM32, Android and API, reports how long the RPi takes at each stage, e.g. from
+an ACK to the next command, on top of the simulated motion, capture and inference times. Does not need the robot,
+run from the root of the repository:
+
+    python3 -m benchmarks.e2e_latency [--orchestrator task1|task1-async|task2] [--motion 0.05] ...
+"""
+import argparse
+import logging
+import os
+import sys
+from typing import Dict, List, Optional
+from simulation.harness import ORCHESTRATORS, Simulation
+from simulation.timeline import Event, Timeline
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Returns the nearest-rank percentile of the values"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def after(events: List[Event], time: float) -> Optional[Event]:
+    """Returns the first event at or after a time"""
+    return next((event for event in events if event.time >= time), None)
+
+
+def before(events: List[Event], time: float) -> Optional[Event]:
+    """Returns the last event at or before a time"""
+    return next((event for event in reversed(events) if event.time <= time), None)
+
+
+def stages(timeline: Timeline) -> Dict[str, List[float]]:
+    """Measures the time the RPi spends at each stage of the run, in seconds"""
+    commands = timeline.events("stm", "command")
+    acks = timeline.events("stm", "ack")
+    requests = timeline.events("api", "request")
+    responses = timeline.events("api", "response")
+    received = timeline.events("android", "recv")
+    sent = timeline.events("android", "send")
+    images = [event for event in requests if event.detail == "/image"]
+    results: Dict[str, List[float]] = {}
+
+    def add(stage: str, start: Optional[Event], end: Optional[Event]):
+        if start is not None and end is not None:
+            results.setdefault(stage, []).append(end.time - start.time)
+
+    for event in sent:
+        if event.detail == "obstacles":
+            add("Obstacles to /compute request", event, after(requests, event.time))
+            compute = after(responses, event.time)
+            add("/compute response to path ready", compute, after(
+                [e for e in received if e.detail.startswith("info:Commands and path received")], event.time))
+        elif event.detail == "control:start":
+            add("Start to first command", event, after(commands, event.time))
+            stitch = after([e for e in responses if e.detail == "/stitch"], event.time)
+            add("Start to images stitched (end to end)", event, stitch)
+
+    # Time between an ACK and the next command, unless the robot stopped to snap in between
+    for ack in acks:
+        command = after(commands, ack.time)
+        image = after(images, ack.time)
+        if command is not None and (image is None or image.time > command.time):
+            add("ACK to next command", ack, command)
+
+    # Locations that queued up are coalesced by the RPi, so every location is matched to the latest ACK
+    for location in (event for event in received if event.detail == "location"):
+        add("ACK to location on Android", before(acks, location.time), location)
+
+    image_results = [event for event in received if event.detail == "image-rec"]
+    for image in images:
+        add("ACK to image upload (capture)", before(acks, image.time), image)
+        response = after([e for e in responses if e.detail == "/image"], image.time)
+        add("/image response to next command", response, after(commands, image.time))
+        add("/image response to result on Android", response, after(image_results, image.time))
+
+    for stitch in (event for event in requests if event.detail == "/stitch"):
+        add("Last ACK to /stitch request", before(acks, stitch.time), stitch)
+    return results
+
+
+def main(args: argparse.Namespace):
+    # Every message and command is logged at debug level, which would flood the report
+    logging.disable(logging.DEBUG)
+    simulation = Simulation(args.orchestrator, args.motion, args.capture, args.inference, protocol=args.protocol)
+    try:
+        finished = simulation.run(timeout=args.timeout)
+    finally:
+        simulation.stop()
+    if not finished:
+        print("Run did not finish in time", file=sys.stderr)
+
+    print(f"{args.orchestrator}: motion {args.motion * 1000:.0f} ms, capture {args.capture * 1000:.0f} ms, "
+          f"inference {args.inference * 1000:.0f} ms per step, "
+          f"{len(simulation.timeline.events('stm', 'command'))} STM32 commands")
+    print(f"{'stage':<40}{'n':>4}{'mean':>9}{'p50':>9}{'p90':>9}{'max':>9}  (ms)")
+    for stage, values in stages(simulation.timeline).items():
+        print(f"{stage:<40}{len(values):>4}{sum(values) / len(values) * 1000:>9.1f}"
+              f"{percentile(values, 0.5) * 1000:>9.1f}{percentile(values, 0.9) * 1000:>9.1f}"
+              f"{max(values) * 1000:>9.1f}")
+    # The orchestrator's own threads never return
+    sys.stdout.flush()
+    os._exit(0 if finished else 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--orchestrator", choices=ORCHESTRATORS, default="task1")
+    parser.add_argument("--motion", type=float, default=0.05, help="seconds the STM32 takes per command")
+    parser.add_argument("--capture", type=float, default=0.05, help="seconds per camera capture")
+    parser.add_argument("--inference", type=float, default=0.05, help="seconds the API takes per request")
+    parser.add_argument("--protocol", choices=("ascii", "binary"), default="ascii")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for each step of the run")
+    main(parser.parse_args())
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark of the IPC backends in ipc.py.
+
+For each backend, measures the one-way latency of a message between two processes, through a ping-pong over a pair
+of queues, and the cost of the lock, event and shared dict operations that the RPi processes perform on every
+command. Does not need the robot, run from the root of the repository:
+
+    python3 -m benchmarks.ipc_latency [iterations]
+"""
+import sys
+import time
+from multiprocessing import Process
+from ipc import create_manager
+
+
+def echo(requests, replies):
+    """[Child Process] Sends every message back until it receives None"""
+    while True:
+        message = requests.get()
+        replies.put(message)
+        if message is None:
+            break
+
+
+def per_op(operation, iterations: int) -> float:
+    """Returns the average time of an operation in microseconds"""
+    start = time.perf_counter()
+    for i in range(iterations):
+        operation(i)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def measure(backend: str, iterations: int) -> dict:
+    manager = create_manager(backend)
+    requests, replies = manager.Queue(), manager.Queue()
+    lock, event = manager.Lock(), manager.Event()
+    location = manager.dict()
+    location.update(x=1, y=1, d=0)
+
+    echo_proc = Process(target=echo, args=(requests, replies))
+    echo_proc.start()
+
+    def ping(i):
+        requests.put(("FW10", i))
+        replies.get()
+
+    def lock_cycle(_):
+        lock.acquire()
+        lock.release()
+
+    def event_cycle(_):
+        event.set()
+        event.clear()
+
+    try:
+        # Warm up the processes and connections before measuring
+        per_op(ping, 100)
+        results = {
+            "queue message": per_op(ping, iterations) / 2,
+            "lock acquire+release": per_op(lock_cycle, iterations),
+            "event set+clear": per_op(event_cycle, iterations),
+            "dict update": per_op(lambda i: location.update(x=i, y=i, d=i % 4), iterations),
+            "dict read": per_op(lambda _: location['x'], iterations),
+        }
+    finally:
+        requests.put(None)
+        replies.get()
+        echo_proc.join()
+        manager.shutdown()
+    return results
+
+
+def main(iterations: int = 2000):
+    backends = ["manager", "native"]
+    results = {backend: measure(backend, iterations) for backend in backends}
+    print(f"{'operation (us)':<24}" + "".join(f"{backend:>12}" for backend in backends) + f"{'speedup':>10}")
+    for operation in results["manager"]:
+        manager_time, native_time = (results[backend][operation] for backend in backends)
+        print(f"{operation:<24}{manager_time:>12.1f}{native_time:>12.1f}{manager_time / native_time:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Reports the memory used by a running orchestrator and all of its child processes, to compare the process-per-stage
+orchestrator (`task1.py`) with the single-process one (`task1.py --asyncio`). Run on the RPi while the robot is set
+up, with the PID of the orchestrator:
+
+    python3 -m benchmarks.orchestrator_rss <pid>
+
+Command latency is logged by the orchestrator itself, on every "ACK for <command> (#<seq>) received after ... ms" line,
+and summed up per run by `log_analyzer.py`.
+"""
+import os
+import sys
+from typing import Iterator
+
+
+def descendants(pid: int) -> Iterator[int]:
+    """Yields the PID and the PIDs of all of its descendants"""
+    yield pid
+    for task in os.listdir(f"/proc/{pid}/task"):
+        with open(f"/proc/{pid}/task/{task}/children") as f:
+            for child in f.read().split():
+                yield from descendants(int(child))
+
+
+def rss_kb(pid: int) -> int:
+    """Returns the resident set size of a process in KB"""
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def main(pid: int):
+    total = 0
+    print(f"{'pid':>8}{'RSS (MB)':>10}  command")
+    for process in descendants(pid):
+        with open(f"/proc/{process}/cmdline", "rb") as f:
+            command = f.read().replace(b"\0", b" ").decode(errors="replace").strip()
+        rss = rss_kb(process)
+        total += rss
+        print(f"{process:>8}{rss / 1024:>10.1f}  {command}")
+    print(f"{'total':>8}{total / 1024:>10.1f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]))
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Throughput of the STM32 protocols in STMLink, against the simulated STM32 in simulation/stm32_sim.py.
+
+For the ASCII and binary protocols, sends a path of commands one at a time, waiting for each ACK as the dispatcher
+does with a window of 1, then the same path in batches with send_batch(), and reports commands per second and the
+bytes written. The wire delay is simulated at `BAUD_RATE`, and the commands take no time to carry out, so the
+numbers are an upper bound on what the link can do. Does not need the robot, run from the root of the repository:
+
+    python3 -m benchmarks.stm_protocol [commands] [batch size]
+"""
+import logging
+import sys
+import time
+from communication.stm32 import STMLink
+from simulation.stm32_sim import STM32Simulator
+
+PATH = ["FW10", "FR00", "BW20", "FL00", "FW30", "BR00", "BW10", "BL00"]
+
+
+def run(protocol: str, commands: int, batch: int) -> dict:
+    simulator = STM32Simulator(protocol)
+    simulator.start()
+    link = STMLink(port=simulator.port, protocol=protocol)
+    link.connect()
+    path = [PATH[i % len(PATH)] for i in range(commands)]
+    try:
+        start = time.perf_counter()
+        for command in path:
+            link.send(command)
+            assert link.recv(timeout=1) == "ACK"
+        single = time.perf_counter() - start
+        sent = simulator.bytes_received
+
+        start = time.perf_counter()
+        for i in range(0, commands, batch):
+            chunk = path[i:i + batch]
+            link.send_batch(chunk)
+            for _ in chunk:
+                assert link.recv(timeout=1) == "ACK"
+        batched = time.perf_counter() - start
+    finally:
+        link.disconnect()
+        simulator.stop()
+    return {
+        "single": commands / single,
+        "batched": commands / batched,
+        "bytes": sent / commands,
+    }
+
+
+def main(commands: int, batch: int):
+    # Every command is logged at debug level, which would be timed along with it
+    logging.disable(logging.DEBUG)
+    print(f"{commands} commands, batches of {batch}")
+    print(f"{'protocol':>10}{'single (cmd/s)':>16}{'batched (cmd/s)':>17}{'bytes/cmd':>11}")
+    for protocol in ("ascii", "binary"):
+        result = run(protocol, commands, batch)
+        print(f"{protocol:>10}{result['single']:>16.0f}{result['batched']:>17.0f}{result['bytes']:>11.1f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500, int(sys.argv[2]) if len(sys.argv) > 2 else 8)
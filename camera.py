@@ -0,0 +1,431 @@
+import time
+from multiprocessing import Array, Condition, Lock, Pipe, Process, Value, shared_memory
+from typing import List, Optional
+from logger import prepare_logger
+from metrics import metrics
+from settings import (CAMERA_MODE, CAMERA_RING_SLOT_SIZE, CAMERA_RING_SLOTS, CAMERA_SETTLE_FRAMES,
+                      CAMERA_WARMUP, CAPTURE_CROPS, CAPTURE_PROFILE, CAPTURE_PROFILES)
+
+
+class FrameRing:
+    """
+    Fixed-size ring buffer of JPEG frames kept in shared memory.
+
+    The camera process writes every frame straight into the next slot through a FrameWriter, and any other
+    process can access the newest frame, or one of the few before it, without asking the camera for a new capture.
+    Frames are numbered by a running index, so slot `index % slots` holds frame `index` until it is overwritten.
+    The slot of the next frame is being written to, so at most `slots - 1` frames can be read at any time.
+    """
+
+    def __init__(self, slots: int = CAMERA_RING_SLOTS, slot_size: int = CAMERA_RING_SLOT_SIZE):
+        """
+        Constructor for FrameRing.
+        :param slots: Number of frames kept in the ring.
+        :param slot_size: Maximum size of a single frame in bytes.
+        """
+        self.slots = slots
+        self.slot_size = slot_size
+        self._shm = shared_memory.SharedMemory(create=True, size=slots * slot_size)
+        self._lengths = Array('l', slots, lock=False)
+        # Number of frames written so far, i.e. index of the next frame
+        self._count = Value('l', 0, lock=False)
+        self._new_frame = Condition(Lock())
+
+    @property
+    def count(self) -> int:
+        """
+        Returns the number of frames written so far.
+        :return: Index of the next frame to be written.
+        """
+        return self._count.value
+
+    def writer(self) -> "FrameWriter":
+        """
+        Returns a writable stream that fills the next slot of the ring.
+        :return: FrameWriter for this ring.
+        """
+        return FrameWriter(self)
+
+    def view(self, index: int) -> Optional[memoryview]:
+        """Returns a frame by its index, without copying it out of shared memory
+
+        The view is only valid until the frame is overwritten, `slots - 1` frames later.
+
+        Args:
+            index (int): index of the frame
+
+        Returns:
+            Optional[memoryview]: the frame, or None if it was not written yet or was already overwritten
+        """
+        with self._new_frame:
+            if not self._readable(index):
+                return None
+            return self._slot(index)[:self._lengths[index % self.slots]]
+
+    def read_into(self, index: int, buffer: bytearray) -> Optional[memoryview]:
+        """Copies a frame by its index into a buffer owned by the caller
+
+        Args:
+            index (int): index of the frame
+            buffer (bytearray): buffer of at least `slot_size` bytes
+
+        Returns:
+            Optional[memoryview]: view of the frame in the buffer, or None if it was not written yet or was
+            already overwritten
+        """
+        with self._new_frame:
+            if not self._readable(index):
+                return None
+            size = self._lengths[index % self.slots]
+            buffer[:size] = self._slot(index)[:size]
+        return memoryview(buffer)[:size]
+
+    def wait_for(self, index: int, timeout: Optional[float] = None) -> Optional[int]:
+        """Waits until the frame with the given index has been written
+
+        Args:
+            index (int): index of the frame to wait for
+            timeout (Optional[float]): maximum time to wait in seconds
+
+        Returns:
+            Optional[int]: index of the newest frame, or None on timeout
+        """
+        with self._new_frame:
+            if not self._new_frame.wait_for(lambda: self._count.value > index, timeout):
+                return None
+            return self._count.value - 1
+
+    def close(self):
+        """Releases the shared memory. Must only be called by the process that created the ring"""
+        try:
+            self._shm.close()
+        except BufferError:
+            # Views handed out by view() are still alive, the memory is released with the process
+            pass
+        self._shm.unlink()
+
+    def _slot(self, index: int) -> memoryview:
+        """Returns the whole slot of a frame in shared memory"""
+        offset = (index % self.slots) * self.slot_size
+        return self._shm.buf[offset:offset + self.slot_size]
+
+    def _readable(self, index: int) -> bool:
+        """Checks whether a frame was written and is not being overwritten"""
+        count = self._count.value
+        return 0 <= index < count and index > count - self.slots
+
+    def _publish(self, size: int) -> int:
+        """Makes the frame written into the next slot available to readers, and returns its index"""
+        with self._new_frame:
+            index = self._count.value
+            self._lengths[index % self.slots] = size
+            self._count.value = index + 1
+            self._new_frame.notify_all()
+        return index
+
+
+class FrameWriter:
+    """
+    Writable stream that the camera captures into, which fills the next slot of a FrameRing in place.
+    This avoids allocating a new buffer for every frame, and copying the frame again into the ring.
+    """
+
+    def __init__(self, ring: FrameRing):
+        """
+        Constructor for FrameWriter.
+        :param ring: Ring to write the frames into.
+        """
+        self._ring = ring
+        self._size = 0
+        self._overflow = False
+
+    def write(self, data: bytes) -> int:
+        """Appends data to the frame in the next slot of the ring
+
+        Args:
+            data (bytes): chunk of the JPEG frame
+
+        Returns:
+            int: number of bytes consumed
+        """
+        size = len(data)
+        if self._size + size > self._ring.slot_size:
+            self._overflow = True
+        if not self._overflow:
+            self._ring._slot(self._ring.count)[self._size:self._size + size] = data
+            self._size += size
+        return size
+
+    def flush(self):
+        """Nothing to flush, the data is written into shared memory directly"""
+        pass
+
+    def commit(self) -> Optional[int]:
+        """Publishes the frame written so far, and starts the next frame
+
+        Returns:
+            Optional[int]: index of the frame, or None if it did not fit into a slot
+        """
+        index = None if self._overflow else self._ring._publish(self._size)
+        self._size = 0
+        self._overflow = False
+        return index
+
+
+class CameraService:
+    """
+    Long-lived process that owns the PiCamera for the whole run.
+
+    The camera is opened and warmed up once when the service starts, and stays open until stop() is called.
+    Any child process of the orchestrator can call capture(), which forwards the request over a pipe to the
+    camera process, so a snap only pays for the capture itself. The camera process captures straight into a
+    FrameRing in shared memory, and capture() returns a view of the frame there instead of a copy.
+    A view stays valid until the ring wraps around, i.e. for the next `CAMERA_RING_SLOTS - 2` captures, and
+    must be copied with bytes() if it is kept for longer.
+
+    In `stream` mode the camera process instead captures continuously from the video port into the ring,
+    and capture() returns the first frame taken after the request, while recent() gives access to the frames
+    before it for retries without recapturing. As the ring is overwritten at the framerate, these frames are
+    copied into a pool of reusable buffers, which are valid for the same number of captures.
+    """
+
+    def __init__(self, mode: str = CAMERA_MODE):
+        """
+        Constructor for CameraService.
+        :param mode: Either "still" or "stream".
+        """
+        self.logger = prepare_logger()
+        self.mode = mode
+        self.ring = FrameRing()
+        self._conn, self._service_conn = Pipe()
+        # Serialises requests from the different child processes over the single pipe
+        self._lock = Lock()
+        # Index of the last frame handed out by capture() in this process
+        self._last_index = None
+        # Reusable buffers that stream mode frames are copied into, allocated on first use in each process
+        self._buffers = None
+        self._next_buffer = 0
+        self.proc = None
+
+    def start(self):
+        """Starts the camera process, which opens the camera and lets the exposure settle"""
+        self.proc = Process(target=self._serve, daemon=True)
+        self.proc.start()
+        self.logger.info(f"Camera service started in {self.mode} mode")
+
+    def stop(self):
+        """Asks the camera process to close the camera, and waits for it to exit"""
+        if self.proc is None:
+            return
+        with self._lock:
+            self._conn.send(("stop", None))
+        self.proc.join(timeout=5)
+        self.proc = None
+        self.ring.close()
+        self.logger.info("Camera service stopped")
+
+    def capture(self, brightness: Optional[int] = None, contrast: Optional[int] = None,
+                framerate: Optional[int] = None, signal: Optional[str] = None,
+                profile: Optional[str] = None) -> memoryview:
+        """Captures a JPEG image with the warmed up camera
+
+        Settings that are not given are reset to the camera defaults, so every capture starts from the same state.
+        In stream mode the framerate cannot be changed while recording and is ignored, and so are the signal
+        and profile, as the stream uses CAPTURE_PROFILE without cropping.
+
+        Args:
+            brightness (Optional[int]): camera brightness (0 to 100)
+            contrast (Optional[int]): camera contrast (-100 to 100)
+            framerate (Optional[int]): camera framerate
+            signal (Optional[str]): position of the obstacle (L, C or R), used to crop if the profile allows it
+            profile (Optional[str]): name of the capture profile in CAPTURE_PROFILES, defaults to CAPTURE_PROFILE
+
+        Returns:
+            memoryview: the captured JPEG image
+        """
+        settings = {"brightness": brightness, "contrast": contrast, "framerate": framerate,
+                    "signal": signal, "profile": profile}
+        start = time.monotonic()
+        with self._lock:
+            self._conn.send(("capture", settings))
+            status, payload = self._conn.recv()
+        if status != "ok":
+            raise RuntimeError(f"Camera capture failed: {payload}")
+        if self.mode != "stream":
+            metrics.record("capture", time.monotonic() - start)
+            return self.ring.view(payload)
+
+        # In stream mode, the camera process replies with the first frame index that is taken after the request
+        index = self.ring.wait_for(payload, timeout=2)
+        metrics.record("capture", time.monotonic() - start)
+        frame = self._copy_frame(index) if index is not None else None
+        if frame is None:
+            raise RuntimeError("Camera capture failed: no frame from the video port")
+        self._last_index = index
+        return frame
+
+    def capture_bracket(self, brackets: List[dict], signal: Optional[str] = None,
+                        profile: Optional[str] = None) -> List[memoryview]:
+        """Captures one JPEG image per group of settings, back-to-back
+
+        In still mode all captures are done in a single request to the camera process.
+
+        Args:
+            brackets (List[dict]): camera settings (brightness, contrast, framerate) for each capture
+            signal (Optional[str]): position of the obstacle (L, C or R), used to crop if the profile allows it
+            profile (Optional[str]): name of the capture profile in CAPTURE_PROFILES, defaults to CAPTURE_PROFILE
+
+        Returns:
+            List[memoryview]: the captured JPEG images, in the same order as the settings
+        """
+        brackets = [{**settings, "signal": signal, "profile": profile} for settings in brackets]
+        if self.mode == "stream":
+            return [self.capture(**settings) for settings in brackets]
+
+        start = time.monotonic()
+        with self._lock:
+            self._conn.send(("bracket", brackets))
+            status, payload = self._conn.recv()
+        if status != "ok":
+            raise RuntimeError(f"Camera capture failed: {payload}")
+        # Timed per image, as the images are captured back-to-back
+        for _ in payload:
+            metrics.record("capture", (time.monotonic() - start) / len(payload))
+        return [self.ring.view(index) for index in payload]
+
+    def recent(self, age: int = 1) -> Optional[memoryview]:
+        """Returns a frame taken before the last captured one, without capturing again
+
+        Args:
+            age (int): how many frames before the last captured frame
+
+        Returns:
+            Optional[memoryview]: the frame, or None if not streaming or if it was already overwritten
+        """
+        if self.mode != "stream" or self._last_index is None:
+            return None
+        return self._copy_frame(self._last_index - age)
+
+    def _copy_frame(self, index: int) -> Optional[memoryview]:
+        """Copies a frame out of the ring into the next reusable buffer"""
+        if self._buffers is None:
+            self._buffers = [bytearray(self.ring.slot_size) for _ in range(self.ring.slots - 1)]
+        buffer = self._buffers[self._next_buffer]
+        self._next_buffer = (self._next_buffer + 1) % len(self._buffers)
+        return self.ring.read_into(index, buffer)
+
+    def _serve(self):
+        """
+        [Camera Process] Keeps the camera open and serves capture requests until asked to stop
+        """
+        # Imported here so that only the camera process holds the camera libraries
+        import picamera
+
+        start = time.monotonic()
+        with picamera.PiCamera() as camera:
+            camera.vflip = True  # Vertical flip
+            camera.hflip = True  # Horizontal flip
+            camera.start_preview()
+            # Let the exposure settle once, instead of on every snap
+            time.sleep(CAMERA_WARMUP)
+            metrics.record("camera_warmup", time.monotonic() - start)
+            defaults = {"brightness": camera.brightness,
+                        "contrast": camera.contrast, "framerate": camera.framerate}
+            self.logger.info("Camera is warmed up and ready")
+
+            if self.mode == "stream":
+                self._serve_stream(camera, defaults)
+            else:
+                self._serve_still(camera, defaults)
+
+            camera.stop_preview()
+
+    def _serve_still(self, camera, defaults: dict):
+        """
+        [Camera Process] Captures a still image for every request, or one per settings for bracket requests,
+        and replies with the indices of the frames in the ring
+        """
+        writer = self.ring.writer()
+        while True:
+            request, settings = self._service_conn.recv()
+            if request == "stop":
+                break
+
+            brackets = settings if request == "bracket" else [settings]
+            try:
+                frames = []
+                for bracket in brackets:
+                    self._apply_settings(camera, defaults, bracket)
+                    options = self._apply_profile(camera, bracket)
+                    camera.capture(writer, format='jpeg', **options)
+                    index = writer.commit()
+                    if index is None:
+                        raise RuntimeError("Frame too large for the ring buffer")
+                    frames.append(index)
+                self._service_conn.send(("ok", frames if request == "bracket" else frames[0]))
+            except Exception as e:
+                self.logger.error(f"Error capturing image: {e}")
+                self._service_conn.send(("error", str(e)))
+
+    def _serve_stream(self, camera, defaults: dict):
+        """
+        [Camera Process] Captures continuously from the video port into the ring buffer, and answers
+        requests between frames with the index of the first frame that satisfies them
+        """
+        # The framerate cannot be changed while recording from the video port
+        defaults = {name: value for name, value in defaults.items() if name != "framerate"}
+        profile = CAPTURE_PROFILES[CAPTURE_PROFILE]
+        writer = self.ring.writer()
+        for _ in camera.capture_continuous(writer, format='jpeg', use_video_port=True,
+                                           quality=profile["quality"], resize=profile["resize"]):
+            if writer.commit() is None:
+                self.logger.warning("Frame too large for the ring buffer, dropped")
+
+            while self._service_conn.poll():
+                request, settings = self._service_conn.recv()
+                if request == "stop":
+                    return
+
+                try:
+                    changed = self._apply_settings(camera, defaults, settings)
+                    # Give the new settings a few frames to take effect
+                    first_index = self.ring.count + (CAMERA_SETTLE_FRAMES if changed else 0)
+                    self._service_conn.send(("ok", first_index))
+                except Exception as e:
+                    self.logger.error(f"Error changing camera settings: {e}")
+                    self._service_conn.send(("error", str(e)))
+
+    @staticmethod
+    def _apply_profile(camera, settings: dict) -> dict:
+        """Crops the camera to the region of the obstacle if the capture profile allows it, and returns the
+        options to pass to camera.capture()"""
+        profile = CAPTURE_PROFILES[settings.get("profile") or CAPTURE_PROFILE]
+        crop = CAPTURE_CROPS.get(settings.get("signal")) if profile["crop"] else None
+        width, height = profile["resize"] or camera.resolution
+        resize = profile["resize"]
+        zoom = (0.0, 0.0, 1.0, 1.0)
+        if crop is not None:
+            x, y, w, h = crop
+            # The crop is applied on the sensor, before the image is flipped
+            if camera.hflip:
+                x = 1.0 - x - w
+            if camera.vflip:
+                y = 1.0 - y - h
+            zoom = (x, y, w, h)
+            # Keep the scale of the profile instead of stretching the region to the full size
+            resize = (int(width * w) // 32 * 32, int(height * h) // 16 * 16)
+        if camera.zoom != zoom:
+            camera.zoom = zoom
+        return {"quality": profile["quality"], "resize": resize}
+
+    @staticmethod
+    def _apply_settings(camera, defaults: dict, settings: dict) -> bool:
+        """Applies the requested settings, falling back to the defaults, and returns whether anything changed"""
+        changed = False
+        for name, default in defaults.items():
+            value = settings.get(name)
+            value = default if value is None else value
+            if getattr(camera, name) != value:
+                setattr(camera, name, value)
+                changed = True
+        return changed
@@ -1,9 +1,22 @@
 import json
-import os
+import queue
+import select
 import socket
-from typing import Optional
-import bluetooth
+import time
+from multiprocessing import Pipe, Value
+from multiprocessing.reduction import recv_handle, send_handle
+from typing import List, Optional
 from communication.link import Link
+from communication.transport import Transport, create_transport
+from metrics import Gauge, metrics
+from settings import ANDROID_OUTBOX_SIZE, ANDROID_SEND_INTERVAL
+
+# Maximum number of bytes read from the socket at once
+RECV_SIZE = 4096
+# Categories of messages that are sent to Android before the others waiting with them
+PRIORITY_CATEGORIES = ("image-rec", "status", "error")
+# Categories whose last message is sent again when Android reconnects, as it may have missed it
+REPLAYED_CATEGORIES = ("location", "status")
 
 
 class AndroidMessage:
@@ -19,6 +32,8 @@ class AndroidMessage:
         """
         self._cat = cat
         self._value = value
+        # Monotonic time at which the message was created, to measure how long it waits to be sent
+        self.created = time.monotonic()
 
     @property
     def cat(self):
@@ -45,9 +60,225 @@ class AndroidMessage:
         return json.dumps({'cat': self._cat, 'value': self._value})
 
 
+class AndroidOutbox:
+    """
+    Messages waiting to be sent to Android, coalesced while they wait.
+
+    Only the latest `location` is kept, since an older one is outdated by the time it could be sent. Messages in
+    `PRIORITY_CATEGORIES` are taken before the rest and are not held back to wait for more messages, and the
+    others, e.g. `info`, keep their order, so that all the messages waiting can be sent together in one write.
+
+    While Android is disconnected, the messages keep waiting in the outbox, up to `max_others` of the others, and
+    the last location and status sent are replayed once it reconnects.
+
+    The number of messages waiting and the counters are kept in shared memory, so that they can be read from
+    another process than the sender, e.g. for the metrics endpoint, if the outbox is created before the processes
+    are forked. The messages themselves are only in the process using the outbox.
+    """
+
+    def __init__(self, max_others: int = ANDROID_OUTBOX_SIZE):
+        """
+        Constructor for AndroidOutbox.
+        :param max_others: Maximum number of messages outside PRIORITY_CATEGORIES and locations that wait, the
+            oldest are dropped beyond it.
+        """
+        self.max_others = max_others
+        self._priority: List[AndroidMessage] = []
+        self._location: Optional[AndroidMessage] = None
+        self._others: List[AndroidMessage] = []
+        # Last message taken in each of REPLAYED_CATEGORIES
+        self._last = {}
+        self._depth = Value('l', 0, lock=False)
+        # Number of locations replaced by a newer one before they were sent, and of other messages dropped
+        self._coalesced = Value('l', 0, lock=False)
+        self._dropped = Value('l', 0, lock=False)
+        # Number of messages taken, and how long the oldest message of the last batch waited, in seconds
+        self._sent = Value('l', 0, lock=False)
+        self._last_latency = Value('d', 0.0, lock=False)
+
+    def __len__(self) -> int:
+        return len(self._priority) + len(self._others) + (self._location is not None)
+
+    @property
+    def depth(self) -> int:
+        """
+        Returns the number of messages waiting, from any process.
+        :return: Number of messages waiting.
+        """
+        return self._depth.value
+
+    @property
+    def coalesced(self) -> int:
+        """
+        Returns the number of locations replaced by a newer one before they were sent.
+        :return: Number of locations coalesced.
+        """
+        return self._coalesced.value
+
+    @property
+    def dropped(self) -> int:
+        """
+        Returns the number of messages dropped as more than `max_others` were waiting.
+        :return: Number of messages dropped.
+        """
+        return self._dropped.value
+
+    @property
+    def sent(self) -> int:
+        """
+        Returns the number of messages taken to be sent, less the ones put back by restore().
+        :return: Number of messages sent.
+        """
+        return self._sent.value
+
+    @property
+    def last_latency(self) -> float:
+        """
+        Returns how long the oldest message of the last batch taken waited in the outbox.
+        :return: Latency in seconds.
+        """
+        return self._last_latency.value
+
+    @property
+    def urgent(self) -> bool:
+        """
+        Checks whether a priority message is waiting, which should be sent without waiting for more messages.
+        :return: True if a message in PRIORITY_CATEGORIES is waiting.
+        """
+        return bool(self._priority)
+
+    def put(self, message: AndroidMessage):
+        """
+        Adds a message to send.
+        :param message: Message to send.
+        """
+        if message.cat in PRIORITY_CATEGORIES:
+            self._priority.append(message)
+        elif message.cat == "location":
+            if self._location is not None:
+                self._coalesced.value += 1
+            self._location = message
+        else:
+            self._others.append(message)
+            self._trim()
+        self._depth.value = len(self)
+
+    def restore(self, messages: List[AndroidMessage]):
+        """
+        Puts back messages that were taken but could not be sent, ahead of the ones that arrived since.
+        :param messages: Messages returned by take().
+        """
+        self._priority = [message for message in messages if message.cat in PRIORITY_CATEGORIES] + self._priority
+        self._others = [message for message in messages
+                        if message.cat not in PRIORITY_CATEGORIES and message.cat != "location"] + self._others
+        self._trim()
+        locations = [message for message in messages if message.cat == "location"]
+        if locations and self._location is None:
+            self._location = locations[-1]
+        self._sent.value -= len(messages)
+        self._depth.value = len(self)
+
+    def replay(self):
+        """
+        Puts back the last location and status taken, for Android to catch up after reconnecting, unless newer
+        ones are already waiting.
+        """
+        waiting = {message.cat for message in self._priority}
+        if self._location is not None:
+            waiting.add("location")
+        for cat, message in self._last.items():
+            if cat not in waiting:
+                self.put(message)
+
+    def fill(self, source, deadline: float):
+        """
+        Moves the messages that arrive on a queue until the deadline into the outbox, then those already queued.
+        Stops waiting as soon as a priority message is in the outbox.
+        :param source: Queue of AndroidMessage, e.g. android_queue.
+        :param deadline: time.monotonic() until which to wait for more messages.
+        """
+        while True:
+            timeout = 0.0 if self.urgent else max(0.0, deadline - time.monotonic())
+            try:
+                self.put(source.get(timeout=timeout))
+            except queue.Empty:
+                return
+
+    def take(self) -> List[AndroidMessage]:
+        """
+        Takes all the messages waiting, in the order to send them: priority messages first, then the latest
+        location, then the others.
+        :return: Messages to send.
+        """
+        messages = self._priority + ([self._location] if self._location is not None else []) + self._others
+        self._priority, self._location, self._others = [], None, []
+        self._depth.value = 0
+        for message in messages:
+            if message.cat in REPLAYED_CATEGORIES:
+                self._last[message.cat] = message
+        if messages:
+            now = time.monotonic()
+            for message in messages:
+                metrics.record("android_queue_wait", now - message.created)
+            self._sent.value += len(messages)
+            self._last_latency.value = now - min(message.created for message in messages)
+        return messages
+
+    def _trim(self):
+        if len(self._others) > self.max_others:
+            self._dropped.value += len(self._others) - self.max_others
+            del self._others[:len(self._others) - self.max_others]
+
+
+class SocketHandoff:
+    """
+    Passes a connected socket from one process to another, e.g. a connection to Android accepted by the main
+    process to a child process that uses the link, so that the child keeps running across reconnections.
+
+    The file descriptor is sent over a Unix socket pair, which works for any kind of socket, including RFCOMM.
+    Must be created before the processes are forked, with one handoff per receiving process.
+    """
+
+    def __init__(self):
+        self._receiver, self._sender = Pipe()
+
+    def send(self, sock: socket.socket):
+        """
+        Sends a socket to the receiving process, which gets its own copy of it.
+        :param sock: Socket to send.
+        """
+        # The destination PID is only used on Windows
+        send_handle(self._sender, sock.fileno(), None)
+
+    def poll(self, timeout: Optional[float] = 0.0) -> bool:
+        """
+        Checks whether a socket was sent.
+        :param timeout: Maximum time to wait in seconds, None to wait forever.
+        :return: True if recv() would not block.
+        """
+        return self._receiver.poll(timeout)
+
+    def fileno(self) -> int:
+        """
+        Returns a file descriptor that is readable once a socket was sent, to wait on it with select().
+        :return: File descriptor of the receiving end.
+        """
+        return self._receiver.fileno()
+
+    def recv(self) -> socket.socket:
+        """
+        Waits for a socket to be sent.
+        :return: The socket.
+        """
+        return socket.socket(fileno=recv_handle(self._receiver))
+
+
 class AndroidLink(Link):
     """Class for communicating with Android tablet over Bluetooth connection. 
 
+    The tablet connects over a `Transport`: Bluetooth RFCOMM on the robot, or a TCP or Unix socket to test the
+    message path without Bluetooth (`ANDROID_TRANSPORT`). Messages are framed the same way over all of them.
+
     ## General Format
     Messages between the Android app and Raspi will be in the following format:
     ```json
@@ -107,77 +338,293 @@ class AndroidLink(Link):
 
     """
 
-    def __init__(self):
+    def __init__(self, transport: Optional[Transport] = None):
         """
-        Initialize the Bluetooth connection.
+        Initialize the Android connection.
+        :param transport: Transport that the tablet connects over, by default the one for ANDROID_TRANSPORT.
         """
         super().__init__()
+        self.transport = create_transport() if transport is None else transport
         self.client_sock = None
-        self.server_sock = None
+        # Number of connections made by connect() or adopt(), to tell when the connection changed
+        self.connections = 0
+        # Bytes received after the last whole message
+        self._buffer = bytearray()
+
+    @property
+    def server_sock(self):
+        """
+        Returns the socket that the tablet connects to.
+        :return: Server socket of the transport, or None if not listening.
+        """
+        return self.transport.server_sock
 
     def connect(self):
         """
-        Connect to Andriod by Bluetooth
+        Connect to Android over the transport
         """
-        self.logger.info("Bluetooth connection started")
+        self.logger.info(f"{self.transport.name} connection started")
         try:
-            # Set RPi to be discoverable in order for service to be advertisable
-            os.system("sudo hciconfig hci0 piscan")
-
-            # Initialize server socket
-            self.server_sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
-            self.server_sock.bind(("", bluetooth.PORT_ANY))
-            self.server_sock.listen(1)
-
-            # Parameters
-            port = self.server_sock.getsockname()[1]
-            uuid = '94f39d29-7d6d-437d-973b-fba39e49d4ee'
-
-            # Advertise
-            bluetooth.advertise_service(self.server_sock, "MDP-Group21-RPi", service_id=uuid, service_classes=[
-                                        uuid, bluetooth.SERIAL_PORT_CLASS], profiles=[bluetooth.SERIAL_PORT_PROFILE])
-
-            self.logger.info(
-                f"Awaiting Bluetooth connection on RFCOMM CHANNEL {port}")
-            self.client_sock, client_info = self.server_sock.accept()
+            self.client_sock, client_info = self.transport.accept()
+            # A partial message from the previous connection will never be completed
+            self._buffer.clear()
+            self.connections += 1
             self.logger.info(f"Accepted connection from: {client_info}")
 
         except Exception as e:
-            self.logger.error(f"Error in Bluetooth link connection: {e}")
-            self.server_sock.close()
-            self.client_sock.close()
+            self.logger.error(f"Error in {self.transport.name} link connection: {e}")
+            self.transport.close()
+            if self.client_sock is not None:
+                self.client_sock.close()
 
     def disconnect(self):
-        """Disconnect from Android Bluetooth connection and shutdown all the sockets established"""
+        """Disconnect from Android and shutdown all the sockets established"""
+        try:
+            self.logger.debug(f"Disconnecting {self.transport.name} link")
+            self.transport.close()
+            if self.client_sock is not None:
+                self.client_sock.shutdown(socket.SHUT_RDWR)
+                self.client_sock.close()
+                self.client_sock = None
+            self.logger.info(f"Disconnected {self.transport.name} link")
+        except Exception as e:
+            self.logger.error(f"Failed to disconnect {self.transport.name} link: {e}")
+
+    def close_client(self):
+        """Closes the connection to Android, but keeps listening for it to reconnect"""
+        if self.client_sock is None:
+            return
         try:
-            self.logger.debug("Disconnecting Bluetooth link")
-            self.server_sock.shutdown(socket.SHUT_RDWR)
             self.client_sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            # Already disconnected by Android
+            pass
+        self.client_sock.close()
+        self.client_sock = None
+        self._buffer.clear()
+
+    def adopt(self, sock: socket.socket):
+        """
+        Switches to a connection to Android accepted by another process, e.g. received through a SocketHandoff.
+        :param sock: Socket connected to Android.
+        """
+        if self.client_sock is not None:
             self.client_sock.close()
-            self.server_sock.close()
-            self.client_sock = None
-            self.server_sock = None
-            self.logger.info("Disconnected Bluetooth link")
-        except Exception as e:
-            self.logger.error(f"Failed to disconnect Bluetooth link: {e}")
+        self.client_sock = sock
+        self._buffer.clear()
+        self.connections += 1
 
     def send(self, message: AndroidMessage):
         """Send message to Android"""
         try:
-            self.client_sock.send(f"{message.jsonify}\n".encode("utf-8"))
+            with metrics.timer("android_send"):
+                self.client_sock.send(f"{message.jsonify}\n".encode("utf-8"))
             self.logger.debug(f"Sent to Android: {message.jsonify}")
         except OSError as e:
             self.logger.error(f"Error sending message to Android: {e}")
             raise e
 
-    def recv(self) -> Optional[str]:
-        """Receive message from Android"""
+    def send_many(self, messages: List[AndroidMessage]):
+        """Send several messages to Android in a single write
+
+        Args:
+            messages (List[AndroidMessage]): messages to send, in order
+        """
+        if not messages:
+            return
+        try:
+            with metrics.timer("android_send"):
+                self.client_sock.sendall("".join(f"{message.jsonify}\n" for message in messages).encode("utf-8"))
+            self.logger.debug(f"Sent to Android: {' '.join(message.jsonify for message in messages)}")
+        except OSError as e:
+            self.logger.error(f"Error sending message to Android: {e}")
+            raise e
+
+    @property
+    def buffered(self) -> bool:
+        """
+        Checks whether a whole message was already received, so that recv() returns it without reading the socket.
+        :return: True if recv() would not block.
+        """
+        # Everything before the last newline is whole lines, which are messages unless blank
+        end = self._buffer.rfind(b"\n")
+        return end >= 0 and bool(self._buffer[:end].strip())
+
+    def recv(self, wait: bool = True) -> Optional[str]:
+        """Receive the next message from Android
+
+        Messages end with a newline. The socket is read in blocks into a buffer that is kept between calls, so a
+        message split across several reads is put back together, and messages received in the same read are
+        returned one by one without reading the socket again.
+
+        Args:
+            wait (bool): whether to keep reading until a whole message is received, or to read the socket at most
+                once, e.g. when it is known to be readable
+
+        Returns:
+            Optional[str]: the message without its newline, None if there is no whole message yet and wait is
+            False, or "" once Android has closed the connection
+        """
         try:
-            tmp = self.client_sock.recv(1024)
-            self.logger.debug(tmp)
-            message = tmp.strip().decode("utf-8")
+            message = self._next_message()
+            while message is None:
+                data = self.client_sock.recv(RECV_SIZE)
+                if not data:
+                    if self._buffer.strip():
+                        self.logger.warning(f"Android closed the connection mid-message: {bytes(self._buffer)}")
+                    self._buffer.clear()
+                    return ""
+                self._buffer += data
+                message = self._next_message()
+                if message is None and not wait:
+                    return None
             self.logger.debug(f"Received from Android: {message}")
             return message
         except OSError as e:  # connection broken, try to reconnect
             self.logger.error(f"Error receiving message from Android: {e}")
             raise e
+
+    def _next_message(self) -> Optional[str]:
+        """Takes the next message out of the buffer, or returns None if there is no whole message yet"""
+        while True:
+            end = self._buffer.find(b"\n")
+            if end < 0:
+                return None
+            line = bytes(self._buffer[:end]).strip()
+            del self._buffer[:end + 1]
+            # Blank lines, e.g. from a sender that ends messages with two newlines, are not messages
+            if line:
+                return line.decode("utf-8")
+
+
+class AndroidMixin:
+    """
+    Android side of an orchestrator that runs its pipeline as child processes: receiving the messages from Android,
+    sending the messages of `android_queue` through an outbox, and handing the connection over to the child
+    processes when Android reconnects.
+
+    The orchestrator provides `logger`, `android_link`, `android_queue`, `android_outbox`, `android_dropped`,
+    `android_recv_handoff` and `android_send_handoff`, and carries out the messages in handle_android_message().
+    """
+
+    def handle_android_message(self, msg_str: str) -> None:
+        """
+        Carries out a message received from Android
+        :param msg_str: the JSON message received from Android
+        """
+        raise NotImplementedError
+
+    def android_mode(self) -> str:
+        """
+        Returns the mode that Android is told the robot is in when it connects
+        :return: "path" or "manual"
+        """
+        return "path"
+
+    def android_gauges(self) -> List[Gauge]:
+        """
+        Reads the state of the Android link and its sender for the metrics endpoint.
+        :return: The gauges.
+        """
+        return [
+            ("rpi_android_connected", "Whether Android is connected", {}, int(not self.android_dropped.is_set())),
+            ("rpi_android_outbox_depth", "Messages waiting in the outbox of the Android sender", {},
+             self.android_outbox.depth),
+            ("rpi_android_messages", "Messages to Android by what became of them", {"outcome": "sent"},
+             self.android_outbox.sent),
+            ("rpi_android_messages", "Messages to Android by what became of them", {"outcome": "coalesced"},
+             self.android_outbox.coalesced),
+            ("rpi_android_messages", "Messages to Android by what became of them", {"outcome": "dropped"},
+             self.android_outbox.dropped),
+            ("rpi_android_send_latency_seconds", "Time the oldest message of the last batch to Android waited", {},
+             self.android_outbox.last_latency),
+        ]
+
+    def reconnect_android(self):
+        """Handles the reconnection to Android in the event of a lost connection."""
+        self.logger.info("Reconnection handler is watching...")
+
+        while True:
+            # Wait for android connection to drop
+            self.android_dropped.wait()
+
+            self.logger.error("Android link is down!")
+
+            # The child processes keep running, only the connection is replaced
+            self.android_link.close_client()
+            self.android_link.connect()
+            self.android_recv_handoff.send(self.android_link.client_sock)
+            self.android_send_handoff.send(self.android_link.client_sock)
+            self.logger.info("Android connection handed over to child processes")
+
+            self.android_dropped.clear()
+            self.android_queue.put(AndroidMessage("info", "You are reconnected!"))
+            self.android_queue.put(AndroidMessage('mode', self.android_mode()))
+
+    def recv_android(self) -> None:
+        """
+        [Child Process] Processes the messages received from Android
+        """
+        while True:
+            if not self.android_link.buffered:
+                # Wait for a message, or for the connection to be handed over after Android reconnects
+                readable, _, _ = select.select([self.android_link.client_sock, self.android_recv_handoff], [], [])
+                if self.android_recv_handoff in readable:
+                    self.android_link.adopt(self.android_recv_handoff.recv())
+                    continue
+
+            msg_str: Optional[str] = None
+            try:
+                msg_str = self.android_link.recv()
+            except OSError:
+                msg_str = ""
+
+            if msg_str == "":
+                # The socket reads as empty once Android closes the connection
+                if not self.android_recv_handoff.poll():
+                    self.android_dropped.set()
+                    self.logger.debug("Event set: Android connection closed")
+                self.android_link.adopt(self.android_recv_handoff.recv())
+                continue
+
+            self.handle_android_message(msg_str)
+
+    def android_sender(self) -> None:
+        """
+        [Child process] Responsible for retrieving messages from android_queue and sending them over the Android link.
+        Messages are written at most every ANDROID_SEND_INTERVAL, and the ones that queue up in between are coalesced
+        and sent together. While Android is disconnected, the messages wait in the outbox until the new connection is
+        handed over.
+        """
+        outbox = self.android_outbox
+        last_sent = 0.0
+        while True:
+            # Retrieve from queue
+            try:
+                outbox.put(self.android_queue.get(timeout=0.5))
+            except queue.Empty:
+                if not len(outbox):
+                    continue
+
+            if self.android_send_handoff.poll():
+                self.android_link.adopt(self.android_send_handoff.recv())
+                # Android may have missed the last location and status while it was disconnected
+                outbox.replay()
+            if self.android_link.client_sock is None:
+                continue
+            outbox.fill(self.android_queue, last_sent + ANDROID_SEND_INTERVAL)
+            messages = outbox.take()
+
+            try:
+                self.android_link.send_many(messages)
+            except OSError:
+                outbox.restore(messages)
+                self.android_link.close_client()
+                # Unless Android already reconnected, and this was the old connection
+                if not self.android_send_handoff.poll():
+                    self.android_dropped.set()
+                    self.logger.debug("Event set: Android dropped")
+                continue
+            last_sent = time.monotonic()
+            self.logger.debug(f"Sent {len(messages)} message(s) to Android in one write, oldest after "
+                              f"{outbox.last_latency * 1000:.1f} ms, {outbox.coalesced} location(s) coalesced so far")
@@ -0,0 +1,136 @@
+import os
+import time
+import uuid
+from typing import Iterator, Optional, Union
+import requests
+from requests.adapters import HTTPAdapter
+from logger import prepare_logger
+from metrics import metrics
+from settings import API_IP, API_PORT, API_POOL_SIZE
+
+
+class MultipartBody:
+    """
+    Streamed `multipart/form-data` body holding a single file.
+
+    The file is sent as it is, e.g. a memoryview of a captured frame, between a small header and footer, so it is
+    not copied into a separate request body first. The body has a length, so it is sent with a Content-Length
+    header rather than chunked.
+    """
+
+    def __init__(self, field: str, filename: str, data: Union[bytes, memoryview], content_type: str = "image/jpeg"):
+        """
+        Constructor for MultipartBody.
+        :param field: Name of the form field.
+        :param filename: Filename of the file.
+        :param data: Contents of the file.
+        :param content_type: MIME type of the file.
+        """
+        self.boundary = uuid.uuid4().hex
+        self._head = (f"--{self.boundary}\r\n"
+                      f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+                      f"Content-Type: {content_type}\r\n\r\n").encode("utf-8")
+        self._data = memoryview(data)
+        self._tail = f"\r\n--{self.boundary}--\r\n".encode("utf-8")
+        # When the whole body was handed to the connection, i.e. the upload finished
+        self.sent_at: Optional[float] = None
+
+    @property
+    def content_type(self) -> str:
+        """
+        Returns the Content-Type header of the body.
+        :return: multipart/form-data content type with the boundary.
+        """
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self) -> int:
+        return len(self._head) + self._data.nbytes + len(self._tail)
+
+    def __iter__(self) -> Iterator[Union[bytes, memoryview]]:
+        yield self._head
+        yield self._data
+        yield self._tail
+        self.sent_at = time.monotonic()
+
+
+class APIClient:
+    """
+    Client for the Algorithm and Image Recognition API running on the laptop.
+
+    Requests go through a `requests.Session`, so connections to `API_IP:API_PORT` are kept alive and reused
+    instead of paying a new TCP handshake on every call.
+    A session cannot be shared between processes, so every child process lazily creates its own on first use,
+    and the threads within a process share it.
+    """
+
+    def __init__(self, host: str = API_IP, port: int = API_PORT):
+        """
+        Constructor for APIClient.
+        :param host: IP address of the API server.
+        :param port: Port of the API server.
+        """
+        self.logger = prepare_logger()
+        self.base_url = f"http://{host}:{port}"
+        self._session = None
+        self._pid = None
+
+    @property
+    def session(self) -> requests.Session:
+        """
+        Returns the session of the current process, creating it if needed.
+        :return: Session with a connection pool to the API server.
+        """
+        if self._session is None or self._pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=API_POOL_SIZE)
+            session.mount("http://", adapter)
+            self._session = session
+            self._pid = os.getpid()
+            self.logger.debug(f"Created API session for process {self._pid}")
+        return self._session
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        """Sends a GET request to the API
+
+        Args:
+            path (str): path of the endpoint, e.g. `/stitch`
+            **kwargs: passed on to `requests.Session.get`
+
+        Returns:
+            requests.Response: response from the API
+        """
+        return self.session.get(f"{self.base_url}{path}", **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        """Sends a POST request to the API
+
+        Args:
+            path (str): path of the endpoint, e.g. `/image`
+            **kwargs: passed on to `requests.Session.post`
+
+        Returns:
+            requests.Response: response from the API
+        """
+        return self.session.post(f"{self.base_url}{path}", **kwargs)
+
+    def post_file(self, path: str, filename: str, data: Union[bytes, memoryview], field: str = "file",
+                  **kwargs) -> requests.Response:
+        """Uploads a file to the API as `multipart/form-data`, streaming it without copying it into the body
+
+        Args:
+            path (str): path of the endpoint, e.g. `/image`
+            filename (str): filename of the file
+            data (Union[bytes, memoryview]): contents of the file
+            field (str): name of the form field
+            **kwargs: passed on to `requests.Session.post`
+
+        Returns:
+            requests.Response: response from the API
+        """
+        body = MultipartBody(field, filename, data)
+        start = time.monotonic()
+        response = self.post(path, data=body, headers={"Content-Type": body.content_type}, **kwargs)
+        if body.sent_at is not None:
+            metrics.record("upload", body.sent_at - start)
+            metrics.record("inference", time.monotonic() - body.sent_at)
+        return response
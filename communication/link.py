@@ -14,7 +14,7 @@ class Link(ABC):
         """
         Constructor for Link.
         """
-        self.logger = prepare_logger()
+        self.logger = prepare_logger(type(self).__module__)
 
     @abstractmethod
     def send(self, message: str) -> None:
@@ -0,0 +1,151 @@
+"""
+Compact binary framing for the commands between the RPi and the STM32, as an alternative to 4-character ASCII.
+
+Every frame is 5 bytes:
+
+| byte | field  | value                                                                  |
+|------|--------|------------------------------------------------------------------------|
+| 0    | sync   | `0xAA`                                                                 |
+| 1    | opcode | command, from `OPCODES`                                                |
+| 2    | arg    | argument of the command, e.g. 10 for `FW10`, `ARG_INDEFINITE` for `--` |
+| 3    | seq    | sequence number of the command, modulo 256                             |
+| 4    | crc    | CRC-8 (polynomial `0x07`) of bytes 1 to 3                              |
+
+The STM32 acknowledges a command with an `ACK` frame carrying the sequence number of the command. A command resent
+by the RPi, because its ACK did not arrive, keeps its sequence number, so the STM32 acknowledges a frame with the
+same sequence number as the last command it carried out again, without carrying it out twice.
+"""
+from typing import List, NamedTuple
+
+SYNC = 0xAA
+FRAME_SIZE = 5
+# Argument of the manual mode commands that run indefinitely, e.g. `FW--`
+ARG_INDEFINITE = 0xFF
+
+OPCODES = {
+    "ACK": 0x06,
+    "FW": 0x10, "BW": 0x11, "FS": 0x12, "BS": 0x13,
+    "FL": 0x20, "FR": 0x21, "BL": 0x22, "BR": 0x23, "TL": 0x24, "TR": 0x25,
+    "SL": 0x30, "SR": 0x31, "LL": 0x32, "LR": 0x33, "BK": 0x34,
+    "RS": 0x40, "DT": 0x41, "ZZ": 0x42,
+    "STOP": 0x50,
+}
+COMMANDS = {opcode: name for name, opcode in OPCODES.items()}
+
+
+def _crc8_table() -> List[int]:
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return table
+
+
+CRC8_TABLE = _crc8_table()
+
+
+def crc8(data: bytes) -> int:
+    """Returns the CRC-8 (polynomial `0x07`) of the data"""
+    crc = 0
+    for byte in data:
+        crc = CRC8_TABLE[crc ^ byte]
+    return crc
+
+
+class Frame(NamedTuple):
+    """Decoded frame"""
+    opcode: int
+    arg: int
+    seq: int
+
+    @property
+    def command(self) -> str:
+        """
+        Returns the frame as an ASCII command.
+        :return: Command, e.g. `FW10`, `FW--`, `STOP` or `ACK`.
+        """
+        name = COMMANDS.get(self.opcode, f"?{self.opcode:02X}")
+        if name in ("ACK", "STOP"):
+            return name
+        if self.arg == ARG_INDEFINITE:
+            return f"{name}--"
+        return f"{name}{self.arg:02d}"
+
+
+def encode(command: str, seq: int) -> bytes:
+    """Encodes an ASCII command into a frame
+
+    Args:
+        command (str): command, e.g. `FW10`, `FW--` or `STOP`
+        seq (int): sequence number of the command
+
+    Returns:
+        bytes: the frame
+
+    Raises:
+        ValueError: if the command has no opcode or its argument does not fit in a byte
+    """
+    if command in ("ACK", "STOP"):
+        opcode, arg = OPCODES[command], 0
+    else:
+        name, value = command[:2], command[2:]
+        if name not in OPCODES or len(value) != 2:
+            raise ValueError(f"Command {command!r} cannot be encoded")
+        opcode = OPCODES[name]
+        arg = ARG_INDEFINITE if value == "--" else int(value)
+    body = bytes((opcode, arg, seq & 0xFF))
+    return bytes((SYNC,)) + body + bytes((crc8(body),))
+
+
+def can_encode(command: str) -> bool:
+    """Checks whether a command can be encoded into a frame, e.g. not the `A` and `C` commands, which have no
+    opcode"""
+    try:
+        encode(command, 0)
+    except ValueError:
+        return False
+    return True
+
+
+class FrameDecoder:
+    """
+    Splits a stream of bytes into frames. Bytes before a sync byte and frames with a bad CRC are skipped, so the
+    decoder resynchronises by itself after a corrupted or partial frame.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.dropped = 0
+
+    def feed(self, data: bytes) -> List[Frame]:
+        """Adds received bytes, and returns the frames that are now complete
+
+        Args:
+            data (bytes): bytes received
+
+        Returns:
+            List[Frame]: frames decoded, possibly none
+        """
+        self._buffer += data
+        frames = []
+        while True:
+            start = self._buffer.find(SYNC)
+            if start < 0:
+                self.dropped += len(self._buffer)
+                self._buffer.clear()
+                return frames
+            if start:
+                self.dropped += start
+                del self._buffer[:start]
+            if len(self._buffer) < FRAME_SIZE:
+                return frames
+            body = bytes(self._buffer[1:4])
+            if crc8(body) != self._buffer[4]:
+                # Not a frame after all, look for the next sync byte
+                self.dropped += 1
+                del self._buffer[:1]
+                continue
+            frames.append(Frame(*body))
+            del self._buffer[:FRAME_SIZE]
@@ -1,7 +1,25 @@
-from typing import Optional
+import queue
+import threading
+import time
+from collections import deque
+from typing import List, Optional
 import serial
 from communication.link import Link
-from settings import SERIAL_PORT, BAUD_RATE
+from communication.protocol import FrameDecoder, can_encode, encode
+from metrics import metrics
+from settings import SERIAL_PORT, BAUD_RATE, STM_FRAME_TIMEOUT, STM_PROTOCOL, STM_READ_TIMEOUT
+
+
+class STMMessage(str):
+    """
+    Message received from STM32, e.g. `ACK`, with the sequence number of its frame in binary protocol.
+    """
+
+    def __new__(cls, text: str, seq: Optional[int] = None):
+        message = super().__new__(cls, text)
+        # Sequence number of the command acknowledged, None in ASCII protocol
+        message.seq = seq
+        return message
 
 
 class STMLink(Link):
@@ -30,18 +48,45 @@ class STMLink(Link):
     After every command received on the STM32, an acknowledgement (string: `ACK`) must be sent back to the RPi.
     This signals to the RPi that the STM32 has completed the command, and is ready for the next command.
 
+    Messages from the STM32 end with a newline. They are read in bulk into a buffer and split into lines here, and a
+    partial line that stays idle for `STM_FRAME_TIMEOUT` is taken as a message with its newline dropped, so that a
+    lost newline cannot hold up the messages after it.
+
+    ### Binary protocol
+    With the `binary` protocol, every command is sent as a 5-byte frame with a sequence number and a CRC, and the
+    STM32 acknowledges it with an `ACK` frame instead (see `communication.protocol`). Messages are still received
+    as strings, e.g. `ACK`, so the protocol makes no difference to the rest of the RPi, but carry the sequence
+    number of their frame in `seq`. The dispatcher sends every command with its own sequence number, and resends it
+    with the same one, so that STM32 can tell a resent command from a new one, and the ACK from the command it
+    acknowledges.
+
     """
 
-    def __init__(self):
+    def __init__(self, port: str = SERIAL_PORT, protocol: str = STM_PROTOCOL):
         """
         Constructor for STMLink.
+        :param port: Serial port of the STM32.
+        :param protocol: "ascii" for 4-character commands, or "binary" for framed commands.
         """
         super().__init__()
+        if protocol not in ("ascii", "binary"):
+            raise ValueError(f"Unknown STM32 protocol: {protocol}")
+        self.port = port
+        self.protocol = protocol
         self.serial_link = None
+        # Sequence number of the next frame in binary protocol, for the messages sent without one
+        self._seq = 0
+        self._decoder = FrameDecoder()
+        self._frames = deque()
+        self._buffer = bytearray()
+        # When the last bytes were added to the buffer
+        self._last_read = 0.0
+        # Messages read by the background reader, if it was started
+        self._messages: Optional[queue.Queue] = None
 
     def connect(self):
         """Connect to STM32 using serial UART connection, given the serial port and the baud rate"""
-        self.serial_link = serial.Serial(SERIAL_PORT, BAUD_RATE)
+        self.serial_link = serial.Serial(self.port, BAUD_RATE, timeout=STM_READ_TIMEOUT)
         self.logger.info("Connected to STM32")
 
     def disconnect(self):
@@ -50,21 +95,133 @@ class STMLink(Link):
         self.serial_link = None
         self.logger.info("Disconnected from STM32")
 
-    def send(self, message: str) -> None:
+    def send(self, message: str, seq: Optional[int] = None) -> None:
         """Send a message to STM32, utf-8 encoded 
 
         Args:
             message (str): message to send
+            seq (Optional[int]): sequence number of the frame in binary protocol, by default the next one of the
+                link. Ignored in ASCII protocol
         """
-        self.serial_link.write(f"{message}".encode("utf-8"))
+        with metrics.timer("serial_write"):
+            self.serial_link.write(self._encode(message, seq))
         self.logger.debug(f"Sent to STM32: {message}")
 
-    def recv(self) -> Optional[str]:
+    def accepts(self, message: str) -> bool:
+        """Checks whether a message can be sent in the protocol of the link
+
+        Args:
+            message (str): message to send
+
+        Returns:
+            bool: True in ASCII protocol, or if the message has an opcode in binary protocol
+        """
+        return self.protocol == "ascii" or can_encode(message)
+
+    def send_batch(self, messages: List[str]) -> None:
+        """Send several messages to STM32 in a single write
+
+        Args:
+            messages (List[str]): messages to send, in order
+        """
+        with metrics.timer("serial_write"):
+            self.serial_link.write(b"".join(self._encode(message) for message in messages))
+        self.logger.debug(f"Sent to STM32: {' '.join(messages)}")
+
+    def _encode(self, message: str, seq: Optional[int] = None) -> bytes:
+        """Encodes a message in the protocol of the link, with the next sequence number of the link if none is
+        given"""
+        if self.protocol == "ascii":
+            return message.encode("utf-8")
+        if seq is None:
+            seq = self._seq
+            self._seq = (self._seq + 1) % 256
+        return encode(message, seq)
+
+    def recv(self, timeout: Optional[float] = None) -> Optional[STMMessage]:
         """Receive a message from STM32, utf-8 decoded
 
+        Args:
+            timeout (Optional[float]): maximum time to wait for a message in seconds, None to wait forever
+
         Returns:
-            Optional[str]: message received
+            Optional[STMMessage]: message received, or None if no message arrived in time
         """
-        message = self.serial_link.readline().strip().decode("utf-8")
-        self.logger.debug(f"Received from STM32: {message}")
-        return message
+        if self._messages is not None:
+            try:
+                return self._messages.get(timeout=timeout)
+            except queue.Empty:
+                return None
+        return self._recv_serial(timeout)
+
+    def poll(self) -> List[STMMessage]:
+        """Receive the messages from STM32 whose bytes have already arrived, without waiting
+
+        Returns:
+            List[STMMessage]: messages received, possibly none
+        """
+        waiting = self.serial_link.in_waiting
+        if waiting:
+            self._feed(self.serial_link.read(waiting))
+        messages = []
+        message = self._next_message()
+        while message is not None:
+            messages.append(message)
+            message = self._next_message()
+        return messages
+
+    def start_reader(self):
+        """Starts a background thread in the current process that keeps reading messages from STM32, which recv()
+        then returns from a queue. Only the process that started the reader may call recv()"""
+        self._messages = queue.Queue()
+        threading.Thread(target=self._read_forever, daemon=True).start()
+        self.logger.debug("Started STM32 reader thread")
+
+    def _read_forever(self):
+        """[Reader Thread] Reads messages from STM32 into the queue"""
+        while True:
+            self._messages.put(self._recv_serial(None))
+
+    def _recv_serial(self, timeout: Optional[float]) -> Optional[STMMessage]:
+        """Reads from the serial link until a whole message is buffered or the timeout passes"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            message = self._next_message()
+            if message is not None:
+                return message
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            # Waits at most STM_READ_TIMEOUT for the first byte, then takes everything that has arrived
+            data = self.serial_link.read(max(1, self.serial_link.in_waiting))
+            if data:
+                self._feed(data)
+
+    def _feed(self, data: bytes):
+        """Adds bytes received from the serial link"""
+        if self.protocol == "binary":
+            self._frames.extend(self._decoder.feed(data))
+        else:
+            self._buffer += data
+            self._last_read = time.monotonic()
+
+    def _next_message(self) -> Optional[STMMessage]:
+        """Takes the next message out of the buffer, or returns None if there is no whole message yet"""
+        if self.protocol == "binary":
+            if not self._frames:
+                return None
+            frame = self._frames.popleft()
+            self.logger.debug(f"Received from STM32: {frame.command} (#{frame.seq})")
+            return STMMessage(frame.command, frame.seq)
+        while b"\n" in self._buffer:
+            line, _, rest = self._buffer.partition(b"\n")
+            self._buffer = rest
+            message = line.strip().decode("utf-8", errors="replace")
+            if message:
+                self.logger.debug(f"Received from STM32: {message}")
+                return STMMessage(message)
+        if self._buffer and time.monotonic() - self._last_read >= STM_FRAME_TIMEOUT:
+            message = self._buffer.strip().decode("utf-8", errors="replace")
+            self._buffer = bytearray()
+            self.logger.warning(f"Received from STM32 without newline: {message}")
+            return STMMessage(message) if message else None
+        return None
@@ -0,0 +1,172 @@
+import os
+import socket
+from abc import ABC, abstractmethod
+from typing import Optional, Tuple
+from logger import prepare_logger
+from settings import ANDROID_TCP_HOST, ANDROID_TCP_PORT, ANDROID_TRANSPORT, ANDROID_UNIX_PATH
+
+
+class Transport(ABC):
+    """
+    Abstract class for the server socket that the Android tablet connects to
+    - open()
+    - accept()
+    - close()
+
+    The accepted connection is a stream socket, so AndroidLink frames and sends the messages the same way whatever
+    the transport.
+    """
+
+    # Name of the transport in the logs
+    name = "socket"
+
+    def __init__(self):
+        """
+        Constructor for Transport.
+        """
+        self.logger = prepare_logger(type(self).__module__)
+        self.server_sock = None
+
+    @abstractmethod
+    def _listen(self) -> socket.socket:
+        """Creates, binds and listens on the server socket"""
+        pass
+
+    @property
+    def address(self):
+        """
+        Returns the address that the server socket listens on.
+        :return: Address of the server socket, in the format of its family.
+        """
+        return self.open().getsockname()
+
+    def open(self) -> socket.socket:
+        """
+        Starts listening for the tablet, if not listening already.
+        :return: The server socket.
+        """
+        if self.server_sock is None:
+            self.server_sock = self._listen()
+        return self.server_sock
+
+    def accept(self) -> Tuple[socket.socket, object]:
+        """
+        Waits for the tablet to connect.
+        :return: Socket connected to the tablet, and its address.
+        """
+        server_sock = self.open()
+        self.logger.info(f"Awaiting {self.name} connection on {server_sock.getsockname()}")
+        return server_sock.accept()
+
+    def close(self):
+        """Stops listening"""
+        if self.server_sock is None:
+            return
+        try:
+            self.server_sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            # Listening sockets are not connected on every platform
+            pass
+        self.server_sock.close()
+        self.server_sock = None
+
+
+class RFCOMMTransport(Transport):
+    """
+    Bluetooth RFCOMM, advertised as a serial port service for the Android app.
+    """
+
+    name = "Bluetooth"
+    uuid = '94f39d29-7d6d-437d-973b-fba39e49d4ee'
+
+    def _listen(self) -> socket.socket:
+        # Imported here, so that the other transports work without PyBluez
+        import bluetooth
+
+        # Set RPi to be discoverable in order for service to be advertisable
+        os.system("sudo hciconfig hci0 piscan")
+
+        # Initialize server socket
+        server_sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+        server_sock.bind(("", bluetooth.PORT_ANY))
+        server_sock.listen(1)
+
+        # Advertise
+        bluetooth.advertise_service(server_sock, "MDP-Group21-RPi", service_id=self.uuid, service_classes=[
+                                    self.uuid, bluetooth.SERIAL_PORT_CLASS], profiles=[bluetooth.SERIAL_PORT_PROFILE])
+        self.logger.info(f"Advertising on RFCOMM CHANNEL {server_sock.getsockname()[1]}")
+        return server_sock
+
+
+class TCPTransport(Transport):
+    """
+    TCP socket, e.g. for a tablet on the RPi's Wi-Fi or a simulated one on localhost.
+    """
+
+    name = "TCP"
+
+    def __init__(self, host: str = ANDROID_TCP_HOST, port: int = ANDROID_TCP_PORT):
+        """
+        Constructor for TCPTransport.
+        :param host: Address to listen on.
+        :param port: Port to listen on, 0 for any free port, which is then kept across reconnections.
+        """
+        super().__init__()
+        self.host = host
+        self.port = port
+
+    def _listen(self) -> socket.socket:
+        server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_sock.bind((self.host, self.port))
+        server_sock.listen(1)
+        self.port = server_sock.getsockname()[1]
+        return server_sock
+
+
+class UnixTransport(Transport):
+    """
+    Unix domain socket, for a simulated tablet on the same machine.
+    """
+
+    name = "Unix socket"
+
+    def __init__(self, path: str = ANDROID_UNIX_PATH):
+        """
+        Constructor for UnixTransport.
+        :param path: Path of the socket file.
+        """
+        super().__init__()
+        self.path = path
+
+    def _listen(self) -> socket.socket:
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server_sock.bind(self.path)
+        server_sock.listen(1)
+        return server_sock
+
+    def close(self):
+        super().close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def create_transport(name: Optional[str] = None) -> Transport:
+    """Creates the transport that the Android tablet connects over
+
+    Args:
+        name (Optional[str]): "rfcomm", "tcp" or "unix", defaults to ANDROID_TRANSPORT
+
+    Returns:
+        Transport: the transport, not listening yet
+    """
+    name = ANDROID_TRANSPORT if name is None else name
+    if name == "rfcomm":
+        return RFCOMMTransport()
+    if name == "tcp":
+        return TCPTransport()
+    if name == "unix":
+        return UnixTransport()
+    raise ValueError(f"Unknown Android transport: {name}")
@@ -0,0 +1,70 @@
+import re
+from typing import List, NamedTuple, Optional
+from logger import prepare_logger
+
+# Straight moves that can be merged, e.g. `FW10` or `BW20`
+STRAIGHT_MOVE = re.compile(r"^(FW|BW)(\d\d)$")
+# Largest distance a merged move may have, which keeps clear of the special FW98/FW99 commands
+MAX_STRAIGHT_DISTANCE = 90
+
+
+class CompactedPath(NamedTuple):
+    """Commands and path after compaction"""
+    commands: List[str]
+    path: List[dict]
+    saved: int
+
+
+def _straight_move(command: str) -> Optional[tuple]:
+    """Returns the direction and distance of a straight move, or None for any other command"""
+    match = STRAIGHT_MOVE.match(command)
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2))
+
+
+def compact_path(commands: List[str], path: List[dict]) -> CompactedPath:
+    """Merges runs of straight moves in the same direction into a single move, and drops straight moves of 0,
+    so that STM32 has to acknowledge fewer commands
+
+    The path has one position per movement command, after the starting position, and is rebuilt to match the
+    compacted commands: a merged move ends at the position of the last move in its run, and a dropped move has
+    no position. If the path does not match the commands, they are returned unchanged.
+
+    Args:
+        commands (List[str]): commands from the algo, e.g. `["FW10", "FW20", "SNAP1_C", "FIN"]`
+        path (List[dict]): starting position of the robot, followed by its position after every movement command
+
+    Returns:
+        CompactedPath: compacted commands and path, and the number of commands saved
+    """
+    moves = [command for command in commands if not command.startswith("SNAP") and command != "FIN"]
+    if len(moves) != len(path) - 1:
+        prepare_logger().warning(
+            f"Path has {len(path) - 1} positions for {len(moves)} movement commands, commands not compacted")
+        return CompactedPath(list(commands), list(path), 0)
+
+    compacted_commands, compacted_path = [], [path[0]]
+    positions = iter(path[1:])
+    for command in commands:
+        if command.startswith("SNAP") or command == "FIN":
+            compacted_commands.append(command)
+            continue
+
+        position = next(positions)
+        move = _straight_move(command)
+        if move is not None and move[1] == 0:
+            # No-op, the robot does not move
+            continue
+
+        previous = _straight_move(compacted_commands[-1]) if compacted_commands else None
+        if (move is not None and previous is not None and previous[0] == move[0]
+                and previous[1] + move[1] <= MAX_STRAIGHT_DISTANCE):
+            compacted_commands[-1] = f"{move[0]}{previous[1] + move[1]:02d}"
+            compacted_path[-1] = position
+            continue
+
+        compacted_commands.append(command)
+        compacted_path.append(position)
+
+    return CompactedPath(compacted_commands, compacted_path, len(commands) - len(compacted_commands))
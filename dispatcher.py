@@ -0,0 +1,249 @@
+import time
+from multiprocessing import Array, Condition, Lock, Value
+from typing import List, NamedTuple, Optional
+from communication.stm32 import STMLink
+from logger import prepare_logger
+from metrics import metrics
+from settings import STM_ACK_RETRIES, STM_ACK_TIMEOUT, STM_SEND_WINDOW
+
+# Number of recent commands whose text and send time are kept, must be larger than STM_SEND_WINDOW
+COMMAND_HISTORY = 16
+# Maximum length of a command in bytes
+COMMAND_SIZE = 8
+
+
+class Ack(NamedTuple):
+    """Acknowledgement of a command by STM32"""
+    seq: int
+    command: str
+    latency: float
+
+
+class CommandDispatcher:
+    """
+    Sends commands to STM32 and tracks them until they are acknowledged, across processes.
+
+    Every command sent gets the next sequence number, and STM32 acknowledges commands in the order they were sent,
+    so the n-th ACK belongs to command n. Up to `window` commands can be in flight, so that the next command is
+    already waiting on the STM32 when it finishes the current one. A process waiting to send is woken as soon as
+    the ACK that frees the window is parsed, instead of going through a lock that the receiving process releases.
+
+    In binary protocol, the sequence number is also sent with the command and returned with its ACK, so that an ACK
+    is matched to its command, and a resent command is not carried out twice.
+
+    The dispatcher can also be held, e.g. while an image is captured, so that no command is sent until it is
+    released.
+
+    A command whose ACK is overdue is resent, or given up on, by expire(), which the receiving process calls
+    regularly, so that a lost command or ACK does not stall the robot. Commands are only resent in binary protocol,
+    where STM32 recognises a resent command by its sequence number. In ASCII protocol, a command resent after only
+    its ACK was lost would be carried out twice, so an overdue command is given up on straight away.
+    """
+
+    def __init__(self, link: STMLink, window: int = STM_SEND_WINDOW, ack_timeout: Optional[float] = STM_ACK_TIMEOUT,
+                 ack_retries: Optional[int] = None):
+        """
+        Constructor for CommandDispatcher.
+        :param link: Link to STM32 that the commands are sent over.
+        :param window: Maximum number of commands sent but not acknowledged yet.
+        :param ack_timeout: Seconds to wait for the ACK of a command before resending it, None to wait forever.
+        :param ack_retries: Maximum number of times a command is resent before it is given up on, by default
+            STM_ACK_RETRIES in binary protocol and 0 in ASCII protocol.
+        """
+        if not 0 < window < COMMAND_HISTORY:
+            raise ValueError(f"Send window must be between 1 and {COMMAND_HISTORY - 1}, got {window}")
+        self.logger = prepare_logger()
+        self.link = link
+        self.window = window
+        self.ack_timeout = ack_timeout
+        if ack_retries is None:
+            ack_retries = STM_ACK_RETRIES if link.protocol == "binary" else 0
+        self.ack_retries = ack_retries
+        self._changed = Condition(Lock())
+        # Sequence numbers of the last command sent and the last command acknowledged, starting from 1
+        self._sent = Value('l', 0, lock=False)
+        self._acked = Value('l', 0, lock=False)
+        self._held = Value('b', False, lock=False)
+        self._sent_at = Array('d', COMMAND_HISTORY, lock=False)
+        self._resends = Array('i', COMMAND_HISTORY, lock=False)
+        self._commands = Array('c', COMMAND_HISTORY * COMMAND_SIZE, lock=False)
+
+    @property
+    def in_flight(self) -> int:
+        """
+        Returns the number of commands sent but not acknowledged yet.
+        :return: Number of commands in flight.
+        """
+        return self._sent.value - self._acked.value
+
+    @property
+    def held(self) -> bool:
+        """
+        Returns whether the dispatcher is held, e.g. while an image is captured.
+        :return: True if no command can be sent until release() is called.
+        """
+        return bool(self._held.value)
+
+    def send(self, command: str, timeout: Optional[float] = None) -> int:
+        """Sends a command to STM32 as soon as the window has room for it and the dispatcher is not held
+
+        Args:
+            command (str): command to send
+            timeout (Optional[float]): maximum time to wait for room in seconds, None to wait forever
+
+        Returns:
+            int: sequence number of the command
+
+        Raises:
+            TimeoutError: if there was no room in time
+            ValueError: if the command cannot be encoded in the protocol of the link
+            OSError: if the command could not be written to STM32
+        """
+        with self._changed:
+            with metrics.timer("lock_wait"):
+                sendable = self._changed.wait_for(self.can_send, timeout)
+            if not sendable:
+                raise TimeoutError(f"Timed out waiting to send {command}, {self.in_flight} command(s) in flight")
+            return self._send(command)
+
+    def ack(self, seq: Optional[int] = None) -> List[Ack]:
+        """Marks the command that an ACK belongs to as acknowledged, and wakes up the processes waiting to send
+
+        Without a sequence number, as in ASCII protocol, the ACK belongs to the oldest command in flight. With the
+        sequence number of a binary ACK frame, an ACK for a command that is already acknowledged, e.g. again for a
+        resent command, is ignored, and an ACK for a later command also acknowledges the commands before it, whose
+        ACKs were lost, since STM32 carries out the commands in order.
+
+        Args:
+            seq (Optional[int]): sequence number of the ACK frame, modulo 256
+
+        Returns:
+            List[Ack]: the acknowledged commands, oldest first, or none if the ACK belongs to no command in flight
+        """
+        with self._changed:
+            if seq is not None and (self._acked.value - seq) % 256 < COMMAND_HISTORY:
+                self.logger.debug(f"Ignored duplicate ACK #{seq} from STM32")
+                return []
+            count = 1 if seq is None else (seq - self._acked.value - 1) % 256 + 1
+            if count > self.in_flight:
+                self.logger.warning(f"Ignored ACK{'' if seq is None else f' #{seq}'} from STM32 with no command "
+                                    f"in flight for it")
+                return []
+            acks = [self._acknowledge() for _ in range(count)]
+        for ack in acks[:-1]:
+            self.logger.warning(f"ACK for {ack.command} (#{ack.seq}) was lost, acknowledged by a later ACK")
+        for ack in acks:
+            metrics.record("ack_wait", ack.latency)
+            self.logger.debug(f"ACK for {ack.command} (#{ack.seq}) received after {ack.latency * 1000:.1f} ms")
+        return acks
+
+    def expire(self) -> Optional[Ack]:
+        """Resends the oldest command in flight if its ACK is overdue, or gives up on it and marks it as
+        acknowledged once it was resent `ack_retries` times
+
+        A command is only resent when it is the only one in flight, since STM32 would otherwise receive it after
+        the commands sent behind it.
+
+        Returns:
+            Optional[Ack]: the command given up on, or None if no command was given up on
+        """
+        if self.ack_timeout is None:
+            return None
+        with self._changed:
+            if self.in_flight == 0:
+                return None
+            seq = self._acked.value + 1
+            slot = seq % COMMAND_HISTORY
+            resends = self._resends[slot]
+            if time.monotonic() - self._sent_at[slot] < self.ack_timeout * (resends + 1):
+                return None
+            command = self._command(seq)
+            if resends < self.ack_retries and self.in_flight == 1:
+                self._resends[slot] = resends + 1
+                # With the same sequence number, so that STM32 does not carry it out again if only the ACK was lost
+                self.link.send(command, seq)
+                self.logger.warning(f"No ACK for {command} (#{seq}), resent it ({resends + 1}/{self.ack_retries})")
+                return None
+            ack = self._acknowledge()
+        self.logger.error(f"No ACK for {ack.command} (#{ack.seq}) after {ack.latency:.1f} s, carrying on without it")
+        return ack
+
+    def hold(self, timeout: Optional[float] = None):
+        """Waits until every command in flight is acknowledged, then stops commands from being sent until
+        release() is called
+
+        Args:
+            timeout (Optional[float]): maximum time to wait in seconds, None to wait forever
+
+        Raises:
+            TimeoutError: if the commands were not acknowledged in time
+        """
+        with self._changed:
+            with metrics.timer("lock_wait"):
+                holdable = self._changed.wait_for(self.can_hold, timeout)
+            if not holdable:
+                raise TimeoutError(f"Timed out waiting to hold, {self.in_flight} command(s) in flight")
+            self._held.value = True
+
+    def release(self):
+        """Lets commands be sent again after hold()"""
+        with self._changed:
+            if not self._held.value:
+                self.logger.warning("Tried to release a dispatcher that is not held")
+                return
+            self._held.value = False
+            self._notify()
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        """Waits until every command in flight is acknowledged
+
+        Args:
+            timeout (Optional[float]): maximum time to wait in seconds, None to wait forever
+
+        Returns:
+            bool: True if no command is in flight, False on timeout
+        """
+        with self._changed, metrics.timer("lock_wait"):
+            return self._changed.wait_for(self.is_idle, timeout)
+
+    def can_send(self) -> bool:
+        """Checks whether send() would send a command without waiting"""
+        return not self._held.value and self.in_flight < self.window
+
+    def can_hold(self) -> bool:
+        """Checks whether hold() would hold the dispatcher without waiting"""
+        return not self._held.value and self.in_flight == 0
+
+    def is_idle(self) -> bool:
+        """Checks whether every command sent was acknowledged"""
+        return self.in_flight == 0
+
+    def _send(self, command: str) -> int:
+        """Records a command and writes it to STM32. The condition must be held, so that commands are written in
+        the order of their sequence numbers. The command only counts as sent once it is written, so that a command
+        that could not be encoded or written does not take up the window waiting for an ACK"""
+        seq = self._sent.value + 1
+        slot = seq % COMMAND_HISTORY
+        text = command.encode("utf-8")[:COMMAND_SIZE].ljust(COMMAND_SIZE, b"\0")
+        self._commands[slot * COMMAND_SIZE:(slot + 1) * COMMAND_SIZE] = text
+        self._resends[slot] = 0
+        self._sent_at[slot] = time.monotonic()
+        self.link.send(command, seq)
+        self._sent.value = seq
+        return seq
+
+    def _acknowledge(self) -> Ack:
+        """Marks the oldest command in flight as acknowledged. The condition must be held"""
+        seq = self._acked.value + 1
+        self._acked.value = seq
+        self._notify()
+        return Ack(seq, self._command(seq), time.monotonic() - self._sent_at[seq % COMMAND_HISTORY])
+
+    def _command(self, seq: int) -> str:
+        """Returns the text of a command that is still in the history"""
+        slot = seq % COMMAND_HISTORY
+        return self._commands[slot * COMMAND_SIZE:(slot + 1) * COMMAND_SIZE].rstrip(b"\0").decode("utf-8")
+
+    def _notify(self):
+        """Wakes up everyone waiting on the dispatcher. The condition must be held"""
+        self._changed.notify_all()
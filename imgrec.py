@@ -0,0 +1,159 @@
+import json
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import List, Optional, Tuple
+import requests
+from camera import CameraService
+from communication.api import APIClient
+from logger import prepare_logger
+from settings import SNAP_ATTEMPTS, SNAP_BRACKETS, SNAP_WORKERS
+
+
+class ImageRecognizer:
+    """
+    Class that captures images of an obstacle and sends them to the image recognition API.
+    """
+
+    def __init__(self, camera: CameraService, api: APIClient):
+        """
+        Constructor for ImageRecognizer.
+        :param camera: Camera service used to capture the images.
+        :param api: Client for the image recognition API.
+        """
+        self.logger = prepare_logger()
+        self.camera = camera
+        self.api = api
+        # Only one attempt may use the camera at a time in concurrent mode
+        self._capture_lock = threading.Lock()
+
+    def recognize(self, filename: str, image_data: memoryview) -> Optional[dict]:
+        """Sends a single image to the image recognition API
+
+        Args:
+            filename (str): filename of the image, in the format `<time>_<obstacle_id>_<signal>[_<suffix>].jpg`
+            image_data (memoryview): JPEG image
+
+        Returns:
+            Optional[dict]: recognition results, or None if the request failed
+        """
+        try:
+            response = self.api.post_file("/image", filename, image_data)
+        except requests.RequestException as e:
+            self.logger.error(f"Error requesting from image-rec API: {e}")
+            return None
+        if response.status_code != 200:
+            self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
+            return None
+        return json.loads(response.content)
+
+    def recognize_first(self, images: List[Tuple[str, memoryview]]) -> Optional[dict]:
+        """Sends all images to the image recognition API at the same time, and returns the first result that is
+        not `NA`. Images that have not been sent yet are cancelled, and responses that are still in flight are
+        discarded.
+
+        Args:
+            images (List[Tuple[str, memoryview]]): filename and JPEG image of each image
+
+        Returns:
+            Optional[dict]: first non-`NA` result, an `NA` result if no image was recognized,
+            or None if every request failed
+        """
+        executor = ThreadPoolExecutor(max_workers=len(images))
+        try:
+            futures = [executor.submit(self.recognize, filename, image_data)
+                       for filename, image_data in images]
+            return self._first_recognized(futures)
+        finally:
+            # cancel_futures requires Python 3.9+
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def snap_bracket(self, obstacle_id: str, signal: str) -> Optional[dict]:
+        """Captures the default, bright and dark variants of the obstacle back-to-back, and recognizes them in
+        parallel, so that the worst case costs a single round-trip to the API
+
+        Args:
+            obstacle_id (str): ID of the obstacle
+            signal (str): position of the obstacle relative to the robot (L, C or R)
+
+        Returns:
+            Optional[dict]: first non-`NA` result, an `NA` result if no image was recognized,
+            or None if every request failed
+        """
+        images = self.capture_bracket(obstacle_id, signal)
+        self.logger.info("Images captured. Calling image-rec api...")
+        return self.recognize_first(images)
+
+    def capture_bracket(self, obstacle_id: str, signal: str) -> List[Tuple[str, memoryview]]:
+        """Captures the SNAP_BRACKETS variants of the obstacle back-to-back, without sending them
+
+        Args:
+            obstacle_id (str): ID of the obstacle
+            signal (str): position of the obstacle relative to the robot (L, C or R)
+
+        Returns:
+            List[Tuple[str, memoryview]]: filename and JPEG image of each variant
+        """
+        self.logger.info("Capturing bracketed images...")
+        frames = self.camera.capture_bracket([settings for _, settings in SNAP_BRACKETS], signal=signal)
+        timestamp = int(time.time())
+        return [(f"{timestamp}_{obstacle_id}_{signal}_{name}.jpg", frame)
+                for (name, _), frame in zip(SNAP_BRACKETS, frames)]
+
+    def snap_concurrent(self, obstacle_id: str, signal: str) -> Optional[dict]:
+        """Captures the SNAP_ATTEMPTS one after another with a bounded pool of workers, so that the camera is
+        only used by one attempt at a time while earlier attempts are being uploaded. Returns as soon as one
+        attempt is recognized, and cancels the attempts that have not captured yet.
+
+        Args:
+            obstacle_id (str): ID of the obstacle
+            signal (str): position of the obstacle relative to the robot (L, C or R)
+
+        Returns:
+            Optional[dict]: first non-`NA` result, an `NA` result if no image was recognized,
+            or None if every request failed
+        """
+        done = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=SNAP_WORKERS)
+        try:
+            futures = [executor.submit(self._snap_attempt, obstacle_id, signal, f"{name}{attempt}", settings, done)
+                       for attempt, (name, settings) in enumerate(SNAP_ATTEMPTS, start=1)]
+            return self._first_recognized(futures)
+        finally:
+            done.set()
+            # cancel_futures requires Python 3.9+
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _snap_attempt(self, obstacle_id: str, signal: str, name: str, settings: dict,
+                      done: threading.Event) -> Optional[dict]:
+        """
+        [Worker Thread] Captures a single image once the camera is free, and sends it for recognition
+        """
+        with self._capture_lock:
+            if done.is_set():
+                return None
+            self.logger.debug(f"Capturing attempt {name} with settings {settings}")
+            image_data = self.camera.capture(**settings, signal=signal)
+        if done.is_set():
+            return None
+        filename = f"{int(time.time())}_{obstacle_id}_{signal}_{name}.jpg"
+        return self.recognize(filename, image_data)
+
+    def _first_recognized(self, futures: List[Future]) -> Optional[dict]:
+        """Waits for the futures as they complete, and returns the first result that is not `NA`. Futures that
+        raised are logged and skipped."""
+        results = None
+        for future in as_completed(futures):
+            try:
+                task_results = future.result()
+            except Exception as e:
+                # A failed capture must not discard the attempts that are still in flight
+                self.logger.error(f"Image recognition attempt failed: {e}")
+                continue
+            if task_results is None:
+                continue
+            results = task_results
+            self.logger.info(f"Image recognition results: {results}")
+            if results['image_id'] != 'NA':
+                break
+        return results
@@ -6,13 +6,15 @@ import picamera
 import queue
 import time
 from multiprocessing import Process, Manager
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Optional
 import os
 import requests
+from camera import CameraService
 from communication.android import AndroidLink, AndroidMessage
+from communication.api import APIClient
 from communication.stm32 import STMLink
 from consts import SYMBOL_MAP
+from imgrec import ImageRecognizer
 from logger import prepare_logger
 from settings import API_IP, API_PORT
 
@@ -51,6 +53,9 @@ class RaspberryPi:
         self.logger = prepare_logger()
         self.android_link = AndroidLink()
         self.stm_link = STMLink()
+        self.api = APIClient()
+        self.camera = CameraService()
+        self.image_recognizer = ImageRecognizer(self.camera, self.api)
 
         self.manager = Manager()
 
@@ -58,7 +63,6 @@ class RaspberryPi:
         self.unpause = self.manager.Event()
 
         self.movement_lock = self.manager.Lock()
-        self.camera_lock = self.manager.Lock()
 
         self.android_queue = self.manager.Queue()  # Messages to send to Android
         # Messages that need to be processed by RPi
@@ -89,6 +93,7 @@ class RaspberryPi:
             #self.android_queue.put(AndroidMessage(
                 #'info', 'You are connected to the RPi!'))
             #self.stm_link.connect()
+            self.camera.start()
             self.check_api()
 
             # Define child processes
@@ -122,6 +127,7 @@ class RaspberryPi:
         """Stops all processes on the RPi and disconnects gracefully with Android and STM32"""
         self.android_link.disconnect()
         self.stm_link.disconnect()
+        self.camera.stop()
         self.logger.info("Program exited!")
 
     def reconnect_android(self):
@@ -387,136 +393,121 @@ class RaspberryPi:
         stream1: bytes = None
         stream2: bytes = None
         stream3: bytes = None
+        # Settings carried over between retries
+        camera_settings = {}
 
-        with picamera.PiCamera() as camera:
-            camera.start_preview()
-            camera.vflip = True  # Vertical flip
-            camera.hflip = True  # Horizontal flip
-            # camera.iso = 100
-            # camera.shutter_speed = 200000
-            # camera.brightness = 40
-            # camera.contrast = 90
-            # camera.framerate = 70
-            time.sleep(1)
-
-            while True:
-                image_capture_count += 1
-                print(f"Image Capture Count: {image_capture_count}")
-                self.logger.debug("Requesting from image API")
-
-                # notify android
-                # self.android_queue.put(AndroidMessage("info", "Image captured. Calling image-rec api..."))
-                self.logger.info("Image captured. Calling image-rec api...")
-
-                # Reset the stream before capturing a new image
-                url = f"http://{API_IP}:{API_PORT}/image"
-                if image_capture_count == 3:
-                    response = requests.post(url+"2", files={"file": (filename, stream1)})
-                    if response.status_code != 200:
-                        self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
-                        #self.android_queue.put(AndroidMessage(
-                            # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
-                        return
-                    results = json.loads(response.content)
-                    if results['image_id'] != 'NA':
-                        break
-
-                elif image_capture_count == 4:
-                    response = requests.post(url+"2", files={"file": (filename, stream2)})
-                    if response.status_code != 200:
-                        self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
-                        #self.android_queue.put(AndroidMessage(
-                            # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
-                        return
-                    results = json.loads(response.content)
-                    if results['image_id'] != 'NA':
-                        break
-                
-                elif image_capture_count == 5:
-                    response = requests.post(url+"2", files={"file": (filename, stream3)})
-                    if response.status_code != 200:
-                        self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
-                        #self.android_queue.put(AndroidMessage(
-                            # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
-                        return
-                    results = json.loads(response.content)
-                    if results['image_id'] != 'NA':
-                        break
-
-                elif image_capture_count == 6:
-                    response = requests.post(url+"3", files={"file": (filename, stream1)})
-                    if response.status_code != 200:
-                        self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
-                        #self.android_queue.put(AndroidMessage(
-                            # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
-                        return
-                    results = json.loads(response.content)
-                    if results['image_id'] != 'NA':
-                        break
-                
-                elif image_capture_count == 7:
-                    response = requests.post(url+"3", files={"file": (filename, stream2)})
-                    if response.status_code != 200:
-                        self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
-                        #self.android_queue.put(AndroidMessage(
-                            # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
-                        return
-                    results = json.loads(response.content)
-                    if results['image_id'] != 'NA':
-                        break
-                
-                elif image_capture_count == 8:
-                    response = requests.post(url+"3", files={"file": (filename, stream3)})
-                    if response.status_code != 200:
-                        self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
-                        #self.android_queue.put(AndroidMessage(
-                            # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
-                        return
-                    results = json.loads(response.content)
-                    if results['image_id'] != 'NA':
-                        break
+        while True:
+            image_capture_count += 1
+            print(f"Image Capture Count: {image_capture_count}")
+            self.logger.debug("Requesting from image API")
 
+            # notify android
+            # self.android_queue.put(AndroidMessage("info", "Image captured. Calling image-rec api..."))
+            self.logger.info("Image captured. Calling image-rec api...")
 
-                # call image-rec API endpoint
-                stream = io.BytesIO()
-                camera.capture(stream,format='jpeg')
-                image_data = stream.getvalue()
-                if image_capture_count == 0:
-                    stream1 = image_data
-                elif image_capture_count == 1:
-                    stream2 = image_data
-                elif image_capture_count == 2:
-                    stream3 = image_data
-                filename = f"{int(time.time())}_{obstacle_id}_{signal}.jpg"
+            # Reset the stream before capturing a new image
+            if image_capture_count == 3:
+                response = self.api.post_file("/image2", filename, stream1)
+                if response.status_code != 200:
+                    self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
+                    #self.android_queue.put(AndroidMessage(
+                        # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
+                    return
+                results = json.loads(response.content)
+                if results['image_id'] != 'NA':
+                    break
 
-                response = requests.post(url, files={"file": (filename, image_data)})
+            elif image_capture_count == 4:
+                response = self.api.post_file("/image2", filename, stream2)
+                if response.status_code != 200:
+                    self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
+                    #self.android_queue.put(AndroidMessage(
+                        # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
+                    return
+                results = json.loads(response.content)
+                if results['image_id'] != 'NA':
+                    break
+            
+            elif image_capture_count == 5:
+                response = self.api.post_file("/image2", filename, stream3)
                 if response.status_code != 200:
                     self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
                     #self.android_queue.put(AndroidMessage(
                         # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
                     return
-                
                 results = json.loads(response.content)
+                if results['image_id'] != 'NA':
+                    break
 
-                """
-                Retrying image capturing again using different configurations
-                """
-                if results['image_id'] != 'NA' or image_capture_count > 8:
+            elif image_capture_count == 6:
+                response = self.api.post_file("/image3", filename, stream1)
+                if response.status_code != 200:
+                    self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
+                    #self.android_queue.put(AndroidMessage(
+                        # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
+                    return
+                results = json.loads(response.content)
+                if results['image_id'] != 'NA':
                     break
-                elif image_capture_count <= 0:
-                    self.logger.info(f"Image recognition results: {results}")
-                    self.logger.info("Recapturing with same shutter speed...")
-                elif image_capture_count <= 1:
-                    self.logger.info(f"Image recognition results: {results}")
-                    self.logger.info("Recapturing with higher brightness...")
-                    camera.brightness = 60
-                    camera.contrast = 90
-                elif image_capture_count == 2:
-                    self.logger.info(f"Image recognition results: {results}")
-                    self.logger.info("Recapturing with lower brightness...")
-                    camera.brightness = 30
-                    camera.contrast = 100
-                    camera.framerate = 70
+            
+            elif image_capture_count == 7:
+                response = self.api.post_file("/image3", filename, stream2)
+                if response.status_code != 200:
+                    self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
+                    #self.android_queue.put(AndroidMessage(
+                        # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
+                    return
+                results = json.loads(response.content)
+                if results['image_id'] != 'NA':
+                    break
+            
+            elif image_capture_count == 8:
+                response = self.api.post_file("/image3", filename, stream3)
+                if response.status_code != 200:
+                    self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
+                    #self.android_queue.put(AndroidMessage(
+                        # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
+                    return
+                results = json.loads(response.content)
+                if results['image_id'] != 'NA':
+                    break
+
+
+            # call image-rec API endpoint
+            image_data = self.camera.capture(**camera_settings, signal=signal)
+            if image_capture_count == 0:
+                stream1 = image_data
+            elif image_capture_count == 1:
+                stream2 = image_data
+            elif image_capture_count == 2:
+                stream3 = image_data
+            filename = f"{int(time.time())}_{obstacle_id}_{signal}.jpg"
+
+            response = self.api.post_file("/image", filename, image_data)
+            if response.status_code != 200:
+                self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
+                #self.android_queue.put(AndroidMessage(
+                    # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
+                return
+            
+            results = json.loads(response.content)
+
+            """
+            Retrying image capturing again using different configurations
+            """
+            if results['image_id'] != 'NA' or image_capture_count > 8:
+                break
+            elif image_capture_count <= 0:
+                self.logger.info(f"Image recognition results: {results}")
+                self.logger.info("Recapturing with same shutter speed...")
+            elif image_capture_count <= 1:
+                self.logger.info(f"Image recognition results: {results}")
+                self.logger.info("Recapturing with higher brightness...")
+                camera_settings.update(brightness=60, contrast=90)
+            elif image_capture_count == 2:
+                self.logger.info(f"Image recognition results: {results}")
+                self.logger.info("Recapturing with lower brightness...")
+                camera_settings.update(brightness=30, contrast=100, framerate=70)
 
         time_taken = time.time() - start
         # Print total time taken to 1dp
@@ -608,10 +599,9 @@ class RaspberryPi:
                     imagedata_3 = stream3.getvalue()
 
                 # call image-rec API endpoint
-                url = f"http://{API_IP}:{API_PORT}/image{model_number}"
                 filename = f"{int(time.time())}_{obstacle_id}_{signal}.jpg"
 
-                response = requests.post(url, files={"file": (filename, image_data)})
+                response = self.api.post_file(f"/image{model_number}", filename, image_data)
                 if response.status_code != 200:
                     self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
                     #self.android_queue.put(AndroidMessage(
@@ -669,58 +659,6 @@ class RaspberryPi:
                 f"self.success_obstacles: {self.success_obstacles}")
         # self.android_queue.put(AndroidMessage("image-rec", results))
 
-    def snap_one_time(self, camera, brightness, contrast, framerate, obstacle_id, signal) -> None:
-        self.logger.debug(f"Requesting from image API with brightness {brightness}, contrast {contrast}, framerate {framerate}")
-        if brightness:
-            camera.brightness = brightness
-        if contrast:
-            camera.contrast = contrast
-        if framerate:
-            camera.framerate = framerate
-
-        # notify android
-        # self.android_queue.put(AndroidMessage("info", "Image captured. Calling image-rec api..."))
-        self.logger.info("Image captured. Calling image-rec api...")
-
-        # Reset the stream before capturing a new image
-        stream = io.BytesIO()
-
-        # call image-rec API endpoint
-        url = f"http://{API_IP}:{API_PORT}/image"
-        self.camera_lock.acquire()
-        camera.capture(stream,format='jpeg')
-        self.camera_lock.release()
-        image_data = stream.getvalue()
-        filename = f"{int(time.time())}_{obstacle_id}_{signal}.jpg"
-
-        response = requests.post(url, files={"file": (filename, image_data)})
-        if response.status_code != 200:
-            self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
-            #self.android_queue.put(AndroidMessage(
-                # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
-            return
-        
-        results = json.loads(response.content)
-         
-        return results    
-
-    def snap_many_times(self, camera, obstacle_id, signal) -> None:
-        retries = [(None, None, None), 
-             (None, None, None), 
-             (None, None, None), 
-             (60, 90, None),
-             (60, 90, None),
-             (30, 100, 70),
-             (30, 100, 70),
-            ]
-        with ThreadPoolExecutor() as executor:
-                futures = {executor.submit(self.snap_one_time, camera, t[0], t[1], t[2], obstacle_id, signal) for t in retries}
-                for future in as_completed(futures):
-                    task_res = future.result()
-                    if task_res['image_id'] != "NA":
-                        return task_res
-                return None
-
     def snap_and_rec_new(self, obstacle_id_with_signal: str) -> None:
         """
         RPi snaps an image and calls the API for image-rec.
@@ -735,22 +673,15 @@ class RaspberryPi:
 
         #capture an image
         start= time.time()
-        with picamera.PiCamera() as camera:
-            camera.start_preview()
-            camera.vflip = True  # Vertical flip
-            camera.hflip = True  # Horizontal flip
-            # camera.iso = 100
-            # camera.shutter_speed = 200000
-            # camera.brightness = 40
-            # camera.contrast = 90
-            # camera.framerate = 70
-            time.sleep(1)
-            results = self.snap_many_times(camera, obstacle_id, signal)
-    
+        results = self.image_recognizer.snap_concurrent(obstacle_id, signal)
+
         time_taken = time.time() - start
         # Print total time taken to 1dp
         print(f"Total time taken: {round(time_taken,1)}")
-        
+        if results is None:
+            self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
+            return
+
         # release lock so that bot can continue moving
         # self.movement_lock.release()
         # try:
@@ -787,8 +718,7 @@ class RaspberryPi:
         self.logger.info(f"data: {data}")
         body = {**data, "big_turn": "0", "robot_x": robot_x,
                 "robot_y": robot_y, "robot_dir": robot_dir, "retrying": retrying}
-        url = f"http://{API_IP}:{API_PORT}/compute"
-        response = requests.post(url, json=body)
+        response = self.api.post("/compute", json=body)
 
         # Error encountered at the server, return early
         if response.status_code != 200:
@@ -820,8 +750,7 @@ class RaspberryPi:
 
     def request_stitch(self):
         """Sends a stitch request to the image recognition API to stitch the different images together"""
-        url = f"http://{API_IP}:{API_PORT}/stitch"
-        response = requests.get(url)
+        response = self.api.get("/stitch")
 
         # If error, then log, and send error to Android
         if response.status_code != 200:
@@ -850,10 +779,9 @@ class RaspberryPi:
         """
         print("hello")
         # Check image recognition API
-        url = f"http://{API_IP}:{API_PORT}/"
         try:
             print('hi')
-            response = requests.get(url, timeout=1)
+            response = self.api.get("/", timeout=1)
             if response.status_code == 200:
                 self.logger.debug("API is up!")
                 # stream = io.BytesIO()
@@ -0,0 +1,272 @@
+import multiprocessing as mp
+import pickle
+import time
+from multiprocessing import queues, shared_memory
+from queue import Empty
+from typing import Any, Iterator, List
+from settings import IPC_BACKEND, IPC_SHARED_SIZE
+
+
+class Queue(queues.Queue):
+    """
+    `multiprocessing.Queue` whose consumers only hold the read lock while a message is actually being received.
+
+    The standard queue holds its read lock for the whole `get()`, including the wait for a message. Some queues have
+    more than one consumer, e.g. command_queue is drained by clear_queues() in rpi_action when a new path arrives,
+    while command_follower waits on it, so the drain would queue up behind the waiting consumer. A consumer that is
+    terminated while waiting, e.g. by the simulation harness, also cannot leave the lock held for the others.
+    """
+
+    def __init__(self, maxsize: int = 0):
+        """
+        Constructor for Queue.
+        :param maxsize: Maximum number of messages in the queue, 0 for unlimited.
+        """
+        super().__init__(maxsize, ctx=mp.get_context())
+
+    def get(self, block: bool = True, timeout: float = None) -> Any:
+        """Removes and returns a message from the queue
+
+        Args:
+            block (bool): whether to wait for a message if the queue is empty
+            timeout (float): maximum time to wait in seconds, None to wait forever
+
+        Returns:
+            Any: the message
+
+        Raises:
+            queue.Empty: if no message arrived in time
+        """
+        if self._closed:
+            raise ValueError(f"Queue {self!r} is closed")
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if block:
+                remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+                if not self._reader.poll(remaining):
+                    raise Empty
+            with self._rlock:
+                # Another consumer may have taken the message while this one was waiting for the lock
+                if self._reader.poll():
+                    data = self._recv_bytes()
+                    self._sem.release()
+                    return pickle.loads(data)
+            if not block or (deadline is not None and time.monotonic() >= deadline):
+                raise Empty
+
+
+class _SharedObject:
+    """
+    Python object shared between processes, kept pickled in shared memory and guarded by a lock.
+    Every access unpickles the object, so values read from it are copies, as with Manager proxies.
+    """
+
+    def __init__(self, initial: Any, size: int = IPC_SHARED_SIZE):
+        """
+        Constructor for _SharedObject.
+        :param initial: Initial value of the object.
+        :param size: Maximum size of the pickled object in bytes.
+        """
+        self._shm = shared_memory.SharedMemory(create=True, size=size)
+        self._length = mp.Value('l', 0, lock=False)
+        self._lock = mp.RLock()
+        self._store(initial)
+
+    def copy(self) -> Any:
+        """
+        Returns a copy of the whole object.
+        :return: The object as it is now.
+        """
+        with self._lock:
+            return self._load()
+
+    def close(self):
+        """Releases the shared memory. Must only be called by the process that created the object"""
+        self._shm.close()
+        self._shm.unlink()
+
+    def _load(self) -> Any:
+        """Unpickles the object from shared memory. The lock must be held"""
+        return pickle.loads(self._shm.buf[:self._length.value])
+
+    def _store(self, value: Any):
+        """Pickles the object into shared memory. The lock must be held"""
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self._shm.size:
+            raise ValueError(f"Shared object is {len(data)} bytes, larger than IPC_SHARED_SIZE ({self._shm.size})")
+        self._shm.buf[:len(data)] = data
+        self._length.value = len(data)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._load())
+
+    def __iter__(self) -> Iterator:
+        return iter(self.copy())
+
+    def __contains__(self, item: Any) -> bool:
+        with self._lock:
+            return item in self._load()
+
+    def __repr__(self) -> str:
+        return repr(self.copy())
+
+
+class SharedList(_SharedObject):
+    """
+    List shared between processes, with the subset of list methods used by the RPi processes.
+    """
+
+    def __init__(self, size: int = IPC_SHARED_SIZE):
+        super().__init__([], size)
+
+    def __getitem__(self, index: int) -> Any:
+        with self._lock:
+            return self._load()[index]
+
+    def __setitem__(self, index: int, value: Any):
+        with self._lock:
+            items = self._load()
+            items[index] = value
+            self._store(items)
+
+    def append(self, value: Any):
+        with self._lock:
+            items = self._load()
+            items.append(value)
+            self._store(items)
+
+    def extend(self, values: List[Any]):
+        with self._lock:
+            items = self._load()
+            items.extend(values)
+            self._store(items)
+
+    def remove(self, value: Any):
+        with self._lock:
+            items = self._load()
+            items.remove(value)
+            self._store(items)
+
+    def pop(self, index: int = -1) -> Any:
+        with self._lock:
+            items = self._load()
+            value = items.pop(index)
+            self._store(items)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._store([])
+
+
+class SharedDict(_SharedObject):
+    """
+    Dict shared between processes, with the subset of dict methods used by the RPi processes.
+    """
+
+    def __init__(self, size: int = IPC_SHARED_SIZE):
+        super().__init__({}, size)
+
+    def __getitem__(self, key: Any) -> Any:
+        with self._lock:
+            return self._load()[key]
+
+    def __setitem__(self, key: Any, value: Any):
+        with self._lock:
+            items = self._load()
+            items[key] = value
+            self._store(items)
+
+    def __delitem__(self, key: Any):
+        with self._lock:
+            items = self._load()
+            del items[key]
+            self._store(items)
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        with self._lock:
+            return self._load().get(key, default)
+
+    def keys(self) -> List[Any]:
+        return list(self.copy().keys())
+
+    def values(self) -> List[Any]:
+        return list(self.copy().values())
+
+    def items(self) -> List[tuple]:
+        return list(self.copy().items())
+
+    def update(self, *args, **kwargs):
+        with self._lock:
+            items = self._load()
+            items.update(*args, **kwargs)
+            self._store(items)
+
+    def pop(self, key: Any, *default) -> Any:
+        with self._lock:
+            items = self._load()
+            value = items.pop(key, *default)
+            self._store(items)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._store({})
+
+
+class NativeManager:
+    """
+    Drop-in replacement for the parts of `multiprocessing.Manager()` used by the RPi, without a server process.
+
+    Queues, locks, events and values are the native `multiprocessing` ones, which work through pipes, semaphores
+    and shared memory, and lists and dicts are kept pickled in shared memory. Child processes must be forked from
+    the process that created them, since unlike Manager proxies they cannot be sent to other processes.
+    """
+
+    def __init__(self):
+        self._shared: List[_SharedObject] = []
+
+    def Event(self) -> mp.Event:
+        return mp.Event()
+
+    def Lock(self) -> mp.Lock:
+        return mp.Lock()
+
+    def Queue(self, maxsize: int = 0) -> Queue:
+        return Queue(maxsize)
+
+    def Value(self, typecode: str, value: Any) -> mp.Value:
+        return mp.Value(typecode, value)
+
+    def list(self) -> SharedList:
+        shared = SharedList()
+        self._shared.append(shared)
+        return shared
+
+    def dict(self) -> SharedDict:
+        shared = SharedDict()
+        self._shared.append(shared)
+        return shared
+
+    def shutdown(self):
+        """Releases the shared memory of the lists and dicts"""
+        for shared in self._shared:
+            shared.close()
+        self._shared.clear()
+
+
+def create_manager(backend: str = IPC_BACKEND):
+    """Creates the manager that the RPi processes share their queues, locks and state through
+
+    Args:
+        backend (str): "native" for a NativeManager, or "manager" for a `multiprocessing.Manager()`
+
+    Returns:
+        NativeManager or SyncManager: the manager
+    """
+    if backend == "manager":
+        return mp.Manager()
+    if backend == "native":
+        return NativeManager()
+    raise ValueError(f"Unknown IPC backend: {backend}")
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Offline analysis of the RPi logs, to find where the time goes in a run.
+
+Streams the log files in the order given, plain or gzip-compressed, as text or JSON lines, and rebuilds every run
+from its records. A run starts with the path request or the start command, and ends once the images are stitched.
+For each run, reports the ACK latency of the STM32 commands, the time and attempts of every snap, the API latency,
+the resent commands, and the longest gaps without any record:
+
+    python3 log_analyzer.py logs/*.log.gz
+    python3 log_analyzer.py logfile.txt --gap 0.5 --gaps 10
+"""
+import argparse
+import gzip
+import json
+import re
+import time
+from typing import Dict, IO, Iterable, Iterator, List, Optional, Tuple
+
+# Messages that start and end a run
+RUN_STARTS = ("Requesting path from algo...", "Start command received")
+RUN_ENDS = ("Images stitched!", "Program exited!")
+# Messages logged when the RPi starts, which end a run that never logged its end
+SESSION_STARTS = ("Child Processes started", "Pipeline tasks started")
+
+SENT = re.compile(r"Sent to STM32: (.+)")
+ACK = re.compile(r"ACK for (\S+) \(#(\d+)\) received after ([\d.]+) ms")
+# Logged before the dispatcher, which only told which command was acknowledged for RS00
+LEGACY_ACK = re.compile(r"ACK (?:for \S+ )?from STM32 received")
+RESENT = re.compile(r"No ACK for (\S+) \(#(\d+)\), resent it")
+GIVEN_UP = re.compile(r"No ACK for (\S+) \(#(\d+)\) after")
+SNAP = re.compile(r"Capturing image for obstacle id: (\S+)")
+RESULTS = re.compile(r"Image recognition results: (.*)")
+IMAGE_ID = re.compile(r"'image_id': '([^']*)'")
+
+# Messages logged before the images of a snap are sent to the API, one for every attempt
+IMAGE_REQUESTS = ("Image captured. Calling image-rec api", "Images captured. Calling image-rec api",
+                  "Images captured, dispatcher released. Calling image-rec api")
+# Requests to the API, as the messages logged before the request and once it is answered. The messages are matched
+# at the start of the records only, as they are also sent to Android. A response is matched to the last request,
+# the ones before it were never answered, e.g. retried after an error.
+API_CALLS = {
+    "/compute": (("Requesting path from algo...",),
+                 ("Commands received from API", "Commands and path received Algo API",
+                  "Something went wrong when requesting path from Algo API")),
+    "/image": (IMAGE_REQUESTS, ("Image recognition results",)),
+    "/stitch": (("PiAction retrieved from queue: stitch",),
+                ("Images stitched!", "Something went wrong when requesting stitch")),
+}
+
+TEXT_RECORD = re.compile(r"(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d{3}) :: (\w+) :: (.*)")
+
+
+class Record:
+    """
+    One log record, as read from a file.
+    """
+
+    __slots__ = ("time", "level", "message")
+
+    def __init__(self, time: float, level: str, message: str):
+        self.time = time
+        self.level = level
+        self.message = message
+
+
+class Run:
+    """
+    Timeline of one run rebuilt from its records, and the measurements taken along it.
+    """
+
+    def __init__(self, number: int, start: Record):
+        """
+        Constructor for Run.
+        :param number: Number of the run in the logs, from 1.
+        :param start: Record that started the run.
+        """
+        self.number = number
+        self.start = start.time
+        self.end = start.time
+        self.moving = False
+        self.records = 0
+        # Commands sent and not acknowledged yet, to match the ACKs of the logs without the dispatcher
+        self.in_flight: List[Tuple[str, float]] = []
+        # Whether the ACKs are logged by the dispatcher, with their latency
+        self.dispatcher = False
+        self.ack_latency: Dict[str, List[float]] = {}
+        self.resent: Dict[str, int] = {}
+        self.given_up: List[str] = []
+        # Snaps as [obstacle, start, end, attempts, image id]
+        self.snaps: List[list] = []
+        self.api_pending: Dict[str, List[float]] = {}
+        self.api_latency: Dict[str, List[float]] = {}
+        # Gaps as (length, previous message, next message, whether a command was in flight)
+        self.gaps: List[Tuple[float, str, str, bool]] = []
+        self._previous: Optional[Record] = None
+
+    def add(self, record: Record, gap: float):
+        """
+        Adds the next record of the run.
+        :param record: The record.
+        :param gap: Shortest time in seconds without any record that is reported as a gap.
+        """
+        message = record.message
+        self.records += 1
+        self.end = record.time
+        if self._previous is not None and record.time - self._previous.time >= gap:
+            self.gaps.append((record.time - self._previous.time, self._previous.message, message,
+                              bool(self.in_flight)))
+        self._previous = record
+        if message.startswith("Start command received"):
+            self.moving = True
+
+        match = SENT.match(message)
+        if match:
+            self.in_flight.extend((command, record.time) for command in match.group(1).split())
+            return
+        match = ACK.match(message)
+        if match:
+            command = match.group(1)
+            self.dispatcher = True
+            self.ack_latency.setdefault(command_type(command), []).append(float(match.group(3)) / 1000)
+            # Commands are acknowledged in the order they were sent
+            if self.in_flight:
+                self.in_flight.pop(0)
+            return
+        if LEGACY_ACK.match(message):
+            if self.in_flight and not self.dispatcher:
+                command, sent = self.in_flight.pop(0)
+                self.ack_latency.setdefault(command_type(command), []).append(record.time - sent)
+            return
+        match = RESENT.match(message)
+        if match:
+            self.resent[match.group(1)] = self.resent.get(match.group(1), 0) + 1
+            return
+        match = GIVEN_UP.match(message)
+        if match:
+            self.given_up.append(match.group(1))
+            if self.in_flight:
+                self.in_flight.pop(0)
+            return
+
+        match = SNAP.match(message)
+        if match:
+            self.snaps.append([match.group(1), record.time, None, 0, None])
+        elif self.snaps and message.startswith(IMAGE_REQUESTS):
+            self.snaps[-1][3] += 1
+        match = RESULTS.match(message)
+        if match and self.snaps:
+            image_id = IMAGE_ID.search(match.group(1))
+            self.snaps[-1][2] = record.time
+            self.snaps[-1][4] = image_id.group(1) if image_id else None
+
+        for endpoint, (requests, responses) in API_CALLS.items():
+            if message.startswith(requests):
+                self.api_pending.setdefault(endpoint, []).append(record.time)
+            elif self.api_pending.get(endpoint) and message.startswith(responses):
+                self.api_latency.setdefault(endpoint, []).append(record.time - self.api_pending.pop(endpoint)[-1])
+
+
+def command_type(command: str) -> str:
+    """Returns the kind of an STM32 command, e.g. FW for FW30"""
+    return command.rstrip("0123456789") or command
+
+
+def open_log(path: str) -> IO[str]:
+    """Opens a log file for reading, decompressing it if it is gzip-compressed"""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, encoding="utf-8", errors="replace")
+
+
+def read_records(paths: Iterable[str]) -> Iterator[Record]:
+    """
+    Reads the records of the log files one at a time, skipping the lines that are not records, e.g. tracebacks.
+    :param paths: Log files, in the order they were written.
+    :return: The records.
+    """
+    # Local time of the start of every minute, as converting each timestamp in full takes most of the time
+    minutes: Dict[str, float] = {}
+    for path in paths:
+        with open_log(path) as log:
+            for line in log:
+                if line.startswith("{"):
+                    try:
+                        entry = json.loads(line)
+                        yield Record(entry["time"], entry["level"], entry["message"])
+                    except (ValueError, KeyError):
+                        pass
+                    continue
+                match = TEXT_RECORD.match(line)
+                if match is None:
+                    continue
+                stamp, millis, level, message = match.groups()
+                minute = stamp[:16]
+                if minute not in minutes:
+                    if len(minutes) > 4096:
+                        minutes.clear()
+                    minutes[minute] = time.mktime(time.strptime(minute, "%Y-%m-%d %H:%M"))
+                yield Record(minutes[minute] + int(stamp[17:]) + int(millis) / 1000, level, message.rstrip())
+
+
+def runs(records: Iterable[Record], gap: float) -> Iterator[Run]:
+    """
+    Splits the records into runs, returning each one as soon as it ends.
+    :param records: Records in the order they were logged.
+    :param gap: Shortest time in seconds without any record that is reported as a gap.
+    :return: The runs.
+    """
+    run: Optional[Run] = None
+    number = 0
+    for record in records:
+        starts = record.message.startswith(RUN_STARTS)
+        # A new path request or start command once the robot is moving belongs to the next run, and the clock of
+        # the RPi, which has no RTC, may be set back between two sessions that did not log their end
+        if run is not None and ((starts and run.moving) or record.time < run.end - 1 or
+                                record.message.startswith(SESSION_STARTS)):
+            yield run
+            run = None
+        if run is None:
+            if not starts:
+                continue
+            number += 1
+            run = Run(number, record)
+        run.add(record, gap)
+        if record.message.startswith(RUN_ENDS):
+            yield run
+            run = None
+    if run is not None:
+        yield run
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Returns the nearest-rank percentile of the values"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def stats_header(title: str) -> str:
+    """Formats the header of the rows of stats_row()"""
+    return f"  {title:<24}{'n':>5}{'mean':>9}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}  (ms)"
+
+
+def stats_row(name: str, values: List[float]) -> str:
+    """Formats the count and distribution of durations in seconds, in milliseconds"""
+    return (f"  {name:<24}{len(values):>5}{sum(values) / len(values) * 1000:>9.1f}"
+            f"{percentile(values, 0.5) * 1000:>9.1f}{percentile(values, 0.9) * 1000:>9.1f}"
+            f"{percentile(values, 0.99) * 1000:>9.1f}{max(values) * 1000:>9.1f}")
+
+
+def report(run: Run, gaps: int):
+    """
+    Prints the measurements of a run.
+    :param run: The run.
+    :param gaps: Number of the longest gaps to print.
+    """
+    started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(run.start))
+    commands = sum(len(values) for values in run.ack_latency.values())
+    print(f"Run {run.number}: {started}, {run.end - run.start:.1f} s, {run.records} records, "
+          f"{commands} acknowledged commands, {len(run.snaps)} snaps")
+    if run.ack_latency:
+        print(stats_header("ACK latency"))
+        print(stats_row("all commands", [value for values in run.ack_latency.values() for value in values]))
+        for kind, values in sorted(run.ack_latency.items()):
+            print(stats_row(kind, values))
+    if run.api_latency:
+        print(stats_header("API latency"))
+        for endpoint, values in run.api_latency.items():
+            print(stats_row(endpoint, values))
+
+    if run.snaps:
+        print(f"  {'Snaps':<24}{'attempts':>9}{'time (ms)':>11}  result")
+        attempts: Dict[str, int] = {}
+        for obstacle, start, end, tries, image_id in run.snaps:
+            duration = f"{(end - start) * 1000:.0f}" if end is not None else "-"
+            print(f"  {obstacle:<24}{tries:>9}{duration:>11}  {image_id or '-'}")
+            attempts[obstacle.split("_")[0]] = attempts.get(obstacle.split("_")[0], 0) + max(tries, 1)
+        retried = {obstacle: count - 1 for obstacle, count in attempts.items() if count > 1}
+        if retried:
+            print(f"  Retries per obstacle: {retried}")
+    if run.resent or run.given_up:
+        print(f"  Resent commands: {run.resent or '-'}, given up on: {run.given_up or '-'}")
+
+    longest = sorted(run.gaps, reverse=True)[:gaps]
+    if longest:
+        print("  Longest gaps without any record, while idle or (motion) with a command in flight:")
+        for length, before, after, in_flight in longest:
+            print(f"  {length * 1000:>9.0f} ms {'(motion)' if in_flight else '        '} "
+                  f"{before[:60]!r} -> {after[:60]!r}")
+    print()
+
+
+def main(args: argparse.Namespace):
+    for run in runs(read_records(args.logs), args.gap):
+        report(run, args.gaps)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("logs", nargs="+", help="log files in the order they were written, e.g. logs/*.log.gz")
+    parser.add_argument("--gap", type=float, default=0.5, help="shortest gap in seconds to report")
+    parser.add_argument("--gaps", type=int, default=5, help="number of the longest gaps to report per run")
+    main(parser.parse_args())
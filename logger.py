@@ -1,29 +1,264 @@
+import atexit
+import gzip
+import json
 import logging
+import os
+import queue
+import shutil
+import signal
+import sys
+import time
+from logging.handlers import QueueHandler
+from multiprocessing import Process
+from typing import List, Optional
+from ipc import Queue
+from settings import (LOG_DIR, LOG_FLUSH_INTERVAL, LOG_JSON, LOG_LEVEL, LOG_LEVELS, LOG_SEGMENT_SIZE,
+                      LOG_SEGMENTS_KEPT)
 
+LOG_FORMAT = '%(asctime)s :: %(levelname)s :: %(message)s'
 
-def prepare_logger() -> logging.Logger:
+# Records logged by every process, and the process that writes them out
+_records: Optional[Queue] = None
+_writer: Optional[Process] = None
+_writer_owner: Optional[int] = None
+
+
+class BatchedStreamHandler(logging.StreamHandler):
     """
-    Creates a logger that is able to both print to console and save to file.
+    StreamHandler that only flushes the stream when flush() is called, instead of after every record.
+    """
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class BatchedFileHandler(logging.FileHandler):
+    """
+    FileHandler that only flushes the file when flush() is called, instead of after every record.
+    """
+
+    def emit(self, record: logging.LogRecord):
+        if self.stream is None:
+            self.stream = self._open()
+        BatchedStreamHandler.emit(self, record)
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats a record as a JSON object on one line, for the post-run tools to parse.
     """
-    log_format = logging.Formatter(
-        '%(asctime)s :: %(levelname)s :: %(message)s')
 
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.DEBUG)
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps({"time": record.created, "level": record.levelname, "logger": record.name,
+                           "process": record.processName, "message": record.getMessage()})
 
-    if not logger.hasHandlers():
-        # Console handler
-        console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.DEBUG)
-        console_handler.setFormatter(log_format)
 
-        # File handler
-        file_handler = logging.FileHandler('logfile.txt')
-        file_handler.setLevel(logging.DEBUG)
+class SegmentedFileHandler(BatchedFileHandler):
+    """
+    Writes the records to one file per segment, e.g. per run, in a directory. A segment that grows past `max_bytes`
+    continues in a new part. Completed files are compressed with gzip, and only the last `keep` of them are kept.
+
+    Files are named `<start time>-<label>.<part>.log`, or `.jsonl` with JSON lines, so that they sort by time.
+    """
+
+    def __init__(self, directory: str = LOG_DIR, keep: int = LOG_SEGMENTS_KEPT, max_bytes: int = LOG_SEGMENT_SIZE,
+                 json_lines: bool = LOG_JSON):
+        """
+        Constructor for SegmentedFileHandler.
+        :param directory: Directory to write the segments to.
+        :param keep: Number of completed files to keep.
+        :param max_bytes: Size in bytes after which a segment continues in a new file, 0 for no limit.
+        :param json_lines: Whether to write the records as JSON lines instead of text.
+        """
+        self.directory = os.path.abspath(directory)
+        self.keep = keep
+        self.max_bytes = max_bytes
+        self.extension = ".jsonl" if json_lines else ".log"
+        self.segment = ""
+        self.part = 0
+        super().__init__(os.path.join(directory, "unused"), delay=True)
+        if json_lines:
+            self.setFormatter(JSONFormatter())
+        self.start_segment("idle")
+
+    def start_segment(self, label: str):
+        """
+        Completes the current file, and writes the records from now on to a new segment.
+        :param label: Label in the name of the segment, e.g. `run`.
+        """
+        self._complete()
+        now = time.time()
+        # With milliseconds, as a run may start in the same second as the segment before it
+        self.segment = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}.{int(now % 1 * 1000):03d}-{label}"
+        self.part = 0
+        self.baseFilename = os.path.join(self.directory, f"{self.segment}.{self.part}{self.extension}")
+
+    def emit(self, record: logging.LogRecord):
+        if self.stream is None:
+            os.makedirs(self.directory, exist_ok=True)
+        super().emit(record)
+
+    def flush(self):
+        super().flush()
+        # Checked on flush rather than on every record, so a file may end up a batch larger than max_bytes
+        if self.stream is not None and self.max_bytes and self.stream.tell() >= self.max_bytes:
+            self._complete()
+            self.part += 1
+            self.baseFilename = os.path.join(self.directory, f"{self.segment}.{self.part}{self.extension}")
+
+    def close(self):
+        self._complete()
+        super().close()
+
+    def _complete(self):
+        """Closes the current file, compresses it and removes the oldest files beyond `keep`"""
+        if self.stream is None:
+            # Nothing was written to it
+            return
+        self.stream.close()
+        self.stream = None
+        with open(self.baseFilename, "rb") as source, gzip.open(f"{self.baseFilename}.gz", "wb") as target:
+            shutil.copyfileobj(source, target)
+        os.remove(self.baseFilename)
+
+        completed = sorted(name for name in os.listdir(self.directory) if name.endswith((".log.gz", ".jsonl.gz")))
+        for name in completed[:max(0, len(completed) - self.keep)]:
+            os.remove(os.path.join(self.directory, name))
+
+
+class CompactQueueHandler(QueueHandler):
+    """
+    QueueHandler that only queues what the writer prints of a record, which is quicker to pickle than the record.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> tuple:
+        # Merges the arguments and the traceback into the message, as the records are printed with LOG_FORMAT
+        message = self.format(record)
+        return record.name, record.levelno, record.created, record.processName, message
+
+
+def write_records(records: Queue, handlers: List[logging.Handler], flush_interval: float = LOG_FLUSH_INTERVAL):
+    """
+    [Child Process] Writes the records logged by every process. The handlers are flushed in batches, at most
+    `flush_interval` after a record is written, or straight away for errors. A label received instead of a record
+    starts a new segment of the log files. Returns once None is received.
+    :param records: Queue that the records are logged to.
+    :param handlers: Handlers to write the records with.
+    :param flush_interval: Maximum time in seconds that a record waits to be flushed.
+    """
+    # Ctrl+C reaches every process of the RPi, but this one writes out the last records once the others stopped
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Time by which the records written so far are flushed, None if all of them were
+    deadline = None
+    while True:
+        try:
+            record = records.get(timeout=None if deadline is None else max(0.0, deadline - time.monotonic()))
+        except queue.Empty:
+            # Nothing arrived before the deadline
+            record = False
+        if record is None:
+            break
+        if isinstance(record, str):
+            for handler in handlers:
+                if isinstance(handler, SegmentedFileHandler):
+                    handler.start_segment(record)
+            continue
+        if record:
+            name, levelno, created, process, message = record
+            record = logging.makeLogRecord({"name": name, "levelno": levelno, "levelname": logging.getLevelName(levelno),
+                                            "created": created, "msecs": (created - int(created)) * 1000,
+                                            "processName": process, "msg": message})
+            for handler in handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+            if deadline is None:
+                deadline = time.monotonic() + flush_interval
+            if record.levelno >= logging.ERROR:
+                deadline = 0
+        if deadline is not None and time.monotonic() >= deadline:
+            for handler in handlers:
+                handler.flush()
+            deadline = None
+
+    for handler in handlers:
+        handler.flush()
+        handler.close()
+
+
+def _start_writer():
+    """Starts the writer process, which the processes forked after this hand their records to"""
+    global _records, _writer, _writer_owner
+    log_format = logging.Formatter(LOG_FORMAT)
+
+    # Console handler
+    console_handler = BatchedStreamHandler()
+    console_handler.setLevel(logging.DEBUG)
+    console_handler.setFormatter(log_format)
+
+    # File handler, only opened by the writer process
+    file_handler = SegmentedFileHandler()
+    file_handler.setLevel(logging.DEBUG)
+    if not LOG_JSON:
         file_handler.setFormatter(log_format)
 
-        # Add handlers to logger
-        logger.addHandler(console_handler)
-        logger.addHandler(file_handler)
+    _records = Queue()
+    _writer = Process(target=write_records, args=(_records, [console_handler, file_handler]), daemon=True)
+    _writer.start()
+    _writer_owner = os.getpid()
+    atexit.register(stop_writer)
+
+
+def stop_writer():
+    """Writes out the records still waiting, and stops the writer process"""
+    global _writer
+    # Forked processes inherit the writer, but only the one that started it can stop it
+    if _writer is None or os.getpid() != _writer_owner:
+        return
+    if _writer.is_alive():
+        _records.put(None)
+        _writer.join(timeout=5)
+    _writer = None
+
+
+def start_segment(label: str):
+    """
+    Starts a new segment of the log files, e.g. at the start and the end of a run. Can be called from any process.
+    :param label: Label in the name of the segment, e.g. `run`.
+    """
+    if _records is not None:
+        _records.put(label)
+
+
+def _module_name(depth: int) -> str:
+    """Returns the name of the module that called prepare_logger(), or of the script run as __main__"""
+    module_globals = sys._getframe(depth + 1).f_globals
+    name = module_globals.get("__name__", "__main__")
+    if name == "__main__":
+        name = os.path.splitext(os.path.basename(module_globals.get("__file__", "main")))[0]
+    return name
+
+
+def prepare_logger(name: Optional[str] = None) -> logging.Logger:
+    """
+    Creates a logger that is able to both print to console and save to file.
+
+    Records are handed to a writer process shared by every process of the RPi, so that logging never waits for
+    the console or the SD card. The level of each module can be set in LOG_LEVELS.
+    :param name: Name of the module logging, by default the module calling this.
+    """
+    base = logging.getLogger(__name__)
+    if not base.handlers:
+        base.setLevel(LOG_LEVEL)
+        _start_writer()
+        base.addHandler(CompactQueueHandler(_records))
+        # Only the writer process prints the records
+        base.propagate = False
 
+    name = _module_name(1) if name is None else name
+    logger = base.getChild(name)
+    if name in LOG_LEVELS:
+        logger.setLevel(LOG_LEVELS[name])
     return logger
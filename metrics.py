@@ -0,0 +1,274 @@
+import bisect
+import os
+import signal
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import Logger
+from multiprocessing import Array, Lock
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from settings import METRICS_HOST, METRICS_PORT
+
+# Stages of the hot path that are timed
+STAGES = (
+    "android_queue_wait",  # From a message for Android being queued to the sender taking it
+    "action_queue_wait",  # From an action, e.g. a snap, being queued to rpi_action taking it
+    "lock_wait",  # Waiting for the dispatcher to have room for a command, or to be held or idle
+    "serial_write",  # Writing commands to STM32
+    "ack_wait",  # From a command being sent to its ACK
+    "camera_warmup",  # Letting the exposure settle when the camera is opened
+    "capture",  # From a capture being requested to the image being in shared memory
+    "upload",  # Sending an image to the API
+    "inference",  # From an image being sent to the API to its response
+    "android_send",  # Writing messages to Android
+)
+# Upper bounds in seconds of the histogram buckets, 4 per decade from 1 us to 100 s, with a last bucket above them
+BOUNDS = [10 ** (exponent / 4) for exponent in range(-24, 9)]
+
+# Value of a metric, as its name, help text, labels and value
+Gauge = Tuple[str, str, Dict[str, str], float]
+
+
+class Histograms:
+    """
+    Histograms of the time spent in each stage, shared by every process of the RPi.
+
+    The histograms live in shared memory, so they must be created before the child processes are forked, as the
+    module-level `metrics` is when this module is imported. Each duration is counted in a bucket with logarithmic
+    bounds, so percentiles are estimated as the upper bound of their bucket, within about 78% above the actual value,
+    while the count, total and maximum are exact.
+    """
+
+    def __init__(self, stages: Tuple[str, ...] = STAGES):
+        """
+        Constructor for Histograms.
+        :param stages: Names of the stages that can be recorded.
+        """
+        self.stages = stages
+        self._index = {stage: i for i, stage in enumerate(stages)}
+        self._buckets = len(BOUNDS) + 1
+        self._lock = Lock()
+        self._counts = Array('l', len(stages) * self._buckets, lock=False)
+        # Total, maximum and last duration of every stage
+        self._totals = Array('d', len(stages), lock=False)
+        self._maxima = Array('d', len(stages), lock=False)
+        self._last = Array('d', len(stages), lock=False)
+
+    def record(self, stage: str, seconds: float):
+        """
+        Records the duration of a stage.
+        :param stage: One of the stages.
+        :param seconds: Duration in seconds.
+        """
+        i = self._index[stage]
+        bucket = bisect.bisect_left(BOUNDS, seconds)
+        with self._lock:
+            self._counts[i * self._buckets + bucket] += 1
+            self._totals[i] += seconds
+            self._last[i] = seconds
+            if seconds > self._maxima[i]:
+                self._maxima[i] = seconds
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        """
+        Records how long the block inside takes, with a monotonic clock.
+        :param stage: One of the stages.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(stage, time.monotonic() - start)
+
+    def last(self, stage: str) -> float:
+        """
+        Returns the last duration recorded for a stage.
+        :param stage: One of the stages.
+        :return: Duration in seconds, 0 if nothing was recorded.
+        """
+        return self._last[self._index[stage]]
+
+    def count(self, stage: str) -> int:
+        """
+        Returns the number of durations recorded for a stage.
+        :param stage: One of the stages.
+        :return: Number of durations.
+        """
+        i = self._index[stage]
+        return sum(self._counts[i * self._buckets:(i + 1) * self._buckets])
+
+    def percentile(self, stage: str, fraction: float) -> Optional[float]:
+        """
+        Estimates a percentile of a stage, as the upper bound of the bucket it falls in.
+        :param stage: One of the stages.
+        :param fraction: Fraction of the durations below the percentile, e.g. 0.9.
+        :return: The percentile in seconds, the maximum if it falls in the last bucket, or None if nothing was recorded.
+        """
+        i = self._index[stage]
+        counts: List[int] = self._counts[i * self._buckets:(i + 1) * self._buckets]
+        total = sum(counts)
+        if total == 0:
+            return None
+        rank = fraction * total
+        seen = 0
+        for bucket, count in enumerate(counts):
+            seen += count
+            if seen >= rank and count:
+                return min(BOUNDS[bucket], self._maxima[i]) if bucket < len(BOUNDS) else self._maxima[i]
+        return self._maxima[i]
+
+    def summary(self) -> str:
+        """
+        Formats the histograms of every stage with durations recorded.
+
+        Reads the histograms without the lock, so that it can be called from a signal handler while the same
+        process is recording, at the cost of a record possibly being half counted.
+        :return: One line per stage.
+        """
+        lines = [f"{'stage':<20}{'n':>7}{'mean':>10}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}  (ms)"]
+        for i, stage in enumerate(self.stages):
+            count = self.count(stage)
+            if count == 0:
+                continue
+            lines.append(f"{stage:<20}{count:>7}{self._totals[i] / count * 1000:>10.2f}"
+                         f"{self.percentile(stage, 0.5) * 1000:>10.2f}{self.percentile(stage, 0.9) * 1000:>10.2f}"
+                         f"{self.percentile(stage, 0.99) * 1000:>10.2f}{self._maxima[i] * 1000:>10.2f}")
+        return "\n".join(lines)
+
+    def prometheus(self, name: str = "rpi_stage_seconds") -> List[str]:
+        """
+        Formats the histograms of every stage in the Prometheus text format, without the lock as summary() does.
+        :param name: Name of the histogram metric.
+        :return: Lines of the metric.
+        """
+        lines = [f"# HELP {name} Time spent in each stage of the hot path", f"# TYPE {name} histogram"]
+        for i, stage in enumerate(self.stages):
+            counts = self._counts[i * self._buckets:(i + 1) * self._buckets]
+            seen = 0
+            for bound, count in zip(BOUNDS, counts):
+                seen += count
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound:.6g}"}} {seen}')
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {sum(counts)}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {self._totals[i]}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {sum(counts)}')
+        return lines
+
+    def reset(self):
+        """Forgets every duration recorded, e.g. at the start of a run"""
+        with self._lock:
+            for i in range(len(self._counts)):
+                self._counts[i] = 0
+            for i in range(len(self.stages)):
+                self._totals[i] = 0.0
+                self._maxima[i] = 0.0
+                self._last[i] = 0.0
+
+
+def prometheus_text(gauges: List[Gauge]) -> str:
+    """
+    Formats gauges and the histograms of `metrics` in the Prometheus text format.
+    :param gauges: Gauges to include, the ones with the same name next to each other.
+    :return: Body of a response to a scrape.
+    """
+    lines = []
+    previous = None
+    for name, help_text, labels, value in gauges:
+        if name != previous:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+            previous = name
+        label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+        lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+    lines += metrics.prometheus()
+    return "\n".join(lines) + "\n"
+
+
+class _QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # A scraper that disconnects early is not worth a traceback
+        pass
+
+
+class MetricsServer:
+    """
+    HTTP server in a background thread that serves the gauges of the RPi and the histograms of `metrics` at
+    /metrics, in the Prometheus text format, e.g. for `curl http://<rpi>:9108/metrics` or a Prometheus scraper.
+    """
+
+    def __init__(self, gauges: Callable[[], List[Gauge]], host: str = METRICS_HOST, port: int = METRICS_PORT):
+        """
+        Constructor for MetricsServer.
+        :param gauges: Function that reads the gauges, called on every scrape.
+        :param host: Address to listen on.
+        :param port: Port to listen on, 0 for any free port.
+        """
+        self.gauges = gauges
+        self.host = host
+        self.port = port
+        self._server = None
+
+    def start(self):
+        """Starts serving in a background thread"""
+        gauges = self.gauges
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = prometheus_text(gauges()).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Every scrape would otherwise be printed
+                pass
+
+        self._server = _QuietHTTPServer((self.host, self.port), Handler)
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        """Stops serving"""
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+
+
+def dump_on_signal(logger: Logger, signum: int = signal.SIGUSR1):
+    """
+    Logs the summary of `metrics` whenever the process receives a signal, e.g. `kill -USR1 <pid>` during a run.
+    Must be called from the main thread.
+
+    Logging takes locks that the interrupted code may be holding, so the signal handler only writes a byte to a
+    pipe, and a background thread logs the summary when it reads it.
+    :param logger: Logger to log the summary with.
+    :param signum: Signal to log the summary on.
+    """
+    read_fd, write_fd = os.pipe()
+    # A burst of signals must not block the handler once the pipe is full
+    os.set_blocking(write_fd, False)
+
+    def log_summaries():
+        while os.read(read_fd, 1):
+            logger.info(f"Timings so far:\n{metrics.summary()}")
+
+    def on_signal(*_):
+        try:
+            os.write(write_fd, b"\0")
+        except BlockingIOError:
+            pass
+
+    threading.Thread(target=log_summaries, name="metrics-dump", daemon=True).start()
+    signal.signal(signum, on_signal)
+
+
+metrics = Histograms()
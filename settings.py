@@ -1,6 +1,38 @@
 # STM32 BOARD SERIAL CONNECTION
 SERIAL_PORT = "/dev/serial/by-id/usb-Silicon_Labs_CP2102_USB_to_UART_Bridge_Controller_0002-if00-port0"  # stm32
 BAUD_RATE = 115200
+# "ascii" sends 4-character commands, "binary" sends framed commands with a sequence number and CRC, which needs
+# firmware that speaks communication/protocol.py
+STM_PROTOCOL = "ascii"
+# Maximum number of commands sent to STM32 before their ACK. 1 waits for every ACK before sending the next command,
+# 2 keeps the next command buffered on the STM32 while it executes the current one (needs firmware that queues them).
+# Commands are never sent ahead past a SNAP or FIN.
+STM_SEND_WINDOW = 1
+STM_READ_TIMEOUT = 0.05  # Seconds a serial read waits for the first byte
+STM_FRAME_TIMEOUT = 0.2  # Seconds a partial line from STM32 stays idle before it is taken as a message
+# Read STM32 messages in a background thread of the receiving process, so they are buffered while it is busy
+STM_READER_THREAD = False
+# Seconds to wait for the ACK of a command before resending it, None to wait forever. A command is resent at most
+# STM_ACK_RETRIES times (only when it is the only command in flight), then given up on as if it was acknowledged.
+# Only the binary protocol resends, since STM32 cannot tell a resent ASCII command from a new one, and would move
+# twice if only the ACK was lost.
+STM_ACK_TIMEOUT = 10.0
+STM_ACK_RETRIES = 1
+# Merge runs of straight moves from the algo into single commands, e.g. FW10 FW20 into FW30, and drop FW00/BW00
+COMPACT_COMMANDS = True
+
+# ANDROID CONNECTION
+# "rfcomm" advertises a Bluetooth serial port service for the tablet, "tcp" and "unix" accept a (simulated) tablet
+# over a socket, e.g. to load-test the message path without Bluetooth
+ANDROID_TRANSPORT = "rfcomm"
+ANDROID_TCP_HOST = "0.0.0.0"
+ANDROID_TCP_PORT = 5000
+ANDROID_UNIX_PATH = "/tmp/mdp-android.sock"
+# Minimum seconds between two writes to Android. Messages queued in between are sent together in the next write,
+# with image-rec, status and error messages first and only the latest location
+ANDROID_SEND_INTERVAL = 0.05
+# Maximum number of info and other non-priority messages kept for Android while it is disconnected
+ANDROID_OUTBOX_SIZE = 100
 
 # API DETAILS
 # API_IP = '192.168.21.49'  # IP address of Tim laptop
@@ -9,7 +41,77 @@ BAUD_RATE = 115200
 API_IP = '192.168.21.111' # IP address of Randy laptop
 
 API_PORT = 8000
+API_POOL_SIZE = 4  # Keep-alive connections to the API per process
+
+
+# IPC SETTINGS
+# "native" shares queues, locks and state between the processes directly through pipes and shared memory,
+# "manager" goes through a multiprocessing.Manager server process for every operation
+IPC_BACKEND = "native"
+IPC_SHARED_SIZE = 64 * 1024  # Maximum size in bytes of a pickled shared list or dict in native mode
 
+# LOGGING
+# Directory of the log files, with one segment per run from start() to FIN, and one for the time in between
+LOG_DIR = "logs"
+LOG_SEGMENTS_KEPT = 50  # Number of completed, gzip-compressed log files kept, the oldest are removed
+LOG_SEGMENT_SIZE = 20 * 1024 * 1024  # Size in bytes after which a segment continues in a new file, 0 for no limit
+LOG_JSON = False  # Write the log files as JSON lines instead of text
+LOG_LEVEL = "DEBUG"
+# Level of a module, overriding LOG_LEVEL, e.g. {"communication.android": "INFO"} to leave out every message sent
+LOG_LEVELS = {}
+LOG_FLUSH_INTERVAL = 0.5  # Maximum seconds a record waits before it is written out to the console and file
+
+# METRICS
+# Address and port of the Prometheus text endpoint at /metrics, with the queue depths and stage timings during a run.
+# METRICS_PORT None does not serve it.
+METRICS_HOST = "0.0.0.0"
+METRICS_PORT = 9108
 
 # ROBOT SETTINGS
 OUTDOOR_BIG_TURN = False
+
+# CAMERA SETTINGS
+CAMERA_WARMUP = 1  # Seconds for exposure to settle after the camera is opened
+# "still" captures a frame when asked, "stream" keeps capturing from the video port into a ring buffer
+CAMERA_MODE = "still"
+CAMERA_RING_SLOTS = 8  # Number of recent frames kept in the ring buffer
+CAMERA_RING_SLOT_SIZE = 1024 * 1024  # Maximum size of a single JPEG frame in bytes
+CAMERA_SETTLE_FRAMES = 3  # Frames to skip after brightness/contrast change in stream mode
+# Capture profiles: JPEG size (None keeps the camera resolution), JPEG quality, and whether to crop to the region
+# where the obstacle face is expected. In stream mode the profile is fixed when the stream starts and is not cropped.
+CAPTURE_PROFILES = {
+    "full": {"resize": None, "quality": 85, "crop": False},
+    "medium": {"resize": (1024, 768), "quality": 80, "crop": False},
+    "small": {"resize": (640, 480), "quality": 75, "crop": True},
+}
+CAPTURE_PROFILE = "full"
+# Region (x, y, width, height as fractions of the uploaded image) where the obstacle face is expected, per signal
+CAPTURE_CROPS = {
+    "L": (0.0, 0.0, 0.6, 1.0),
+    "C": (0.2, 0.0, 0.6, 1.0),
+    "R": (0.4, 0.0, 0.6, 1.0),
+}
+
+# IMAGE RECOGNITION SETTINGS
+# "sequential" retries one capture at a time, "bracket" captures all SNAP_BRACKETS variants and sends them at once,
+# "concurrent" captures SNAP_ATTEMPTS one after another while earlier captures are being uploaded
+SNAP_MODE = "sequential"
+# Task 1 only: capture the SNAP_BRACKETS images, let the robot move on, and recognize them in the background
+SNAP_ASYNC = False
+# Name and camera settings of each bracketed capture
+SNAP_BRACKETS = [
+    ("default", {}),
+    ("bright", {"brightness": 60, "contrast": 90}),
+    ("dark", {"brightness": 30, "contrast": 100, "framerate": 70}),
+]
+# Name and camera settings of each attempt in concurrent mode, in the order they are captured
+SNAP_ATTEMPTS = [
+    ("default", {}),
+    ("default", {}),
+    ("default", {}),
+    ("bright", {"brightness": 60, "contrast": 90}),
+    ("bright", {"brightness": 60, "contrast": 90}),
+    ("dark", {"brightness": 30, "contrast": 100, "framerate": 70}),
+    ("dark", {"brightness": 30, "contrast": 100, "framerate": 70}),
+]
+SNAP_WORKERS = 3  # Maximum number of attempts in flight in concurrent mode
@@ -0,0 +1,73 @@
+import json
+import socket
+import threading
+from typing import Any, List, Optional, Union
+from simulation.timeline import Timeline
+
+
+class AndroidClient:
+    """
+    Simulated Android tablet, which sends messages to the RPi and records the ones it receives.
+    """
+
+    def __init__(self, address: Union[tuple, str], timeline: Optional[Timeline] = None):
+        """
+        Constructor for AndroidClient.
+        :param address: Address that the RPi accepts Android on, a (host, port) pair or the path of a Unix socket.
+        :param timeline: Timeline to record every message sent and received on.
+        """
+        self.address = address
+        self.timeline = timeline
+        self.received: List[dict] = []
+        self.sock = None
+        self._thread = None
+
+    def connect(self):
+        """Connects to the RPi, and starts receiving in a background thread"""
+        if isinstance(self.address, str):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(self.address)
+        else:
+            self.sock = socket.create_connection(self.address)
+        self._thread = threading.Thread(target=self._receive, daemon=True)
+        self._thread.start()
+
+    def disconnect(self):
+        """Closes the connection to the RPi"""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def send(self, cat: str, value: Any):
+        """
+        Sends a message to the RPi.
+        :param cat: Message category.
+        :param value: Message value.
+        """
+        self.sock.sendall(f"{json.dumps({'cat': cat, 'value': value})}\n".encode("utf-8"))
+        self._record("send", cat, value)
+
+    def _receive(self):
+        buffer = b""
+        while True:
+            try:
+                data = self.sock.recv(4096)
+            except OSError:
+                return
+            if not data:
+                return
+            buffer += data
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if not line.strip():
+                    continue
+                message = json.loads(line)
+                self.received.append(message)
+                self._record("recv", message["cat"], message["value"])
+
+    def _record(self, name: str, cat: str, value: Any):
+        if self.timeline is not None:
+            # String values are part of the detail, so that e.g. a `status` of `finished` can be waited for
+            self.timeline.record("android", name, f"{cat}:{value}" if isinstance(value, str) else cat)
@@ -0,0 +1,133 @@
+"""
+Stand-in for the Algorithm and Image Recognition API on the laptop, serving `/`, `/compute`, `/image` and `/stitch`
+on localhost with canned answers after a configurable processing time.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+from simulation.timeline import Timeline
+
+# Path of the default /compute answer: three obstacles, with straight moves that compaction can merge
+DEFAULT_COMMANDS = [
+    "FW10", "FW20", "FR00", "SNAP1_C",
+    "BW10", "FL00", "FW30", "SNAP2_L",
+    "BR00", "FW10", "FW00", "BL00", "SNAP3_R",
+    "FW20", "FIN",
+]
+
+
+def straight_path(commands: List[str]) -> List[dict]:
+    """
+    Makes up a path for the commands, with one position per movement command after the starting position, so
+    that every ACK has a location to report.
+    :param commands: Commands of the path.
+    :return: Positions of the robot.
+    """
+    moves = [command for command in commands if not command.startswith("SNAP") and command != "FIN"]
+    return [{"x": 1, "y": 1 + i, "direction": 0} for i in range(len(moves) + 1)]
+
+
+class _QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Connections are reset when the harness stops the RPi processes mid-request
+        pass
+
+
+class StubAPIServer:
+    """
+    HTTP server that answers like the API, from a thread of the harness process.
+    """
+
+    def __init__(self, commands: Optional[List[str]] = None, image_id: str = "20", inference_time: float = 0.0,
+                 timeline: Optional[Timeline] = None):
+        """
+        Constructor for StubAPIServer.
+        :param commands: Commands that /compute answers with, by default DEFAULT_COMMANDS.
+        :param image_id: Image ID that /image answers with.
+        :param inference_time: Seconds that /compute and /image take to answer.
+        :param timeline: Timeline to record every request on.
+        """
+        self.commands = DEFAULT_COMMANDS if commands is None else commands
+        self.image_id = image_id
+        self.inference_time = inference_time
+        self.timeline = timeline
+        self.server = _QuietHTTPServer(("127.0.0.1", 0), self._handler())
+        self._thread = None
+
+    @property
+    def host(self) -> str:
+        return self.server.server_address[0]
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def start(self):
+        """Starts serving in a background thread"""
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops serving"""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def answer(self, method: str, path: str, body: bytes) -> Optional[dict]:
+        """
+        Answers a request.
+        :param method: HTTP method.
+        :param path: Path of the endpoint.
+        :param body: Body of the request.
+        :return: JSON answer, or None for an unknown endpoint.
+        """
+        if method == "GET" and path == "/":
+            return {"result": "ok"}
+        if method == "POST" and path == "/compute":
+            time.sleep(self.inference_time)
+            return {"data": {"commands": self.commands, "path": straight_path(self.commands)}, "error": None}
+        if method == "POST" and path == "/image":
+            time.sleep(self.inference_time)
+            # The filename is `<time>_<obstacle_id>_<signal>.jpg`, and appears in the multipart header of the file
+            filename = body.split(b'filename="', 1)[-1].split(b'"', 1)[0].decode("utf-8", errors="replace")
+            parts = filename.split("_")
+            obstacle_id = parts[1] if len(parts) > 1 else "0"
+            return {"image_id": self.image_id, "obstacle_id": obstacle_id}
+        if method == "GET" and path == "/stitch":
+            return {"result": "ok"}
+        return None
+
+    def _handler(self) -> type:
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self._serve("GET")
+
+            def do_POST(self):
+                self._serve("POST")
+
+            def _serve(self, method: str):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if stub.timeline is not None:
+                    stub.timeline.record("api", "request", self.path)
+                answer = stub.answer(method, self.path, body)
+                content = json.dumps(answer).encode("utf-8")
+                self.send_response(404 if answer is None else 200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                # Recorded before the answer is written, as the RPi may act on it before this thread runs again
+                if stub.timeline is not None:
+                    stub.timeline.record("api", "response", self.path)
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
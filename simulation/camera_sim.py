@@ -0,0 +1,43 @@
+import time
+from typing import List, Optional
+
+# Smallest valid JPEG: start of image followed by end of image. The stub API does not decode it
+BLANK_JPEG = b"\xff\xd8\xff\xd9"
+
+
+class FakeCamera:
+    """
+    Stand-in for CameraService, which returns the same image after a configurable capture time, without the
+    PiCamera.
+    """
+
+    def __init__(self, capture_time: float = 0.0, image: bytes = BLANK_JPEG):
+        """
+        Constructor for FakeCamera.
+        :param capture_time: Seconds that every capture takes.
+        :param image: JPEG image returned by every capture.
+        """
+        self.capture_time = capture_time
+        self.image = image
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def capture(self, brightness: Optional[int] = None, contrast: Optional[int] = None,
+                framerate: Optional[int] = None, signal: Optional[str] = None,
+                profile: Optional[str] = None) -> memoryview:
+        """Returns the image after the capture time, ignoring the settings"""
+        time.sleep(self.capture_time)
+        return memoryview(self.image)
+
+    def capture_bracket(self, brackets: List[dict], signal: Optional[str] = None,
+                        profile: Optional[str] = None) -> List[memoryview]:
+        """Returns one image per group of settings, after the capture time of each"""
+        return [self.capture() for _ in brackets]
+
+    def recent(self, age: int = 1) -> Optional[memoryview]:
+        """Returns None, as the fake camera does not stream"""
+        return None
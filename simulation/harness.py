@@ -0,0 +1,117 @@
+"""
+Runs an RPi orchestrator against simulated hardware: an STM32 on a pseudo-terminal, an Android tablet over a
+local TCP socket, the API on a local HTTP server and a camera that returns a blank image. The orchestrator runs
+unchanged in its own processes, while the simulated components run as threads of this process and record what they
+see on a shared timeline.
+"""
+import multiprocessing
+import threading
+from typing import List, Optional
+from communication.android import AndroidLink
+from communication.api import APIClient
+from communication.transport import TCPTransport
+from settings import STM_ACK_RETRIES, STM_PROTOCOL
+from simulation.android_sim import AndroidClient
+from simulation.api_stub import StubAPIServer
+from simulation.camera_sim import FakeCamera
+from simulation.stm32_sim import STM32Simulator
+from simulation.timeline import Timeline
+
+ORCHESTRATORS = ("task1", "task1-async", "task2")
+
+
+def obstacles_for(commands: List[str]) -> List[dict]:
+    """
+    Makes up an obstacle for every snap command of a path, so that the recognition results can be matched to them.
+    :param commands: Commands of the path.
+    :return: Obstacles in the format sent by Android.
+    """
+    ids = [command.replace("SNAP", "").split("_")[0] for command in commands if command.startswith("SNAP")]
+    return [{"x": 5 + 2 * i, "y": 10, "id": int(obstacle_id), "d": 2} for i, obstacle_id in enumerate(ids)]
+
+
+class Simulation:
+    """
+    One run of an orchestrator against the simulated hardware.
+    """
+
+    def __init__(self, orchestrator: str = "task1", motion_time: float = 0.05, capture_time: float = 0.05,
+                 inference_time: float = 0.05, commands: Optional[List[str]] = None, protocol: str = STM_PROTOCOL):
+        """
+        Constructor for Simulation.
+        :param orchestrator: One of ORCHESTRATORS.
+        :param motion_time: Seconds that the STM32 takes to carry out every command.
+        :param capture_time: Seconds that every capture takes.
+        :param inference_time: Seconds that the API takes to answer /compute and /image.
+        :param commands: Commands that the algo answers with, by default those of StubAPIServer.
+        :param protocol: Protocol between the RPi and the STM32.
+        """
+        if orchestrator not in ORCHESTRATORS:
+            raise ValueError(f"Unknown orchestrator {orchestrator}, expected one of {ORCHESTRATORS}")
+        self.orchestrator = orchestrator
+        self.timeline = Timeline()
+        self.stm = STM32Simulator(protocol, execute_time=motion_time, timeline=self.timeline)
+        self.api = StubAPIServer(commands, inference_time=inference_time, timeline=self.timeline)
+        self.rpi = self._build(protocol, capture_time)
+        # Listening straight away, so that the simulated tablet can connect as soon as the RPi starts
+        self.android = AndroidClient(self.rpi.android_link.transport.address, timeline=self.timeline)
+
+    def _build(self, protocol: str, capture_time: float):
+        """Creates the orchestrator, with the simulated components in place of the hardware"""
+        # Imported here, as each orchestrator pulls in its own dependencies
+        if self.orchestrator == "task1":
+            from task1 import RaspberryPi
+            rpi = RaspberryPi()
+        elif self.orchestrator == "task1-async":
+            from task1_async import AsyncRaspberryPi
+            rpi = AsyncRaspberryPi()
+        else:
+            from task2 import RaspberryPi
+            rpi = RaspberryPi()
+
+        rpi.android_link = AndroidLink(TCPTransport("127.0.0.1", 0))
+        rpi.stm_link.port = self.stm.port
+        rpi.stm_link.protocol = protocol
+        # The dispatcher picked its retries for the protocol of the settings when it was built
+        rpi.dispatcher.ack_retries = STM_ACK_RETRIES if protocol == "binary" else 0
+        rpi.api = APIClient(self.api.host, self.api.port)
+        # The camera service was never started, only its frame ring needs releasing
+        rpi.camera.ring.close()
+        rpi.camera = FakeCamera(capture_time)
+        rpi.image_recognizer.api = rpi.api
+        rpi.image_recognizer.camera = rpi.camera
+        return rpi
+
+    def run(self, timeout: float = 60) -> bool:
+        """
+        Starts the orchestrator, sets the obstacles from the tablet and starts the robot, then waits until the
+        images are stitched at the end of the path.
+        :param timeout: Maximum time to wait for each step in seconds.
+        :return: True if the run finished, False on timeout.
+        """
+        self.stm.start()
+        self.api.start()
+        threading.Thread(target=self.rpi.start, daemon=True).start()
+        self.android.connect()
+        if self.timeline.wait_for("android", "recv", "info:Robot is ready!", timeout) is None:
+            return False
+
+        # Task 2 has no obstacles to set, its path is fixed
+        if self.orchestrator != "task2":
+            self.android.send("obstacles", {"obstacles": obstacles_for(self.api.commands), "mode": "0"})
+            ready = "info:Commands and path received Algo API. Robot is ready to move."
+            if self.timeline.wait_for("android", "recv", ready, timeout) is None:
+                return False
+
+        self.android.send("control", "start")
+        return self.timeline.wait_for("api", "response", "/stitch", timeout) is not None
+
+    def stop(self):
+        """Stops the orchestrator processes and the simulated components"""
+        for process in multiprocessing.active_children():
+            process.terminate()
+            process.join()
+        self.rpi.manager.shutdown()
+        self.android.disconnect()
+        self.api.stop()
+        self.stm.stop()
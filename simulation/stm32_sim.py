@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Pure-Python stand-in for the STM32, for running the RPi without the robot.
+
+The simulator sits on the master side of a pseudo-terminal, and the RPi opens the slave side as its serial port.
+It acknowledges every command it receives, in either protocol of STMLink, after an optional execution time and the
+time the bytes would take on the wire at `BAUD_RATE`. To try it by hand:
+
+    python3 -m simulation.stm32_sim [ascii|binary]
+"""
+import os
+import pty
+import sys
+import threading
+import time
+import tty
+from typing import List, Optional, Tuple
+from communication.protocol import OPCODES, FrameDecoder, encode
+from settings import BAUD_RATE
+from simulation.timeline import Timeline
+
+# Length of an ASCII command, e.g. `FW10`
+ASCII_COMMAND_SIZE = 4
+
+
+def open_pty() -> Tuple[int, str]:
+    """
+    Opens a pseudo-terminal in raw mode, so that the bytes written to it are passed through unchanged.
+    :return: File descriptor of the master side, and path of the slave side to open as the serial port.
+    """
+    master, slave = pty.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    path = os.ttyname(slave)
+    # Keep the slave open, so that the master does not read EOF before the RPi opens it
+    return master, path
+
+
+class STM32Simulator:
+    """
+    Simulated STM32 that acknowledges commands over a pseudo-terminal.
+    """
+
+    def __init__(self, protocol: str = "ascii", execute_time: float = 0.0, baud_rate: Optional[int] = BAUD_RATE,
+                 timeline: Optional[Timeline] = None):
+        """
+        Constructor for STM32Simulator.
+        :param protocol: "ascii" or "binary", as in STMLink.
+        :param execute_time: Seconds that every command takes to carry out before it is acknowledged, i.e. the
+            time the robot takes to move.
+        :param baud_rate: Baud rate to simulate the wire delay of, None for no delay.
+        :param timeline: Timeline to record every command received and ACK sent on.
+        """
+        if protocol not in ("ascii", "binary"):
+            raise ValueError(f"Unknown STM32 protocol: {protocol}")
+        self.protocol = protocol
+        self.execute_time = execute_time
+        self.baud_rate = baud_rate
+        self.timeline = timeline
+        self.master, self.port = open_pty()
+        self.received = 0
+        self.bytes_received = 0
+        self._buffer = bytearray()
+        self._decoder = FrameDecoder()
+        # Sequence number of the last command carried out in binary protocol, to acknowledge resends only once
+        self._last_seq = None
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """Starts acknowledging commands in a background thread"""
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the simulator and closes the pseudo-terminal"""
+        self._running = False
+        os.close(self.master)
+
+    def _run(self):
+        while self._running:
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                return
+            self.bytes_received += len(data)
+            self._wire_delay(len(data))
+            for command, seq in self._commands(data):
+                if seq is not None and seq == self._last_seq:
+                    # Resent by the RPi as its ACK was lost, so it is acknowledged again but not carried out
+                    self._reply(seq)
+                    self._record("duplicate", command)
+                    continue
+                self._last_seq = seq
+                self.received += 1
+                self._record("command", command)
+                if self.execute_time:
+                    time.sleep(self.execute_time)
+                self._reply(seq)
+                self._record("ack", command)
+
+    def _commands(self, data: bytes) -> List[Tuple[str, Optional[int]]]:
+        """Returns the commands completed by the data, with their sequence numbers, None for ASCII commands"""
+        if self.protocol == "binary":
+            return [(frame.command, frame.seq) for frame in self._decoder.feed(data)
+                    if frame.opcode != OPCODES["ACK"]]
+        self._buffer += data
+        commands = []
+        while len(self._buffer) >= ASCII_COMMAND_SIZE:
+            commands.append((self._buffer[:ASCII_COMMAND_SIZE].decode("utf-8", errors="replace"), None))
+            del self._buffer[:ASCII_COMMAND_SIZE]
+        return commands
+
+    def _reply(self, seq: Optional[int]):
+        reply = b"ACK\n" if seq is None else encode("ACK", seq)
+        self._wire_delay(len(reply))
+        os.write(self.master, reply)
+
+    def _record(self, name: str, command: str):
+        if self.timeline is not None:
+            self.timeline.record("stm", name, command)
+
+    def _wire_delay(self, size: int):
+        """Sleeps for the time that the bytes take on the wire, at 10 bits per byte"""
+        if self.baud_rate:
+            time.sleep(size * 10 / self.baud_rate)
+
+
+if __name__ == "__main__":
+    simulator = STM32Simulator(sys.argv[1] if len(sys.argv) > 1 else "ascii")
+    simulator.start()
+    print(f"Simulated STM32 ({simulator.protocol}) on {simulator.port}, press Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        simulator.stop()
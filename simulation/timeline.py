@@ -0,0 +1,73 @@
+import threading
+import time
+from typing import Iterator, List, NamedTuple, Optional
+
+
+class Event(NamedTuple):
+    """Something that a simulated component saw, at a time.monotonic() timestamp"""
+    time: float
+    source: str
+    name: str
+    detail: str
+
+
+class Timeline:
+    """
+    Events recorded by the simulated STM32, Android and API, in the order they happened.
+
+    The simulated components run as threads of the harness process, so they share one clock and one timeline,
+    while the RPi under test runs in its own processes and is only seen through them.
+    """
+
+    def __init__(self):
+        self._events: List[Event] = []
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def record(self, source: str, name: str, detail: str = "") -> Event:
+        """
+        Records an event now.
+        :param source: Component that saw the event, e.g. "stm".
+        :param name: Name of the event, e.g. "command".
+        :param detail: Details of the event, e.g. the command.
+        :return: The recorded event.
+        """
+        event = Event(time.monotonic(), source, name, detail)
+        with self._changed:
+            self._events.append(event)
+            self._changed.notify_all()
+        return event
+
+    def events(self, source: Optional[str] = None, name: Optional[str] = None) -> List[Event]:
+        """
+        Returns the events recorded so far, optionally only those of a source and name.
+        :param source: Component to filter on, None for all.
+        :param name: Event name to filter on, None for all.
+        :return: Matching events, oldest first.
+        """
+        with self._lock:
+            return [event for event in self._events
+                    if (source is None or event.source == source) and (name is None or event.name == name)]
+
+    def wait_for(self, source: str, name: str, detail: Optional[str] = None,
+                 timeout: Optional[float] = None) -> Optional[Event]:
+        """
+        Waits until an event is recorded, or returns it straight away if it already was.
+        :param source: Component of the event.
+        :param name: Name of the event.
+        :param detail: Details of the event, None for any.
+        :param timeout: Maximum time to wait in seconds, None to wait forever.
+        :return: The first matching event, or None on timeout.
+        """
+        def find() -> Optional[Event]:
+            for event in self._events:
+                if event.source == source and event.name == name and detail in (None, event.detail):
+                    return event
+            return None
+
+        with self._changed:
+            self._changed.wait_for(lambda: find() is not None, timeout)
+            return find()
+
+    def __iter__(self) -> Iterator[Event]:
+        return iter(self.events())
@@ -1,19 +1,30 @@
 #!/usr/bin/env python3
 import json
-import io
-import picamera
 import queue
 import signal
+import sys
+import threading
 import time
-from multiprocessing import Process, Manager
-from typing import Optional
+from multiprocessing import Process
+from typing import List, Optional, Tuple
 import os
 import requests
-from communication.android import AndroidLink, AndroidMessage
-from communication.stm32 import STMLink
+from camera import CameraService
+from communication.android import AndroidLink, AndroidMessage, AndroidMixin, AndroidOutbox, SocketHandoff
+from communication.api import APIClient
+from communication.stm32 import STMLink, STMMessage
+from compaction import compact_path
 from consts import SYMBOL_MAP
-from logger import prepare_logger
-from settings import API_IP, API_PORT
+from dispatcher import Ack, CommandDispatcher
+from imgrec import ImageRecognizer
+from ipc import create_manager
+from logger import prepare_logger, start_segment
+from metrics import Gauge, MetricsServer, dump_on_signal, metrics
+from settings import COMPACT_COMMANDS, METRICS_PORT, SNAP_ASYNC, SNAP_MODE, STM_READER_THREAD
+
+# Commands that are sent straight to STM32
+STM32_PREFIXES = ("FS", "BS", "FW", "BW", "FL", "FR", "BL",
+                  "BR", "TL", "TR", "A", "C", "DT", "STOP", "ZZ", "RS")
 
 
 class PiAction:
@@ -28,6 +39,8 @@ class PiAction:
         """
         self._cat = cat
         self._value = value
+        # Monotonic time at which the action was created, to measure how long it waits to be carried out
+        self.created = time.monotonic()
 
     @property
     def cat(self):
@@ -38,27 +51,37 @@ class PiAction:
         return self._value
 
 
-class RaspberryPi:
+class RaspberryPi(AndroidMixin):
     """
     Class that represents the Raspberry Pi.
     """
 
-    def __init__(self):
+    def __init__(self, manager=None):
         """
         Initializes the Raspberry Pi.
+        :param manager: Manager to create the shared queues, locks and state with, by default one for IPC_BACKEND.
         """
         self.logger = prepare_logger()
         self.android_link = AndroidLink()
         self.stm_link = STMLink()
+        self.api = APIClient()
+        self.camera = CameraService()
+        self.image_recognizer = ImageRecognizer(self.camera, self.api)
 
-        self.manager = Manager()
+        self.manager = create_manager() if manager is None else manager
 
         self.android_dropped = self.manager.Event()
         self.unpause = self.manager.Event()
+        # Pass the connection to Android on to the child processes using it when Android reconnects
+        self.android_recv_handoff = SocketHandoff()
+        self.android_send_handoff = SocketHandoff()
 
-        self.movement_lock = self.manager.Lock()
+        # Sends the commands to STM32 and tracks them until they are acknowledged
+        self.dispatcher = self.create_dispatcher()
 
         self.android_queue = self.manager.Queue()  # Messages to send to Android
+        # Messages waiting in android_sender, created here so that the metrics endpoint can read its counters
+        self.android_outbox = AndroidOutbox()
         # Messages that need to be processed by RPi
         self.rpi_action_queue = self.manager.Queue()
         # Messages that need to be processed by STM32, as well as snap commands
@@ -71,12 +94,24 @@ class RaspberryPi:
         self.proc_android_sender = None
         self.proc_command_follower = None
         self.proc_rpi_action = None
-        self.rs_flag = False
+        # Serves the state of the orchestrator to a local scraper during the run
+        self.metrics_server = None
+        # Number of the next command sent to STM32
+        self.instruction = 1
         self.success_obstacles = self.manager.list()
         self.failed_obstacles = self.manager.list()
         self.obstacles = self.manager.dict()
         self.current_location = self.manager.dict()
         self.failed_attempt = False
+        # Background image-rec threads started by snap_and_rec in the rpi_action process
+        self.pending_recognitions = []
+
+    def create_dispatcher(self) -> CommandDispatcher:
+        """
+        Creates the dispatcher that sends the commands to STM32, once the link and the manager exist
+        :return: the dispatcher
+        """
+        return CommandDispatcher(self.stm_link)
 
     def start(self):
         """Starts the RPi orchestrator"""
@@ -87,6 +122,7 @@ class RaspberryPi:
             self.android_queue.put(AndroidMessage(
                 'info', 'You are connected to the RPi!'))
             self.stm_link.connect()
+            self.camera.start()
             self.check_api()
 
             # Define child processes
@@ -104,12 +140,14 @@ class RaspberryPi:
             self.proc_rpi_action.start()
 
             self.logger.info("Child Processes started")
+            # After the child processes are forked, so that they do not inherit its socket
+            self.start_metrics_server()
 
             ### Start up complete ###
 
             # Send success message to Android
             self.android_queue.put(AndroidMessage('info', 'Robot is ready!'))
-            self.android_queue.put(AndroidMessage('mode', 'path'))
+            self.android_queue.put(AndroidMessage('mode', self.android_mode()))
             self.reconnect_android()
 
         except KeyboardInterrupt:
@@ -121,222 +159,225 @@ class RaspberryPi:
 
     def stop(self):
         """Stops all processes on the RPi and disconnects gracefully with Android and STM32"""
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
         self.android_link.disconnect()
         self.stm_link.disconnect()
+        self.camera.stop()
+        self.manager.shutdown()
         self.logger.info("Program exited!")
 
-    def reconnect_android(self):
-        """Handles the reconnection to Android in the event of a lost connection."""
-        self.logger.info("Reconnection handler is watching...")
-
-        while True:
-            # Wait for android connection to drop
-            self.android_dropped.wait()
-
-            self.logger.error("Android link is down!")
-
-            # Kill child processes
-            self.logger.debug("Killing android child processes")
-            self.proc_android_sender.kill()
-            self.proc_recv_android.kill()
-
-            # Wait for the child processes to finish
-            self.proc_android_sender.join()
-            self.proc_recv_android.join()
-            assert self.proc_android_sender.is_alive() is False
-            assert self.proc_recv_android.is_alive() is False
-            self.logger.debug("Android child processes killed")
-
-            # Clean up old sockets
-            self.android_link.disconnect()
-
-            # Reconnect
-            self.android_link.connect()
-
-            # Recreate Android processes
-            self.proc_recv_android = Process(target=self.recv_android)
-            self.proc_android_sender = Process(target=self.android_sender)
-
-            # Start previously killed processes
-            self.proc_recv_android.start()
-            self.proc_android_sender.start()
-
-            self.logger.info("Android child processes restarted")
-            self.android_queue.put(AndroidMessage(
-                "info", "You are reconnected!"))
-            self.android_queue.put(AndroidMessage('mode', 'path'))
-
-            self.android_dropped.clear()
-
-    def recv_android(self) -> None:
+    def start_metrics_server(self):
+        """Serves the gauges of gauges() and the timings of the hot path at /metrics, unless METRICS_PORT is None"""
+        if METRICS_PORT is None:
+            return
+        try:
+            self.metrics_server = MetricsServer(self.gauges)
+            self.metrics_server.start()
+            self.logger.info(f"Serving metrics on port {self.metrics_server.port}")
+        except OSError as e:
+            # The run goes on without them, e.g. when another orchestrator still holds the port
+            self.metrics_server = None
+            self.logger.warning(f"Could not serve metrics on port {METRICS_PORT}: {e}")
+
+    def gauges(self) -> List[Gauge]:
         """
-        [Child Process] Processes the messages received from Android
+        Reads the state of the orchestrator for the metrics endpoint, from the thread serving it.
+        :return: The gauges.
         """
-        while True:
-            msg_str: Optional[str] = None
-            try:
-                msg_str = self.android_link.recv()
-            except OSError:
-                self.android_dropped.set()
-                self.logger.debug("Event set: Android connection dropped")
+        return [
+            ("rpi_queue_depth", "Items waiting in each queue", {"queue": "command"}, self.command_queue.qsize()),
+            ("rpi_queue_depth", "Items waiting in each queue", {"queue": "android"}, self.android_queue.qsize()),
+            ("rpi_queue_depth", "Items waiting in each queue", {"queue": "rpi_action"}, self.rpi_action_queue.qsize()),
+            ("rpi_queue_depth", "Items waiting in each queue", {"queue": "path"}, self.path_queue.qsize()),
+            ("rpi_commands_in_flight", "Commands sent to STM32 and not acknowledged yet", {},
+             self.dispatcher.in_flight),
+            ("rpi_dispatcher_held", "Whether the dispatcher is held, e.g. during a capture", {},
+             int(self.dispatcher.held)),
+            ("rpi_last_ack_seconds", "Time from the last command acknowledged being sent to its ACK", {},
+             metrics.last("ack_wait")),
+            *self.android_gauges(),
+        ]
+
+    def handle_android_message(self, msg_str: str) -> None:
+        """
+        Queues the action requested by a message from Android
+        :param msg_str: the JSON message received from Android
+        """
+        message: dict = json.loads(msg_str)
 
-            if msg_str is None:
-                continue
-            
-            message: dict = json.loads(msg_str)
+        ## Command: Set obstacles ##
+        if message["cat"] == "obstacles":
+            self.rpi_action_queue.put(PiAction(**message))
+            self.logger.debug(f"Set obstacles PiAction added to queue: {message}")
 
-            ## Command: Set obstacles ##
-            if message["cat"] == "obstacles":
+        ## Command: Start Moving ##
+        elif message["cat"] == "control":
+            if message["value"] == "start":
                 self.rpi_action_queue.put(PiAction(**message))
-                self.logger.debug(f"Set obstacles PiAction added to queue: {message}")
-
-            ## Command: Start Moving ##
-            elif message["cat"] == "control":
-                if message["value"] == "start":
-                    self.rpi_action_queue.put(PiAction(**message))
-                    self.logger.debug(
-                        f"Control start PiAction added to queue: {message}"
-                    )
+                self.logger.debug(
+                    f"Control start PiAction added to queue: {message}"
+                )
 
     def recv_stm(self) -> None:
         """
-        [Child Process] Receive acknowledgement messages from STM32, and release the movement lock
+        [Child Process] Receive acknowledgement messages from STM32, and pass them to the command dispatcher
         """
+        if STM_READER_THREAD:
+            self.stm_link.start_reader()
         while True:
-            message: str = self.stm_link.recv()
-            if message.startswith("ACK"):
-                if self.rs_flag == False:
-                    self.rs_flag = True
-                    self.logger.debug("ACK for RS00 from STM32 received.")
-                    self.unpause.set()
-                    continue
-                try:
-                    self.movement_lock.release()
-                    try:
-                        self.retrylock.release()
-                    except:
-                        pass
-                    self.logger.debug(
-                        "ACK from STM32 received, movement lock released.")
-
-                    cur_location = self.path_queue.get_nowait()
-                    print(f"Current Location from path queue {cur_location}")
-                    self.current_location['x'] = cur_location['x']
-                    self.current_location['y'] = cur_location['y']
-                    self.current_location['d'] = cur_location['direction']
-                    self.logger.info(
-                        f"self.current_location = {self.current_location}")
-                    self.android_queue.put(AndroidMessage('location', {
-                        "x": cur_location['x'],
-                        "y": cur_location['y'],
-                        "d": cur_location['direction'],
-                    }))
-
-                except Exception as e:
-                    # self.logger.warning("Tried to release a released lock!")
-                    self.logger.error(e)
-            else:
-                self.logger.warning(
-                    f"Ignored unknown message from STM: {message}")
+            # Wakes up at least every second to resend or give up on commands whose ACK is overdue
+            message: Optional[STMMessage] = self.stm_link.recv(timeout=1)
+            if message is not None:
+                self.handle_stm_message(message)
+            ack = self.dispatcher.expire()
+            if ack is not None:
+                self.handle_given_up(ack)
+
+    def handle_stm_message(self, message: STMMessage) -> None:
+        """
+        Marks the command that an ACK belongs to as acknowledged when STM32 sends one
+        :param message: the message received from STM32
+        """
+        if message.startswith("ACK"):
+            for ack in self.dispatcher.ack(message.seq):
+                self.handle_ack(ack)
+        else:
+            self.logger.warning(
+                f"Ignored unknown message from STM: {message}")
 
-    def android_sender(self) -> None:
+    def handle_ack(self, ack: Ack) -> None:
         """
-        [Child process] Responsible for retrieving messages from android_queue and sending them over the Android link. 
+        Starts the path once the gyro is reset, or forwards the location reached by an acknowledged command to
+        Android
+        :param ack: the acknowledged command
         """
-        while True:
-            # Retrieve from queue
-            try:
-                message: AndroidMessage = self.android_queue.get(timeout=0.5)
-            except queue.Empty:
-                continue
+        if ack.command == "RS00":
+            self.logger.debug("ACK for RS00 from STM32 received.")
+            self.unpause.set()
+            return
 
-            try:
-                self.android_link.send(message)
-            except OSError:
-                self.android_dropped.set()
-                self.logger.debug("Event set: Android dropped")
+        try:
+            cur_location = self.path_queue.get_nowait()
+        except queue.Empty:
+            self.logger.warning(f"No location in path queue for {ack.command}")
+            return
+        print(f"Current Location from path queue {cur_location}")
+        # Single update, so that other processes never see a half-updated location
+        self.current_location.update(
+            x=cur_location['x'], y=cur_location['y'], d=cur_location['direction'])
+        self.logger.info(
+            f"self.current_location = {self.current_location}")
+        self.android_queue.put(AndroidMessage('location', {
+            "x": cur_location['x'],
+            "y": cur_location['y'],
+            "d": cur_location['direction'],
+        }))
+
+    def handle_given_up(self, ack: Ack) -> None:
+        """
+        Drops the location of a command given up on without an ACK, so that the path queue stays in step with the
+        commands, but does not report it, since the robot may not have reached it
+        :param ack: the command given up on
+        """
+        if ack.command == "RS00":
+            self.logger.error("Gyro reset was not confirmed by STM32, not starting the path")
+            self.android_queue.put(AndroidMessage("error", "STM32 did not confirm the gyro reset."))
+            return
+
+        try:
+            location = self.path_queue.get_nowait()
+        except queue.Empty:
+            location = None
+        self.logger.error(f"Location {location} of {ack.command} (#{ack.seq}) is not confirmed, not reporting it")
+        self.android_queue.put(AndroidMessage("error", f"STM32 did not confirm {ack.command}."))
 
     def command_follower(self) -> None:
         """
         [Child Process] 
         """
-        instruction = 1
         while True:
             # Retrieve next movement command
             command: str = self.command_queue.get()
             self.logger.debug("wait for unpause")
             # Wait for unpause event to be true [Main Trigger]
+            self.unpause.wait()
+
+            self.dispatch_command(command)
+
+    def dispatch_command(self, command: str) -> None:
+        """
+        Carries out a command from the algo: movement commands are sent to STM32 once the send window has room,
+        snap commands hold the dispatcher and are passed on to rpi_action, and FIN ends the path
+        :param command: the command to carry out
+        """
+        # STM32 Commands - Send straight to STM32
+        if command.startswith(STM32_PREFIXES):
+            if not self.stm_link.accepts(command):
+                self.logger.error(f"Skipped {command}, it cannot be sent in {self.stm_link.protocol} protocol")
+                self.android_queue.put(AndroidMessage("error", f"Skipped unsupported command {command}"))
+                return
             try:
-                self.logger.debug("wait for retrylock")
-                self.retrylock.acquire()
-                self.retrylock.release()
-            except:
-                self.logger.debug("wait for unpause")
-                self.unpause.wait()
-            self.logger.debug("wait for movelock")
-            # Acquire lock first (needed for both moving, and snapping pictures)
-            self.movement_lock.acquire()
-
-            # STM32 Commands - Send straight to STM32
-            stm32_prefixes = ("FS", "BS", "FW", "BW", "FL", "FR", "BL",
-                              "BR", "TL", "TR", "A", "C", "DT", "STOP", "ZZ", "RS")
-            if command.startswith(stm32_prefixes):
-                self.stm_link.send(command)
-                self.logger.debug(f"Sending to STM32: {command}")
-                self.logger.info(f"Command: {command}; instruction number: {instruction}")
-                instruction+=1
-
-            # Snap command
-            elif command.startswith("SNAP"):
-                obstacle_id_with_signal = command.replace("SNAP", "")
-
-                self.rpi_action_queue.put(
-                   PiAction(cat="snap", value=obstacle_id_with_signal))
-
-            # End of path
-            elif command == "FIN":
-                self.unpause.clear()
-                self.movement_lock.release()
-                self.logger.info("Commands queue finished.")
-                self.android_queue.put(AndroidMessage(
-                    "info", "Commands queue finished."))
-                self.android_queue.put(AndroidMessage("status", "finished"))
-                self.rpi_action_queue.put(PiAction(cat="stitch", value=""))
-                
-                """
-                Retry algo path again, not required
-
-
-                self.logger.info(
-                    f"At FIN, self.failed_obstacles: {self.failed_obstacles}")
-                self.logger.info(
-                    f"At FIN, self.current_location: {self.current_location}")
-                if len(self.failed_obstacles) != 0 and self.failed_attempt == False:
-
-                    new_obstacle_list = list(self.failed_obstacles)
-                    for i in list(self.success_obstacles):
-                        # {'x': 5, 'y': 11, 'id': 1, 'd': 4}
-                        i['d'] = 8
-                        new_obstacle_list.append(i)
-
-                    self.logger.info("Attempting to go to failed obstacles")
-                    self.failed_attempt = True
-                    self.request_algo({'obstacles': new_obstacle_list, 'mode': '0'},
-                                      self.current_location['x'], self.current_location['y'], self.current_location['d'], retrying=True)
-                    self.retrylock = self.manager.Lock()
-                    self.movement_lock.release()
-                    continue
-
-                self.unpause.clear()
-                self.movement_lock.release()
-                self.logger.info("Commands queue finished.")
-                self.android_queue.put(AndroidMessage(
-                    "info", "Commands queue finished."))
-                self.android_queue.put(AndroidMessage("status", "finished"))
-                self.rpi_action_queue.put(PiAction(cat="stitch", value=""))
+                self.dispatcher.send(command)
+            except (ValueError, OSError) as e:
+                # Skip the command rather than bring down command_follower
+                self.logger.error(f"Failed to send {command} to STM32: {e}")
+                return
+            self.logger.debug(f"Sending to STM32: {command}")
+            self.logger.info(f"Command: {command}; instruction number: {self.instruction}")
+            self.instruction += 1
+
+        # Snap command
+        elif command.startswith("SNAP"):
+            obstacle_id_with_signal = command.replace("SNAP", "")
+
+            # No command is sent until snap_and_rec releases the dispatcher
+            self.dispatcher.hold()
+            self.rpi_action_queue.put(
+               PiAction(cat="snap", value=obstacle_id_with_signal))
+
+        # End of path
+        elif command == "FIN":
+            self.dispatcher.wait_idle()
+            self.unpause.clear()
+            self.logger.info("Commands queue finished.")
+            self.android_queue.put(AndroidMessage(
+                "info", "Commands queue finished."))
+            self.android_queue.put(AndroidMessage("status", "finished"))
+            self.rpi_action_queue.put(PiAction(cat="stitch", value=""))
+            self.logger.info(f"Timings of the run:\n{metrics.summary()}")
+            
             """
-            else:
-                raise Exception(f"Unknown command: {command}")
+            Retry algo path again, not required
+
+
+            self.logger.info(
+                f"At FIN, self.failed_obstacles: {self.failed_obstacles}")
+            self.logger.info(
+                f"At FIN, self.current_location: {self.current_location}")
+            if len(self.failed_obstacles) != 0 and self.failed_attempt == False:
+
+                new_obstacle_list = list(self.failed_obstacles)
+                for i in list(self.success_obstacles):
+                    # {'x': 5, 'y': 11, 'id': 1, 'd': 4}
+                    i['d'] = 8
+                    new_obstacle_list.append(i)
+
+                self.logger.info("Attempting to go to failed obstacles")
+                self.failed_attempt = True
+                self.request_algo({'obstacles': new_obstacle_list, 'mode': '0'},
+                                  self.current_location['x'], self.current_location['y'], self.current_location['d'], retrying=True)
+                return
+
+            self.unpause.clear()
+            self.logger.info("Commands queue finished.")
+            self.android_queue.put(AndroidMessage(
+                "info", "Commands queue finished."))
+            self.android_queue.put(AndroidMessage("status", "finished"))
+            self.rpi_action_queue.put(PiAction(cat="stitch", value=""))
+        """
+        else:
+            raise Exception(f"Unknown command: {command}")
 
     def rpi_action(self):
         """
@@ -348,41 +389,63 @@ class RaspberryPi:
                 f"PiAction retrieved from queue: {action.cat} {action.value}"
             )
 
-            if action.cat == "obstacles":
-                for obs in action.value["obstacles"]:
-                    self.obstacles[obs["id"]] = obs
-                self.request_algo(action.value)
-            elif action.cat == "snap":
-                self.snap_and_rec(obstacle_id_with_signal=action.value)
-            elif action.cat == "stitch":
-                self.request_stitch()
-            elif action.cat == "control" and action.value == "start":
-                # Check API
-                if not self.check_api():
-                    self.logger.error("API is down! Start command aborted.")
-                    self.android_queue.put(
-                        AndroidMessage("error", "API is down, start command aborted.")
-                    )
+            self.handle_action(action)
 
-                # Commencing path following
-                if not self.command_queue.empty():
-                    self.logger.info("Gryo reset!")
-                    self.stm_link.send("RS00")
-                    # Main trigger to start movement self.unpause.set() will be sent when ACK for RS is received in recv_stm#
-                    self.logger.info("Start command received, starting robot on path!")
-                    self.android_queue.put(
-                        AndroidMessage("info", "Starting robot on path!")
-                    )
-                    self.android_queue.put(AndroidMessage("status", "running"))
-                else:
-                    self.logger.warning(
-                        "The command queue is empty, please set obstacles."
-                    )
-                    self.android_queue.put(
-                        AndroidMessage(
-                            "error", "Command queue is empty, did you set obstacles?"
-                        )
+    def handle_action(self, action: PiAction) -> None:
+        """
+        Carries out an action requested by Android or by the command follower
+        :param action: the action to carry out
+        """
+        metrics.record("action_queue_wait", time.monotonic() - action.created)
+        if action.cat == "obstacles":
+            # New obstacles start a new run, which is logged to a segment of its own, and timed from scratch
+            start_segment("run")
+            metrics.reset()
+            for obs in action.value["obstacles"]:
+                self.obstacles[obs["id"]] = obs
+            self.request_algo(action.value)
+        elif action.cat == "snap":
+            self.snap_and_rec(obstacle_id_with_signal=action.value)
+        elif action.cat == "stitch":
+            self.stitch_images()
+        elif action.cat == "control" and action.value == "start":
+            # Check API
+            if not self.check_api():
+                self.logger.error("API is down! Start command aborted.")
+                self.android_queue.put(
+                    AndroidMessage("error", "API is down, start command aborted.")
+                )
+
+            # Commencing path following
+            if not self.command_queue.empty():
+                self.logger.info("Gryo reset!")
+                self.dispatcher.send("RS00")
+                # Main trigger to start movement self.unpause.set() will be sent when ACK for RS is received in recv_stm#
+                self.logger.info("Start command received, starting robot on path!")
+                self.android_queue.put(
+                    AndroidMessage("info", "Starting robot on path!")
+                )
+                self.android_queue.put(AndroidMessage("status", "running"))
+            else:
+                self.logger.warning(
+                    "The command queue is empty, please set obstacles."
+                )
+                self.android_queue.put(
+                    AndroidMessage(
+                        "error", "Command queue is empty, did you set obstacles?"
                     )
+                )
+
+    def stitch_images(self) -> None:
+        """
+        Requests the stitched image once the images still being recognized in the background are done
+        """
+        for recognition in self.pending_recognitions:
+            recognition.join()
+        self.pending_recognitions.clear()
+        self.request_stitch()
+        # The run ends once the images are stitched
+        start_segment("idle")
 
     def snap_and_rec(self, obstacle_id_with_signal: str) -> None:
         """
@@ -397,165 +460,55 @@ class RaspberryPi:
         self.android_queue.put(AndroidMessage("info", f"Capturing image for obstacle id: {obstacle_id}"))
 
         #capture an image
-        image_capture_count = 0
         start= time.time()
 
-        stream1: bytes = None
-        stream2: bytes = None
-        stream3: bytes = None
-
-        with picamera.PiCamera() as camera:
-            camera.start_preview()
-            camera.vflip = True  # Vertical flip
-            camera.hflip = True  # Horizontal flip
-            # camera.iso = 100
-            # camera.shutter_speed = 200000
-            # camera.brightness = 40
-            # camera.contrast = 90
-            # camera.framerate = 70
-            time.sleep(1)
-
-            while True:
-                image_capture_count += 1
-
-                # call image-rec API endpoint
-         
-                print(f"Image Capture Count: {image_capture_count}")
-                self.logger.debug("Requesting from image API")
-
-                # notify android
-                self.android_queue.put(AndroidMessage("info", "Image captured. Calling image-rec api..."))
-                self.logger.info("Image captured. Calling image-rec api...")
-
-                # Reset the stream before capturing a new image
-                url = f"http://{API_IP}:{API_PORT}/image"                
-                if image_capture_count == 1:
-                    stream1=io.BytesIO()
-                    self.logger.info("Recapturing with same shutter speed...")
-                    camera.capture(stream1,format='jpeg')
-                    image_data1 = stream1.getvalue()
-                    filename = f"{int(time.time())}_{obstacle_id}_{signal}.jpg"
-                    response = requests.post(url, files={"file": (filename, image_data1)})
-                    if response.status_code != 200:
-                        self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
-                        #self.android_queue.put(AndroidMessage(
-                            # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
-                        return
-                    results = json.loads(response.content)
-                    if results['image_id'] != 'NA':
-                        break
-
-                elif image_capture_count == 2:
-                    # Prepare image to be converted to gray-scale
-                    imageToConvert = image_data1
-                    url = f"http://{API_IP}:{API_PORT}/image"
-                    filename = f"{int(time.time())}_{obstacle_id}_{signal}_grayDuplicate.jpg"
-                    response = requests.post(url, files={"file": (filename, imageToConvert)})
-                    if response.status_code != 200:
-                        self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
-                        #self.android_queue.put(AndroidMessage(
-                            # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
-                        return
-                    results = json.loads(response.content)
-                    if results['image_id'] != 'NA':
-                        break
-
-                elif image_capture_count == 3:
-                    stream2 = io.BytesIO()
-                    camera.brightness = 30
-                    camera.contrast = 100
-                    camera.framerate = 70
-                    self.logger.info("Recapturing with lower brightness...")
-                    camera.capture(stream2,format='jpeg')
-                    image_data2 = stream2.getvalue()
-                    url = f"http://{API_IP}:{API_PORT}/image"
-                    response = requests.post(url, files={"file": (filename, image_data2)})
-                    if response.status_code != 200:
-                        self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
-                        #self.android_queue.put(AndroidMessage(
-                            # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
-                        return
-                    results = json.loads(response.content)
-                    if results['image_id'] != 'NA':
-                        break
-
-                elif image_capture_count == 4:
-                    stream3 = io.BytesIO()
-                    camera.brightness = 60
-                    camera.contrast = 90
-                    self.logger.info("Recapturing with higher brightness...")
-                    camera.capture(stream3,format='jpeg')
-                    image_data3 = stream3.getvalue()
-                    url = f"http://{API_IP}:{API_PORT}/image"
-                    response = requests.post(url, files={"file": (filename, image_data3)})
-                    if response.status_code != 200:
-                        self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
-                        #self.android_queue.put(AndroidMessage(
-                            # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
-                        return
-                    results = json.loads(response.content)
-                    if results['image_id'] != 'NA':
-                        break
-                    
-                elif image_capture_count == 5:
-                    url = f"http://{API_IP}:{API_PORT}/image"
-                    print(f"{url}")
-                    response = requests.post(url, files={"file": (filename, image_data1)})
-                    if response.status_code != 200:
-                        self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
-                        #self.android_queue.put(AndroidMessage(
-                            # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
-                        return
-                    results = json.loads(response.content)
-                    
-                    if results['image_id'] != 'NA':
-                        break
-
-                elif image_capture_count == 6:
-                    url = f"http://{API_IP}:{API_PORT}/image"
-                    response = requests.post(url, files={"file": (filename, image_data2)})
-                    if response.status_code != 200:
-                        self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
-                        #self.android_queue.put(AndroidMessage(
-                            # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
-                        return
-                    results = json.loads(response.content)
-                    if results['image_id'] != 'NA':
-                        break
-                
-                elif image_capture_count == 7:
-                    url = f"http://{API_IP}:{API_PORT}/image"
-                    response = requests.post(url, files={"file": (filename, image_data3)})
-                    if response.status_code != 200:
-                        self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
-                        self.android_queue.put(AndroidMessage(
-                             "error", "Something went wrong when requesting path from image-rec API. Please try again."))
-                        return
-                    results = json.loads(response.content)
-                    if results['image_id'] != 'NA':
-                        break
-
-                # elif image_capture_count == 8:
-                #     url = f"http://{API_IP}:{API_PORT}/image3"
-                #     print(f"{url}")
-                #     response = requests.post(url, files={"file": (filename, gray_image)})
-                #     if response.status_code != 200:
-                #         self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
-                #         #self.android_queue.put(AndroidMessage(
-                #             # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
-                #         return
-                #     results = json.loads(response.content)
-                #     if results['image_id'] != 'NA':
-                #         break
-                
-                """
-                Retrying image capturing again using different configurations
-                """
-                if results['image_id'] != 'NA' or image_capture_count > 7:
-                    self.logger.info("Breaking out of snap_and_rec")
-                    break
-                self.logger.info(f"Image recognition results: {results}")
+        images = None
+        try:
+            if SNAP_ASYNC:
+                # The images outlive the camera's frame ring while the robot keeps snapping, so they are copied out
+                images = [(filename, bytes(image_data))
+                          for filename, image_data in self.image_recognizer.capture_bracket(obstacle_id, signal)]
+            else:
+                if SNAP_MODE == "bracket":
+                    results = self.image_recognizer.snap_bracket(obstacle_id, signal)
+                elif SNAP_MODE == "concurrent":
+                    results = self.image_recognizer.snap_concurrent(obstacle_id, signal)
+                else:
+                    results = self.snap_sequential(obstacle_id, signal)
+                if results is not None:
+                    self.report_rec_results(results, start)
+        except Exception as e:
+            self.logger.error(f"Snap for obstacle id {obstacle_id} failed: {e}")
+        finally:
+            # release dispatcher so that bot can continue moving, even if the snap failed
+            self.dispatcher.release()
+
+        if images is not None:
+            # The path was precomputed by the algo, so the robot can move on while the images are recognized
+            self.logger.info("Images captured, dispatcher released. Calling image-rec api in the background...")
+            recognition = threading.Thread(
+                target=self.recognize_in_background, args=(images, start), daemon=True)
+            recognition.start()
+            self.pending_recognitions.append(recognition)
+
+    def recognize_in_background(self, images: List[Tuple[str, bytes]], start: float) -> None:
+        """
+        [Background Thread] Sends the images captured by snap_and_rec for image-rec while the robot keeps moving
+        :param images: filename and JPEG image of each captured variant
+        :param start: time at which snap_and_rec started
+        """
+        results = self.image_recognizer.recognize_first(images)
+        if results is None:
+            self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
+            return
+        self.report_rec_results(results, start)
 
+    def report_rec_results(self, results: dict, start: float) -> None:
+        """
+        Records the obstacle as recognized or failed, and forwards the results to the android
+        :param results: the image-rec results
+        :param start: time at which snap_and_rec started
+        """
         self.logger.info(f"results: {results}")
         self.logger.info(f"self.obstacles: {self.obstacles}")
         self.logger.info(
@@ -578,12 +531,144 @@ class RaspberryPi:
         # Print total time taken to 1dp
         print(f"Total time taken: {round(time_taken,1)}")     
 
-        # release lock so that bot can continue moving
-        self.movement_lock.release()
-        try:
-           self.retrylock.release()
-        except:
-           pass
+    def snap_sequential(self, obstacle_id: str, signal: str) -> Optional[dict]:
+        """
+        Captures and sends images one at a time, retrying with different camera settings until the image is recognized.
+        :param obstacle_id: the current obstacle ID
+        :param signal: the position of the obstacle relative to the robot (L, C or R)
+        :return: the image-rec results, or None if the request to the image-rec API failed
+        """
+        image_capture_count = 0
+
+        image_data1: memoryview = None
+        image_data2: memoryview = None
+        image_data3: memoryview = None
+
+        while True:
+            image_capture_count += 1
+
+            # call image-rec API endpoint
+     
+            print(f"Image Capture Count: {image_capture_count}")
+            self.logger.debug("Requesting from image API")
+
+            # notify android
+            self.android_queue.put(AndroidMessage("info", "Image captured. Calling image-rec api..."))
+            self.logger.info("Image captured. Calling image-rec api...")
+
+            # Reset the stream before capturing a new image
+            if image_capture_count == 1:
+                self.logger.info("Recapturing with same shutter speed...")
+                image_data1 = self.camera.capture(signal=signal)
+                filename = f"{int(time.time())}_{obstacle_id}_{signal}.jpg"
+                response = self.api.post_file("/image", filename, image_data1)
+                if response.status_code != 200:
+                    self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
+                    #self.android_queue.put(AndroidMessage(
+                        # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
+                    return None
+                results = json.loads(response.content)
+                if results['image_id'] != 'NA':
+                    break
+
+            elif image_capture_count == 2:
+                # Prepare image to be converted to gray-scale
+                # When streaming, retry with the frame before the first one instead of resending the same image
+                imageToConvert = self.camera.recent(1) or image_data1
+                filename = f"{int(time.time())}_{obstacle_id}_{signal}_grayDuplicate.jpg"
+                response = self.api.post_file("/image", filename, imageToConvert)
+                if response.status_code != 200:
+                    self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
+                    #self.android_queue.put(AndroidMessage(
+                        # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
+                    return None
+                results = json.loads(response.content)
+                if results['image_id'] != 'NA':
+                    break
+
+            elif image_capture_count == 3:
+                self.logger.info("Recapturing with lower brightness...")
+                image_data2 = self.camera.capture(brightness=30, contrast=100, framerate=70, signal=signal)
+                response = self.api.post_file("/image", filename, image_data2)
+                if response.status_code != 200:
+                    self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
+                    #self.android_queue.put(AndroidMessage(
+                        # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
+                    return None
+                results = json.loads(response.content)
+                if results['image_id'] != 'NA':
+                    break
+
+            elif image_capture_count == 4:
+                self.logger.info("Recapturing with higher brightness...")
+                # Same framerate as the lower brightness capture, which the settings are no longer carried over from
+                image_data3 = self.camera.capture(brightness=60, contrast=90, framerate=70, signal=signal)
+                response = self.api.post_file("/image", filename, image_data3)
+                if response.status_code != 200:
+                    self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
+                    #self.android_queue.put(AndroidMessage(
+                        # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
+                    return None
+                results = json.loads(response.content)
+                if results['image_id'] != 'NA':
+                    break
+                
+            elif image_capture_count == 5:
+                response = self.api.post_file("/image", filename, image_data1)
+                if response.status_code != 200:
+                    self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
+                    #self.android_queue.put(AndroidMessage(
+                        # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
+                    return None
+                results = json.loads(response.content)
+                
+                if results['image_id'] != 'NA':
+                    break
+
+            elif image_capture_count == 6:
+                response = self.api.post_file("/image", filename, image_data2)
+                if response.status_code != 200:
+                    self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
+                    #self.android_queue.put(AndroidMessage(
+                        # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
+                    return None
+                results = json.loads(response.content)
+                if results['image_id'] != 'NA':
+                    break
+            
+            elif image_capture_count == 7:
+                response = self.api.post_file("/image", filename, image_data3)
+                if response.status_code != 200:
+                    self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
+                    self.android_queue.put(AndroidMessage(
+                         "error", "Something went wrong when requesting path from image-rec API. Please try again."))
+                    return None
+                results = json.loads(response.content)
+                if results['image_id'] != 'NA':
+                    break
+
+            # elif image_capture_count == 8:
+            #     url = f"http://{API_IP}:{API_PORT}/image3"
+            #     print(f"{url}")
+            #     response = requests.post(url, files={"file": (filename, gray_image)})
+            #     if response.status_code != 200:
+            #         self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
+            #         #self.android_queue.put(AndroidMessage(
+            #             # "error", "Something went wrong when requesting path from image-rec API. Please try again."))
+            #         return
+            #     results = json.loads(response.content)
+            #     if results['image_id'] != 'NA':
+            #         break
+            
+            """
+            Retrying image capturing again using different configurations
+            """
+            if results['image_id'] != 'NA' or image_capture_count > 7:
+                self.logger.info("Breaking out of snap_and_rec")
+                break
+            self.logger.info(f"Image recognition results: {results}")
+
+        return results
 
     def request_algo(self, data, robot_x=1, robot_y=1, robot_dir=0, retrying=False):
         """
@@ -596,8 +681,7 @@ class RaspberryPi:
         self.logger.info(f"data: {data}")
         body = {**data, "big_turn": "0", "robot_x": robot_x,
                 "robot_y": robot_y, "robot_dir": robot_dir, "retrying": retrying}
-        url = f"http://{API_IP}:{API_PORT}/compute"
-        response = requests.post(url, json=body)
+        response = self.api.post("/compute", json=body)
 
         # Error encountered at the server, return early
         if response.status_code != 200:
@@ -617,6 +701,10 @@ class RaspberryPi:
         # Log commands received
         self.logger.debug(f"Commands received from API: {commands}")
 
+        if COMPACT_COMMANDS:
+            commands, path, saved = compact_path(commands, path)
+            self.logger.info(f"Compacted commands save {saved} STM32 round-trip(s): {commands}")
+
         # Put commands and paths into respective queues
         self.clear_queues()
         for c in commands:
@@ -631,8 +719,7 @@ class RaspberryPi:
 
     def request_stitch(self):
         """Sends a stitch request to the image recognition API to stitch the different images together"""
-        url = f"http://{API_IP}:{API_PORT}/stitch"
-        response = requests.get(url)
+        response = self.api.get("/stitch")
 
         # If error, then log, and send error to Android
         if response.status_code != 200:
@@ -660,10 +747,9 @@ class RaspberryPi:
             bool: True if running, False if not.
         """
         # Check image recognition API
-        url = f"http://{API_IP}:{API_PORT}/"
         try:
             print('hi!')
-            response = requests.get(url, timeout=1)
+            response = self.api.get("/", timeout=1)
             if response.status_code == 200:
                 self.logger.debug("API is up!")
                 return True
@@ -681,5 +767,12 @@ class RaspberryPi:
 
 
 if __name__ == "__main__":
-    rpi = RaspberryPi()
+    # `--asyncio` runs the pipeline as coroutines in a single process instead of one process per stage
+    if "--asyncio" in sys.argv[1:]:
+        from task1_async import AsyncRaspberryPi
+        rpi = AsyncRaspberryPi()
+    else:
+        rpi = RaspberryPi()
+    # `kill -USR1 <pid>` logs the timings so far
+    dump_on_signal(rpi.logger)
     rpi.start()
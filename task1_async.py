@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+import asyncio
+import queue
+import time
+from typing import Any, Callable
+from communication.android import AndroidMessage
+from communication.stm32 import STMLink
+from dispatcher import CommandDispatcher
+from metrics import metrics
+from settings import ANDROID_SEND_INTERVAL, STM_SEND_WINDOW
+from task1 import STM32_PREFIXES, PiAction, RaspberryPi
+
+
+async def to_thread(func: Callable, *args) -> Any:
+    """Runs a blocking function in a worker thread of the running loop, like asyncio.to_thread() of Python 3.9+"""
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+class LoopManager:
+    """
+    Manager for a single-process RPi, whose queues, locks and events live on one asyncio event loop.
+
+    Coroutines on the loop await them, while the blocking work that runs in worker threads (HTTP requests to the
+    API, camera captures) can still put, set and release them like the multiprocessing ones, since those calls
+    are handed over to the loop.
+
+    The queues, locks and events can be created before the loop runs, but their asyncio counterparts are only
+    created by bind(), as they are tied to the loop they are created on before Python 3.10.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self._primitives = []
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        """
+        Binds the manager to the event loop that its queues, locks and events are used on. Must be called from
+        that loop.
+        :param loop: The running event loop.
+        """
+        self.loop = loop
+        for primitive in self._primitives:
+            primitive.bind()
+
+    def call(self, callback: Callable, *args) -> None:
+        """
+        Runs a callback on the loop: straight away when called from the loop, or as soon as possible otherwise.
+        :param callback: Function to run.
+        """
+        try:
+            on_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def Event(self) -> "LoopEvent":
+        return self._add(LoopEvent(self))
+
+    def Lock(self) -> "LoopLock":
+        return self._add(LoopLock(self))
+
+    def Queue(self) -> "LoopQueue":
+        return self._add(LoopQueue(self))
+
+    def Value(self, typecode: str, value: Any) -> "LoopValue":
+        return LoopValue(value)
+
+    def list(self) -> list:
+        return []
+
+    def dict(self) -> dict:
+        return {}
+
+    def shutdown(self):
+        pass
+
+    def _add(self, primitive: Any) -> Any:
+        """Creates the asyncio counterpart of a queue, lock or event straight away if the manager is bound, or
+        once it is"""
+        self._primitives.append(primitive)
+        if self.loop is not None:
+            primitive.bind()
+        return primitive
+
+
+class LoopEvent:
+    """asyncio.Event that worker threads can also set and clear"""
+
+    def __init__(self, manager: LoopManager):
+        self._manager = manager
+        self._event = None
+
+    def bind(self):
+        self._event = asyncio.Event()
+
+    def is_set(self) -> bool:
+        return self._event.is_set()
+
+    def set(self):
+        self._manager.call(self._event.set)
+
+    def clear(self):
+        self._manager.call(self._event.clear)
+
+    async def wait(self):
+        await self._event.wait()
+
+
+class LoopLock:
+    """asyncio.Lock that worker threads can also release"""
+
+    def __init__(self, manager: LoopManager):
+        self._manager = manager
+        self._lock = None
+
+    def bind(self):
+        self._lock = asyncio.Lock()
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    async def acquire(self):
+        await self._lock.acquire()
+
+    def release(self):
+        if not self._lock.locked():
+            raise RuntimeError("Lock is not acquired.")
+        self._manager.call(self._lock.release)
+
+
+class LoopQueue:
+    """asyncio.Queue that worker threads can also put into"""
+
+    def __init__(self, manager: LoopManager):
+        self._manager = manager
+        self._queue = None
+
+    def bind(self):
+        self._queue = asyncio.Queue()
+
+    def put(self, item: Any):
+        self._manager.call(self._queue.put_nowait, item)
+
+    async def get(self) -> Any:
+        return await self._queue.get()
+
+    def get_nowait(self) -> Any:
+        try:
+            return self._queue.get_nowait()
+        except asyncio.QueueEmpty:
+            raise queue.Empty
+
+    def empty(self) -> bool:
+        return self._queue.empty()
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def clear(self):
+        """Removes all items from the queue"""
+        self._manager.call(self._clear)
+
+    def _clear(self):
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+
+class LoopValue:
+    """Plain holder for a value, since all coroutines and threads share the process"""
+
+    def __init__(self, value: Any):
+        self.value = value
+
+
+class AsyncCommandDispatcher(CommandDispatcher):
+    """
+    CommandDispatcher that coroutines can wait on without blocking the event loop.
+    """
+
+    def __init__(self, link: STMLink, manager: LoopManager, window: int = STM_SEND_WINDOW):
+        """
+        Constructor for AsyncCommandDispatcher.
+        :param link: Link to STM32 that the commands are sent over.
+        :param manager: Manager bound to the event loop that the waiting coroutines run on.
+        :param window: Maximum number of commands sent but not acknowledged yet.
+        """
+        super().__init__(link, window)
+        self._manager = manager
+        self._wakeup = manager.Event()
+
+    async def wait_until(self, predicate: Callable[[], bool]):
+        """
+        Waits until a predicate on the dispatcher holds, e.g. can_send(), without blocking the event loop.
+        :param predicate: Function that checks the state of the dispatcher.
+        """
+        with metrics.timer("lock_wait"):
+            while True:
+                with self._changed:
+                    if predicate():
+                        return
+                    # Cleared under the condition, so a change made after the check always sets it again
+                    self._wakeup.clear()
+                await self._wakeup.wait()
+
+    def _notify(self):
+        super()._notify()
+        self._wakeup.set()
+
+
+class AsyncRaspberryPi(RaspberryPi):
+    """
+    Raspberry Pi orchestrator that runs the task 1 pipeline as coroutines in a single process, instead of one
+    process per pipeline stage.
+
+    Serial and Bluetooth are read when the event loop reports them readable, and the HTTP requests to the API and
+    the camera captures run in worker threads, so that they do not hold up the loop. The messages, commands and
+    actions are handled by the same methods as in RaspberryPi.
+    """
+
+    def __init__(self):
+        """
+        Initializes the Raspberry Pi.
+        """
+        super().__init__(manager=LoopManager())
+        # Set while the Android link is up, so that the sender waits instead of failing during a reconnection
+        self.android_connected = self.manager.Event()
+
+    def create_dispatcher(self) -> CommandDispatcher:
+        return AsyncCommandDispatcher(self.stm_link, self.manager)
+
+    def start(self):
+        """Starts the RPi orchestrator"""
+        try:
+            asyncio.run(self.run())
+        except KeyboardInterrupt:
+            self.stop()
+        except Exception as e:
+            self.logger.error(f"An error occurred in the start process: {str(e)}")
+            self.stop()
+
+    async def run(self):
+        """Connects to Android, STM32 and the camera, and runs the pipeline until interrupted"""
+        loop = asyncio.get_running_loop()
+        self.manager.bind(loop)
+
+        ### Start up initialization ###
+
+        await to_thread(self.android_link.connect)
+        self.android_queue.put(AndroidMessage(
+            'info', 'You are connected to the RPi!'))
+        self.stm_link.connect()
+        self.camera.start()
+        await to_thread(self.check_api)
+
+        loop.add_reader(self.android_link.client_sock.fileno(), self.recv_android)
+        loop.add_reader(self.stm_link.serial_link.fileno(), self.recv_stm)
+        self.android_connected.set()
+
+        for coroutine in (self.android_sender(), self.command_follower(), self.rpi_action(), self.ack_watchdog()):
+            task = loop.create_task(coroutine)
+            task.add_done_callback(self._log_task_error)
+
+        self.logger.info("Pipeline tasks started")
+        self.start_metrics_server()
+
+        ### Start up complete ###
+
+        # Send success message to Android
+        self.android_queue.put(AndroidMessage('info', 'Robot is ready!'))
+        self.android_queue.put(AndroidMessage('mode', self.android_mode()))
+        await self.reconnect_android()
+
+    async def reconnect_android(self):
+        """Handles the reconnection to Android in the event of a lost connection."""
+        self.logger.info("Reconnection handler is watching...")
+        loop = asyncio.get_running_loop()
+
+        while True:
+            # Wait for android connection to drop
+            await self.android_dropped.wait()
+
+            self.logger.error("Android link is down!")
+
+            # Keeps listening, so that Android can reconnect straight away
+            self.android_link.close_client()
+
+            # Reconnect
+            await to_thread(self.android_link.connect)
+            loop.add_reader(self.android_link.client_sock.fileno(), self.recv_android)
+            self.android_connected.set()
+
+            self.logger.info("Android link reconnected")
+            self.android_queue.put(AndroidMessage(
+                "info", "You are reconnected!"))
+            self.android_queue.put(AndroidMessage('mode', self.android_mode()))
+
+            self.android_dropped.clear()
+
+    def recv_android(self) -> None:
+        """
+        [Reader Callback] Processes the messages received from Android
+        """
+        # Reads the socket once, which may complete several messages, then takes the rest out of the buffer, as the
+        # socket is not reported readable again for them
+        while True:
+            try:
+                msg_str = self.android_link.recv(wait=False)
+            except OSError:
+                self.drop_android("Event set: Android connection dropped")
+                return
+
+            if msg_str == "":
+                # The socket reads as empty once Android closes the connection
+                self.drop_android("Event set: Android connection closed")
+                return
+
+            if msg_str is not None:
+                try:
+                    self.handle_android_message(msg_str)
+                except Exception as e:
+                    self.logger.error(f"Failed to handle message from Android {msg_str!r}: {e}")
+
+            if not self.android_link.buffered:
+                return
+
+    def drop_android(self, reason: str) -> None:
+        """
+        Stops reading from the Android link and signals the reconnection handler
+        :param reason: message to log
+        """
+        if self.android_dropped.is_set():
+            return
+        asyncio.get_running_loop().remove_reader(self.android_link.client_sock.fileno())
+        self.android_connected.clear()
+        self.android_dropped.set()
+        self.logger.debug(reason)
+
+    def recv_stm(self) -> None:
+        """
+        [Reader Callback] Receives acknowledgement messages from STM32 as they arrive, and passes them to the dispatcher
+        """
+        for message in self.stm_link.poll():
+            self.handle_stm_message(message)
+
+    async def ack_watchdog(self) -> None:
+        """
+        [Task] Takes in a partial message from STM32 that lost its newline, and resends or gives up on commands whose
+        ACK is overdue, every second
+        """
+        while True:
+            await asyncio.sleep(1)
+            self.recv_stm()
+            ack = self.dispatcher.expire()
+            if ack is not None:
+                self.handle_given_up(ack)
+
+    async def android_sender(self) -> None:
+        """
+        [Task] Responsible for retrieving messages from android_queue and sending them over the Android link.
+        Messages are written at most every ANDROID_SEND_INTERVAL, and the ones that queue up in between are coalesced
+        and sent together. While Android is disconnected, the messages wait in the outbox until it reconnects.
+        """
+        outbox = self.android_outbox
+        last_sent = 0.0
+        connections = self.android_link.connections
+        while True:
+            outbox.put(await self.android_queue.get())
+            # Collect the messages that arrive until the next write is allowed, unless a priority message is waiting
+            while True:
+                try:
+                    outbox.put(self.android_queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    pass
+                wait = last_sent + ANDROID_SEND_INTERVAL - time.monotonic()
+                if outbox.urgent or wait <= 0:
+                    break
+                try:
+                    outbox.put(await asyncio.wait_for(self.android_queue.get(), wait))
+                except asyncio.TimeoutError:
+                    break
+            await self.android_connected.wait()
+            if self.android_link.connections != connections:
+                connections = self.android_link.connections
+                # Android may have missed the last location and status while it was disconnected
+                outbox.replay()
+            messages = outbox.take()
+
+            try:
+                self.android_link.send_many(messages)
+            except OSError:
+                outbox.restore(messages)
+                self.drop_android("Event set: Android dropped")
+                continue
+            last_sent = time.monotonic()
+            self.logger.debug(f"Sent {len(messages)} message(s) to Android in one write, oldest after "
+                              f"{outbox.last_latency * 1000:.1f} ms, {outbox.coalesced} location(s) coalesced so far")
+
+    async def command_follower(self) -> None:
+        """
+        [Task] Carries out the commands one at a time, waiting without blocking the loop until the dispatcher can
+        take each one
+        """
+        while True:
+            # Retrieve next movement command
+            command: str = await self.command_queue.get()
+            self.logger.debug("wait for unpause")
+            # Wait for unpause event to be true [Main Trigger]
+            await self.unpause.wait()
+
+            # Wait until dispatch_command() can carry out the command straight away
+            if command.startswith(STM32_PREFIXES):
+                await self.dispatcher.wait_until(self.dispatcher.can_send)
+            elif command.startswith("SNAP"):
+                await self.dispatcher.wait_until(self.dispatcher.can_hold)
+            elif command == "FIN":
+                await self.dispatcher.wait_until(self.dispatcher.is_idle)
+            self.dispatch_command(command)
+
+    async def rpi_action(self) -> None:
+        """
+        [Task] Carries out the actions one at a time in a worker thread, since they call the API and the camera
+        """
+        while True:
+            action: PiAction = await self.rpi_action_queue.get()
+            self.logger.debug(
+                f"PiAction retrieved from queue: {action.cat} {action.value}"
+            )
+            await to_thread(self.handle_action, action)
+
+    def clear_queues(self):
+        """Clear both command and path queues"""
+        self.command_queue.clear()
+        self.path_queue.clear()
+
+    def _log_task_error(self, task: asyncio.Task) -> None:
+        """Logs the error that ended a pipeline task, which would otherwise go unnoticed"""
+        if not task.cancelled() and task.exception() is not None:
+            self.logger.error(f"Pipeline task {task.get_coro().__name__} stopped: {task.exception()}")
+
@@ -176,6 +176,11 @@ class RaspberryPi:
 
             if msg_str is None:
                 continue
+            if msg_str == "":
+                # The socket reads as empty once Android closes the connection
+                self.android_dropped.set()
+                self.logger.debug("Event set: Android connection closed")
+                return
             
             message: dict = json.loads(msg_str)
 
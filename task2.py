@@ -1,25 +1,31 @@
 #!/usr/bin/env python3
 import json
-import io
-import picamera
 import queue
 import signal
 import time
-from multiprocessing import Process, Manager
-from typing import Optional
+from multiprocessing import Process
+from typing import List, Optional
 import os
 import requests
-from communication.android import AndroidLink, AndroidMessage
-from communication.stm32 import STMLink
+from camera import CameraService
+from communication.android import AndroidLink, AndroidMessage, AndroidMixin, AndroidOutbox, SocketHandoff
+from communication.api import APIClient
+from communication.stm32 import STMLink, STMMessage
 from consts import SYMBOL_MAP
-from logger import prepare_logger
-from settings import API_IP, API_PORT
+from dispatcher import Ack, CommandDispatcher
+from imgrec import ImageRecognizer
+from ipc import create_manager
+from logger import prepare_logger, start_segment
+from metrics import Gauge, MetricsServer, dump_on_signal, metrics
+from settings import METRICS_PORT, SNAP_MODE, STM_READER_THREAD
 
 
 class PiAction:
     def __init__(self, cat, value):
         self._cat = cat
         self._value = value
+        # Monotonic time at which the action was created, to measure how long it waits to be carried out
+        self.created = time.monotonic()
 
     @property
     def cat(self):
@@ -30,29 +36,37 @@ class PiAction:
         return self._value
 
 
-class RaspberryPi:
+class RaspberryPi(AndroidMixin):
     def __init__(self):
         # Initialize logger and communication objects with Android and STM
         self.logger = prepare_logger()
         self.android_link = AndroidLink()
         self.stm_link = STMLink()
+        self.api = APIClient()
+        self.camera = CameraService()
+        self.image_recognizer = ImageRecognizer(self.camera, self.api)
 
         # For sharing information between child processes
-        self.manager = Manager()
+        self.manager = create_manager()
 
         # Set robot mode to be 1 (Path mode)
         self.robot_mode = self.manager.Value('i', 1)
 
         # Events
         self.android_dropped = self.manager.Event()  # Set when the android link drops
+        # Pass the connection to Android on to the child processes using it when Android reconnects
+        self.android_recv_handoff = SocketHandoff()
+        self.android_send_handoff = SocketHandoff()
         # commands will be retrieved from commands queue when this event is set
         self.unpause = self.manager.Event()
 
-        # Movement Lock
-        self.movement_lock = self.manager.Lock()
+        # Sends the commands to STM32 and tracks them until they are acknowledged
+        self.dispatcher = CommandDispatcher(self.stm_link)
 
         # Queues
         self.android_queue = self.manager.Queue() # Messages to send to Android
+        # Messages waiting in android_sender, created here so that the metrics endpoint can read its counters
+        self.android_outbox = AndroidOutbox()
         self.rpi_action_queue = self.manager.Queue() # Messages that need to be processed by RPi
         self.command_queue = self.manager.Queue() # Messages that need to be processed by STM32, as well as snap commands
 
@@ -63,6 +77,9 @@ class RaspberryPi:
         self.proc_command_follower = None
         self.proc_rpi_action = None
 
+        # Serves the state of the orchestrator to a local scraper during the run
+        self.metrics_server = None
+
         self.ack_count = 0
         self.near_flag = self.manager.Lock()
 
@@ -76,6 +93,9 @@ class RaspberryPi:
             # Establish connection with STM32
             self.stm_link.connect()
 
+            # Open the camera once and keep it warm for the whole run
+            self.camera.start()
+
             # Check Image Recognition and Algorithm API status
             self.check_api()
             
@@ -100,12 +120,14 @@ class RaspberryPi:
             self.proc_rpi_action.start()
 
             self.logger.info("Child Processes started")
+            # After the child processes are forked, so that they do not inherit its socket
+            self.start_metrics_server()
 
             ### Start up complete ###
 
             # Send success message to Android
             self.android_queue.put(AndroidMessage('info', 'Robot is ready!'))
-            self.android_queue.put(AndroidMessage('mode', 'path' if self.robot_mode.value == 1 else 'manual'))
+            self.android_queue.put(AndroidMessage('mode', self.android_mode()))
             
             # Handover control to the Reconnect Handler to watch over Android connection
             self.reconnect_android()
@@ -120,109 +142,113 @@ class RaspberryPi:
 
     def stop(self):
         """Stops all processes on the RPi and disconnects gracefully with Android and STM32"""
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
         self.android_link.disconnect()
         self.stm_link.disconnect()
+        self.camera.stop()
+        self.manager.shutdown()
         self.logger.info("Program exited!")
 
-    def reconnect_android(self):
-        """Handles the reconnection to Android in the event of a lost connection."""
-        self.logger.info("Reconnection handler is watching...")
-
-        while True:
-            # Wait for android connection to drop
-            self.android_dropped.wait()
-
-            self.logger.error("Android link is down!")
-
-            # Kill child processes
-            self.logger.debug("Killing android child processes")
-            self.proc_android_sender.kill()
-            self.proc_recv_android.kill()
-
-            # Wait for the child processes to finish
-            self.proc_android_sender.join()
-            self.proc_recv_android.join()
-            assert self.proc_android_sender.is_alive() is False
-            assert self.proc_recv_android.is_alive() is False
-            self.logger.debug("Android child processes killed")
-
-            # Clean up old sockets
-            self.android_link.disconnect()
-
-            # Reconnect
-            self.android_link.connect()
-
-            # Recreate Android processes
-            self.proc_recv_android = Process(target=self.recv_android)
-            self.proc_android_sender = Process(target=self.android_sender)
-
-            # Start previously killed processes
-            self.proc_recv_android.start()
-            self.proc_android_sender.start()
-
-            self.logger.info("Android child processes restarted")
-            self.android_queue.put(AndroidMessage("info", "You are reconnected!"))
-            self.android_queue.put(AndroidMessage('mode', 'path' if self.robot_mode.value == 1 else 'manual'))
-
-            self.android_dropped.clear()
+    def start_metrics_server(self):
+        """Serves the gauges of gauges() and the timings of the hot path at /metrics, unless METRICS_PORT is None"""
+        if METRICS_PORT is None:
+            return
+        try:
+            self.metrics_server = MetricsServer(self.gauges)
+            self.metrics_server.start()
+            self.logger.info(f"Serving metrics on port {self.metrics_server.port}")
+        except OSError as e:
+            # The run goes on without them, e.g. when another orchestrator still holds the port
+            self.metrics_server = None
+            self.logger.warning(f"Could not serve metrics on port {METRICS_PORT}: {e}")
+
+    def gauges(self) -> List[Gauge]:
+        """
+        Reads the state of the orchestrator for the metrics endpoint, from the thread serving it.
+        :return: The gauges.
+        """
+        return [
+            ("rpi_queue_depth", "Items waiting in each queue", {"queue": "command"}, self.command_queue.qsize()),
+            ("rpi_queue_depth", "Items waiting in each queue", {"queue": "android"}, self.android_queue.qsize()),
+            ("rpi_queue_depth", "Items waiting in each queue", {"queue": "rpi_action"}, self.rpi_action_queue.qsize()),
+            ("rpi_commands_in_flight", "Commands sent to STM32 and not acknowledged yet", {},
+             self.dispatcher.in_flight),
+            ("rpi_dispatcher_held", "Whether the dispatcher is held, e.g. during a capture", {},
+             int(self.dispatcher.held)),
+            ("rpi_last_ack_seconds", "Time from the last command acknowledged being sent to its ACK", {},
+             metrics.last("ack_wait")),
+            *self.android_gauges(),
+        ]
+
+    def android_mode(self) -> str:
+        return 'path' if self.robot_mode.value == 1 else 'manual'
+
+    def handle_android_message(self, msg_str: str) -> None:
+        """
+        Starts the run when Android sends the start command
+        :param msg_str: the JSON message received from Android
+        """
+        message: dict = json.loads(msg_str)
+
+        ## Command: Start Moving ##
+        if message['cat'] == "control":
+            if message['value'] == "start":
+    
+                if not self.check_api():
+                    self.logger.error("API is down! Start command aborted.")
+
+                # Every start is a new run, which is logged to a segment of its own, and timed from scratch
+                start_segment("run")
+                metrics.reset()
+                self.clear_queues()
+                self.command_queue.put("RS00") # ack_count = 1
+
+                self.logger.info("Start command received, starting robot on Week 9 task!")
+                self.android_queue.put(AndroidMessage('status', 'running'))
+                self.android_queue.put(AndroidMessage('info','Clearing first obstacle...'))
+                # Commencing path following | Main trigger to start movement #
+                self.unpause.set()                    
+
+                # elif self.small_direction == None or self.small_direction == 'None':
+                #     self.logger.info("Acquiring near_flag log")
+                #     self.near_flag.acquire()             
                 
-    def recv_android(self) -> None:
+    def stop_unconfirmed(self, ack: Ack) -> None:
         """
-        [Child Process] Processes the messages received from Android
+        Stops the run when a command is given up on without an ACK. The next step depends on where the robot ended
+        up, so the run cannot carry on as if the command was carried out, and carrying it out again could move the
+        robot twice
+        :param ack: the command given up on
         """
-       
-        while True:
-            msg_str: Optional[str] = None
-            try:
-                msg_str = self.android_link.recv()
-            except OSError:
-                self.android_dropped.set()
-                self.logger.debug("Event set: Android connection dropped")
-
-            # If an error occurred in recv()
-            if msg_str is None:
-                continue
+        self.logger.error(f"{ack.command} (#{ack.seq}) was not confirmed by STM32 at ACK count {self.ack_count}, "
+                          f"stopping the run")
+        self.unpause.clear()
+        self.android_queue.put(AndroidMessage("error", f"STM32 did not confirm {ack.command}, run stopped."))
 
-            message: dict = json.loads(msg_str)
-
-            ## Command: Start Moving ##
-            if message['cat'] == "control":
-                if message['value'] == "start":
-        
-                    if not self.check_api():
-                        self.logger.error("API is down! Start command aborted.")
-
-                    self.clear_queues()
-                    self.command_queue.put("RS00") # ack_count = 1
-
-                    self.logger.info("Start command received, starting robot on Week 9 task!")
-                    self.android_queue.put(AndroidMessage('status', 'running'))
-                    self.android_queue.put(AndroidMessage('info','Clearing first obstacle...'))
-                    # Commencing path following | Main trigger to start movement #
-                    self.unpause.set()                    
-
-                    # elif self.small_direction == None or self.small_direction == 'None':
-                    #     self.logger.info("Acquiring near_flag log")
-                    #     self.near_flag.acquire()             
-                    
     def recv_stm(self) -> None:
         """
-        [Child Process] Receive acknowledgement messages from STM32, and release the movement lock
+        [Child Process] Receive acknowledgement messages from STM32, and pass them to the command dispatcher
         """
+        if STM_READER_THREAD:
+            self.stm_link.start_reader()
         while True:
+            # Wakes up at least every second to resend or give up on commands whose ACK is overdue
+            message: Optional[STMMessage] = self.stm_link.recv(timeout=1)
+            if message is None:
+                ack = self.dispatcher.expire()
+                if ack is not None:
+                    self.stop_unconfirmed(ack)
+                continue
+            if not message.startswith("ACK"):
+                self.logger.warning(
+                    f"Ignored unknown message from STM: {message}")
+                continue
 
-            message: str = self.stm_link.recv()
             # Acknowledgement from STM32
-            if message.startswith("ACK"):
-
+            for ack in self.dispatcher.ack(message.seq):
                 self.ack_count += 1
 
-                # Release movement lock
-                try:
-                    self.movement_lock.release()
-                except Exception:
-                    self.logger.warning("Tried to release a released lock!")
-
                 self.logger.debug(f"ACK from STM32 received, ACK count now:{self.ack_count}")
 
                 if self.ack_count == 1:
@@ -281,40 +307,32 @@ class RaspberryPi:
 
                 # except Exception:
                 #     self.logger.warning("Tried to release a released lock!")
-            else:
-                self.logger.warning(
-                    f"Ignored unknown message from STM: {message}")
-
-    def android_sender(self) -> None:
-        while True:
-            try:
-                message: AndroidMessage = self.android_queue.get(timeout=0.5)
-            except queue.Empty:
-                continue
-
-            try:
-                self.android_link.send(message)
-            except OSError:
-                self.android_dropped.set()
-                self.logger.debug("Event set: Android dropped")
 
     def command_follower(self) -> None:
         while True:
             command: str = self.command_queue.get()
             self.unpause.wait()
-            self.movement_lock.acquire()
             stm32_prefixes = ("FS", "BS", "FW", "BW", "FL", "FR", "BL",
                               "BR", "TL", "TR", "A", "C", "DT", "STOP", "ZZ", "RS",
                               "SR", "SL", "LL", "LR", "BK")
             if command.startswith(stm32_prefixes):
-                self.stm_link.send(command)
+                if not self.stm_link.accepts(command):
+                    self.logger.error(f"Skipped {command}, it cannot be sent in {self.stm_link.protocol} protocol")
+                    self.android_queue.put(AndroidMessage("error", f"Skipped unsupported command {command}"))
+                    continue
+                try:
+                    self.dispatcher.send(command)
+                except (ValueError, OSError) as e:
+                    # Skip the command rather than bring down command_follower
+                    self.logger.error(f"Failed to send {command} to STM32: {e}")
             elif command == "FIN":
+                self.dispatcher.wait_idle()
                 self.unpause.clear()
-                self.movement_lock.release()
                 self.logger.info("Commands queue finished.")
                 self.android_queue.put(AndroidMessage("info", "Commands queue finished."))
                 self.android_queue.put(AndroidMessage("status", "finished"))
                 self.rpi_action_queue.put(PiAction(cat="stitch", value=""))
+                self.logger.info(f"Timings of the run:\n{metrics.summary()}")
             else:
                 raise Exception(f"Unknown command: {command}")
 
@@ -322,9 +340,13 @@ class RaspberryPi:
     def rpi_action(self):
         while True:
             action: PiAction = self.rpi_action_queue.get()
+            metrics.record("action_queue_wait", time.monotonic() - action.created)
             self.logger.debug(f"PiAction retrieved from queue: {action.cat} {action.value}")
             if action.cat == "snap": self.snap_and_rec(obstacle_id=action.value)
-            elif action.cat == "stitch": self.request_stitch()
+            elif action.cat == "stitch":
+                self.request_stitch()
+                # The run ends once the images are stitched
+                start_segment("idle")
 
     def snap_and_rec(self, obstacle_id: str) -> None:
     #def snap_and_rec(self, obstacle_id_with_signal: str) -> None:
@@ -338,59 +360,23 @@ class RaspberryPi:
         signal = "C"
         self.android_queue.put(AndroidMessage("info", f"Capturing image for obstacle id: {obstacle_id}"))
 
-        image_capture_count = 0
         start = time.time()
-        with picamera.PiCamera() as camera:
-            camera.start_preview()
-            camera.vflip = True  # Vertical flip
-            camera.hflip = True  # Horizontal flip
-            # time.sleep(1)
-
-            while True: 
-                image_capture_count += 1
-                print(f"Image Capture Count: {image_capture_count}")
-                self.logger.debug("Requesting from image API")
-                
-                # Reset the stream before capturing a new image
-                stream = io.BytesIO()
-
-                # call image-rec API endpoint
-                url = f"http://{API_IP}:{API_PORT}/image"
-                camera.capture(stream,format='jpeg')
-                image_data = stream.getvalue()
-                filename = f"{int(time.time())}_{obstacle_id}_{signal}.jpg"
-
-                # notify android
-                self.android_queue.put(AndroidMessage("info", "Image captured. Calling image-rec api..."))
-                self.logger.info("Image captured. Calling image-rec api...")
-                response = requests.post(url, files={"file": (filename, image_data)})
-                if response.status_code != 200:
-                    self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
-                    self.android_queue.put(AndroidMessage(
-                        "error", "Something went wrong when requesting path from image-rec API. Please try again."))
-                    return
-                
-                results = json.loads(response.content)
-
-                """
-                Retrying image capturing again using different configurations
-                """
-                if results['image_id'] != 'NA' or results['image_id'] !='Bullseye' or image_capture_count > 2:
-                    break
-                elif image_capture_count <= 0: # 1st try
-                    self.logger.info(f"Image recognition results: {results}")
-                    self.logger.info("Recapturing with same shutter speed...")
-                elif image_capture_count <= 1: # 2nd try
-                    self.logger.info(f"Image recognition results: {results}")
-                    self.logger.info("Recapturing with higher brightness...")
-                    camera.brightness = 60
-                    camera.contrast = 90
-                elif image_capture_count == 2: # 3rd try
-                    self.logger.info(f"Image recognition results: {results}")
-                    self.logger.info("Recapturing with lower brightness...")
-                    camera.brightness = 30
-                    camera.contrast = 100
-                    camera.framerate = 70
+
+        try:
+            if SNAP_MODE == "bracket":
+                results = self.image_recognizer.snap_bracket(obstacle_id, signal)
+            elif SNAP_MODE == "concurrent":
+                results = self.image_recognizer.snap_concurrent(obstacle_id, signal)
+            else:
+                results = self.snap_sequential(obstacle_id, signal)
+        except Exception as e:
+            # The robot goes on with the default direction rather than stopping in front of the obstacle
+            self.logger.error(f"Snap for obstacle id {obstacle_id} failed: {e}")
+            results = None
+        if results is None:
+            self.android_queue.put(AndroidMessage(
+                "error", "Something went wrong when requesting path from image-rec API. Please try again."))
+            return
 
         time_taken = time.time() - start
         # Print total time taken to 1dp
@@ -400,9 +386,57 @@ class RaspberryPi:
         self.logger.info(f"Image recognition results: {results} ({ans})")
         return ans
 
+    def snap_sequential(self, obstacle_id: str, signal: str) -> Optional[dict]:
+        """
+        Captures and sends images one at a time, retrying with different camera settings until the image is recognized.
+        :param obstacle_id: the current obstacle ID
+        :param signal: the position of the obstacle relative to the robot
+        :return: the image-rec results, or None if the request to the image-rec API failed
+        """
+        image_capture_count = 0
+
+        # Settings carried over between retries
+        camera_settings = {}
+        while True: 
+            image_capture_count += 1
+            print(f"Image Capture Count: {image_capture_count}")
+            self.logger.debug("Requesting from image API")
+            
+            # call image-rec API endpoint
+            image_data = self.camera.capture(**camera_settings, signal=signal)
+            filename = f"{int(time.time())}_{obstacle_id}_{signal}.jpg"
+
+            # notify android
+            self.android_queue.put(AndroidMessage("info", "Image captured. Calling image-rec api..."))
+            self.logger.info("Image captured. Calling image-rec api...")
+            response = self.api.post_file("/image", filename, image_data)
+            if response.status_code != 200:
+                self.logger.error("Something went wrong when requesting path from image-rec API. Please try again.")
+                return None
+            
+            results = json.loads(response.content)
+
+            """
+            Retrying image capturing again using different configurations
+            """
+            if results['image_id'] != 'NA' or results['image_id'] !='Bullseye' or image_capture_count > 2:
+                break
+            elif image_capture_count <= 0: # 1st try
+                self.logger.info(f"Image recognition results: {results}")
+                self.logger.info("Recapturing with same shutter speed...")
+            elif image_capture_count <= 1: # 2nd try
+                self.logger.info(f"Image recognition results: {results}")
+                self.logger.info("Recapturing with higher brightness...")
+                camera_settings.update(brightness=60, contrast=90)
+            elif image_capture_count == 2: # 3rd try
+                self.logger.info(f"Image recognition results: {results}")
+                self.logger.info("Recapturing with lower brightness...")
+                camera_settings.update(brightness=30, contrast=100, framerate=70)
+
+        return results
+
     def request_stitch(self):
-        url = f"http://{API_IP}:{API_PORT}/stitch"
-        response = requests.get(url)
+        response = self.api.get("/stitch")
         if response.status_code != 200:
             self.logger.error("Something went wrong when requesting stitch from the API.")
             return
@@ -413,9 +447,8 @@ class RaspberryPi:
             self.command_queue.get()
 
     def check_api(self) -> bool:
-        url = f"http://{API_IP}:{API_PORT}/"
         try:
-            response = requests.get(url, timeout=1)
+            response = self.api.get("/", timeout=1)
             if response.status_code == 200:
                 self.logger.info("API is up!")
                 return True
@@ -469,4 +502,6 @@ class RaspberryPi:
 
 if __name__ == "__main__":
     rpi = RaspberryPi()
+    # `kill -USR1 <pid>` logs the timings so far
+    dump_on_signal(rpi.logger)
     rpi.start()